@@ -1,34 +1,150 @@
 import datetime
 import logging
-from urllib.parse import urlparse, ParseResult, unquote
+import time
 
 import urllib3
 
+from crawler.host_limiter import RETRYABLE_STATUSES
+from crawler.url_canonicalizer import UrlCanonicalizer, sanitize_url
+
+# Content types of the pages worth reading, a response without one is read
+# too.
+PAGE_TYPES = ("text/html", "application/xhtml+xml")
+
+# Bytes read off a response at a time
+_CHUNK_BYTES = 64 * 1024
+
+# Error responses smaller than this are read to the end to keep their
+# connection alive, larger ones are not worth it.
+_MAX_DRAIN_BYTES = 64 * 1024
+
+# Responses which never have a body, so need no draining to keep their
+# connection alive, eg. the 304 of a revisit.
+_NO_BODY_STATUSES = (204, 304)
+
+
+# Returns a connection pool for the crawlers of a process to share, keeping up
+# to max_connections connections to a host alive, which is to be the number of
+# fetches the process runs at a time. Pages are asked for compressed, with
+# gzip and deflate and also brotli if it is installed, and decoded by urllib3.
+def make_pool(max_connections):
+    return urllib3.PoolManager(num_pools=10,
+                               maxsize=max(1, max_connections),
+                               headers=urllib3.make_headers(
+                                   keep_alive=True, accept_encoding=True))
+
+
+# True if e, raised by a request, is down to the host rather than to the url,
+# ie. connecting to it failed, the connection dropped or it timed out, and so
+# worth a retry and less load on the host. A keep-alive connection the host
+# closed while it sat in the pool fails with a ProtocolError.
+def _is_host_failure(e):
+    if isinstance(e, urllib3.exceptions.MaxRetryError):
+        e = e.reason
+    return isinstance(e, (urllib3.exceptions.TimeoutError,
+                          urllib3.exceptions.NewConnectionError,
+                          urllib3.exceptions.ProtocolError))
+
 
 class UrlCrawler:
     _pool = None
-    _base = None
     _url = None
     _crawl_time = None
     _contents = None
     _is_redirect = False
+    _not_modified = False
+    _transient_failure = False
+    _etag = None
+    _last_modified = None
+    _canonicalizer = None
+    _metrics = None
+    _scheduler = None
+    _timeout = 0
+    _retries = None
+    _wire_bytes = 0
+    _max_page_bytes = 0
+    _rejection = None
 
-    def __init__(self, base_domain):
-        self._pool = urllib3.PoolManager(10)
-        self._base = urlparse(base_domain, allow_fragments=False)
-        logging.info("Netloc of base: %s", self._base.netloc)
-        assert len(self._base.netloc) > 0
+    # canonicalize_cache_size bounds the number of urls whose canonical form
+    # is remembered, see crawler.url_canonicalizer.UrlCanonicalizer. metrics, if given, is the crawler.metrics.CrawlMetrics
+    # fetches are timed into and scheduler, if given, the
+    # crawler.host_limiter.HostScheduler which paces and retries them.
+    # timeout is in seconds, for connecting and for every read. pool is the
+    # make_pool() to fetch with, shared by all the crawlers of a crawl, by
+    # default the crawler keeps one connection alive of its own. Pages larger
+    # than max_page_bytes, decoded, are not fetched.
+    def __init__(self,
+                 base_domain,
+                 canonicalize_cache_size=100000,
+                 metrics=None,
+                 scheduler=None,
+                 timeout=5.0,
+                 pool=None,
+                 max_page_bytes=4 * 1024 * 1024):
+        self._pool = pool if pool is not None else make_pool(1)
+        self._max_page_bytes = max_page_bytes
+        self._metrics = metrics
+        self._scheduler = scheduler
+        self._timeout = timeout
+        if scheduler is not None:
+            # Retries are left to the scheduler, which spaces them out and
+            # counts them against the host.
+            self._retries = urllib3.Retry(connect=0,
+                                          read=0,
+                                          other=0,
+                                          status=0,
+                                          redirect=3,
+                                          respect_retry_after_header=False)
+        self._canonicalizer = UrlCanonicalizer(base_domain,
+                                               canonicalize_cache_size)
 
-    def fetch(self, url):
+    # etag and last_modified are the validators from an earlier fetch of url,
+    # if given the fetch is conditional and a 304 from the server is a
+    # successful fetch with no contents, see is_not_modified().
+    # Never raises for a failed request. A fetch which failed on a throttled,
+    # 5xx, timed out or dropped response, after the retries of the scheduler
+    # if any, is a transient failure, see is_transient_failure().
+    # The page is read in chunks, and given to on_chunk, if given, as they
+    # arrive. A page which is not html or is larger than max_page_bytes is
+    # dropped as soon as that is known, see get_rejection(), so at most
+    # max_page_bytes of a page are held whatever the server sends.
+    def fetch(self, url, etag=None, last_modified=None, on_chunk=None):
         assert url is not None and len(url) > 0, url
         self._reset(url)
         self._crawl_time = datetime.datetime.now().isoformat()
-        resp = self._pool.request('GET', self._url, timeout=5.0)
+        # Headers of a request replace those of the pool
+        headers = dict(self._pool.headers)
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+        resp = self._request(headers)
+        if resp is None:
+            return False
         status_code = resp.status
+        self._etag = resp.headers.get('ETag')
+        self._last_modified = resp.headers.get('Last-Modified')
+        if status_code == 304:
+            logging.debug("Not modified since last fetch: %s", self._url)
+            self._release(resp)
+            self._not_modified = True
+            self._contents = b''
+            return True
         if status_code != 200 and status_code != 302:
             logging.debug("Fetching %s returned %d", self._url, status_code)
+            self._release(resp)
+            return False
+        contents = self._read_page(resp, on_chunk)
+        if contents is None:
             return False
-        self._contents = resp.data
+        self._contents = contents
+        # Bytes read off the socket, before decoding
+        self._wire_bytes = resp.tell()
+        if self._metrics is not None:
+            self._metrics.fetch_bytes.inc("wire", self._wire_bytes)
+            self._metrics.fetch_bytes.inc("decoded", len(self._contents))
+        logging.debug("Fetched %s, %d bytes on the wire, %d decoded",
+                      self._url, self._wire_bytes, len(self._contents))
         if status_code == 302 and resp.geturl(
         ) is not None and resp.geturl() != self._url:
             self._is_redirect = True
@@ -37,41 +153,178 @@ class UrlCrawler:
             self._url = resp.geturl()
         return True
 
+    # Sends the request, through the limiter of the host and with the retries
+    # of the scheduler if there is one. Returns the response or None if the
+    # request failed.
+    def _request(self, headers):
+        limiter = None
+        if self._scheduler is not None:
+            limiter = self._scheduler.get_limiter(self._url)
+        attempt = 0
+        while True:
+            if limiter is not None:
+                limiter.acquire()
+            start = time.perf_counter()
+            resp, status = None, "error"
+            try:
+                resp = self._pool.request('GET',
+                                          self._url,
+                                          headers=headers,
+                                          timeout=self._timeout,
+                                          retries=self._retries,
+                                          preload_content=False)
+                status = resp.status
+            except urllib3.exceptions.HTTPError as e:
+                if not _is_host_failure(e):
+                    # Eg. a redirect loop, which says nothing about the load
+                    # on the host
+                    if limiter is not None:
+                        limiter.release(time.perf_counter() - start, None)
+                    logging.info("Fetching %s failed: %s", self._url, e)
+                    return None
+                logging.debug("Fetching %s failed: %s", self._url, e)
+            except Exception as e:
+                # Not worth retrying, eg. a url which does not parse
+                if limiter is not None:
+                    limiter.release(time.perf_counter() - start, None)
+                logging.error("Fetching %s failed: %s", self._url, e)
+                return None
+            latency = time.perf_counter() - start
+            if self._metrics is not None:
+                self._metrics.fetch_seconds.observe(latency, status)
+            transient = resp is None or status in RETRYABLE_STATUSES
+            if limiter is not None:
+                limiter.release(
+                    latency, "ok" if not transient else
+                    "throttled" if status == 429 else "error")
+            if not transient:
+                return resp
+            if resp is not None:
+                self._release(resp)
+            if self._scheduler is None or attempt >= self._scheduler.max_retries:
+                logging.info("Fetching %s failed with %s, giving up for now",
+                             self._url, status)
+                self._transient_failure = True
+                return None
+            attempt += 1
+            retry_after = None if resp is None else resp.headers.get(
+                'Retry-After')
+            time.sleep(self._scheduler.get_backoff(attempt, retry_after))
+
+    # Returns the decoded body of resp, or None if the page is not to be kept.
+    def _read_page(self, resp, on_chunk):
+        content_type = resp.headers.get('Content-Type', PAGE_TYPES[0])
+        length = resp.headers.get('Content-Length', "")
+        if not any(page_type in content_type for page_type in PAGE_TYPES):
+            return self._reject(resp, "not_html", content_type)
+        if length.isdigit() and int(length) > self._max_page_bytes:
+            return self._reject(resp, "too_large", length + " bytes")
+        chunks = []
+        size = 0
+        try:
+            for chunk in resp.stream(_CHUNK_BYTES, decode_content=True):
+                size += len(chunk)
+                if size > self._max_page_bytes:
+                    return self._reject(resp, "too_large",
+                                        "over %d bytes" % size)
+                chunks.append(chunk)
+                if on_chunk is not None:
+                    on_chunk(chunk)
+        except urllib3.exceptions.HTTPError as e:
+            # The connection dropped or timed out, or the page did not decode
+            logging.info("Reading %s failed: %s", self._url, e)
+            self._transient_failure = True
+            resp.close()
+            resp.release_conn()
+            return None
+        resp.release_conn()
+        return b''.join(chunks)
+
+    def _reject(self, resp, reason, detail):
+        logging.info("Dropping %s, %s: %s", self._url, reason, detail)
+        self._rejection = reason
+        # The rest of the body is not read, so the connection can not be
+        # reused.
+        resp.close()
+        resp.release_conn()
+        return None
+
+    # Gives the connection of a response whose body is not needed back to the
+    # pool.
+    def _release(self, resp):
+        if resp.status in _NO_BODY_STATUSES or resp.status < 200:
+            # Nothing to read, whatever the headers say
+            resp.release_conn()
+            return
+        length = resp.headers.get('Content-Length', "")
+        if length.isdigit() and int(length) <= _MAX_DRAIN_BYTES:
+            resp.drain_conn()
+        else:
+            resp.close()
+        resp.release_conn()
+
     def get_contents(self):
         return self._contents
 
+    # Size of the page of the last fetch as sent by the server, ie. compressed
+    # if it was, get_contents() has the decoded page.
+    def get_wire_bytes(self):
+        return self._wire_bytes
+
     def get_crawl_time(self):
         return self._crawl_time
 
     def canonicalize_url(self, url):
-        assert url is not None and len(url) > 0
-        parsed = urlparse(url, allow_fragments=False)
-        new_parsed = ParseResult(self._base.scheme,
-                                 self._base.netloc,
-                                 parsed.path,
-                                 parsed.params,
-                                 parsed.query,
-                                 fragment='')  # Empty fragment
-        new_url = self.sanitize_url(unquote(new_parsed.geturl()))
-        logging.debug("New formed url: %s", new_url)
-        return new_url
+        return self._canonicalizer.canonicalize_url(url)
+
+    def canonicalize_urls(self, urls):
+        return self._canonicalizer.canonicalize_urls(urls)
+
+    def get_canonicalize_stats(self):
+        return self._canonicalizer.get_canonicalize_stats()
 
     def is_from_base_domain(self, url):
-        parsed = urlparse(url, allow_fragments=False)
-        return len(parsed.netloc) == 0 or parsed.netloc == self._base.netloc
+        return self._canonicalizer.is_from_base_domain(url)
 
     def is_redirect(self):
         return self._is_redirect
 
+    def is_not_modified(self):
+        return self._not_modified
+
+    # Why the page of the last fetch was dropped unread, "not_html" or
+    # "too_large", or None.
+    def get_rejection(self):
+        return self._rejection
+
+    # True if the last fetch failed in a way which may not last, eg. the host
+    # was throttling, so the url is worth fetching again later.
+    def is_transient_failure(self):
+        return self._transient_failure
+
+    # Validators of the last fetch, to make the next fetch of the url
+    # conditional.
+    def get_etag(self):
+        return self._etag
+
+    def get_last_modified(self):
+        return self._last_modified
+
     def get_fetched_url(self):
         return self._url
 
     @staticmethod
     def sanitize_url(url):
-        return url.strip('/')
+        return sanitize_url(url)
 
     def _reset(self, url):
         self._crawl_time = False
         self._contents = False
         self._url = self.canonicalize_url(url)
         self._is_redirect = False
+        self._not_modified = False
+        self._transient_failure = False
+        self._wire_bytes = 0
+        self._rejection = None
+        self._etag = None
+        self._last_modified = None
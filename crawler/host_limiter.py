@@ -0,0 +1,195 @@
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+# Responses which mean the host is overloaded or briefly unavailable. The
+# request is retried and the host gets less load.
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+# Request rate and concurrency limits of one host which adapt to how it
+# copes, additive increase / multiplicative decrease as in TCP. A response is
+# fast if it took at most latency_tolerance times the fastest recent one.
+#   - until the first back off, every fast response raises the concurrency
+#     limit by 1 and the rate by as much in proportion, which doubles them
+#     about every round trip, to find the capacity of the host quickly
+#   - after that, every fast response raises the concurrency limit by
+#     1 / limit and the rate by 1 / rate, ie. by about 1 request and
+#     1 request/sec per second
+#   - a throttled (429) or failed (5xx, timeout) response halves both and a
+#     slow one takes a tenth off them, at most once per round trip so that the
+#     responses to one burst count once
+# so the crawl settles just under the load at which the host starts slowing
+# down or pushing back.
+# Requests wait in acquire() for a slot under the concurrency limit and a
+# token of the token bucket, which refills at the current rate and holds up to
+# one second worth of them.
+class HostLimiter:
+    host = None
+    _min_rate = 0
+    _max_rate = 0
+    _max_concurrency = 0
+    _latency_tolerance = 0
+    _rate = 0
+    _limit = 0
+    _tokens = 0
+    _last_refill = 0
+    _in_flight = 0
+    # Fastest recent response, drifts up slowly so that it follows the host
+    _min_latency = None
+    _smoothed_latency = 0
+    _last_decrease = 0
+    _slow_start = True
+    _num_throttled = 0
+    _num_errors = 0
+    _num_slow = 0
+    _cond = None
+
+    def __init__(self,
+                 host,
+                 initial_rate=5.0,
+                 max_rate=50.0,
+                 max_concurrency=16,
+                 min_rate=0.5,
+                 latency_tolerance=2.0):
+        self.host = host
+        self._min_rate = min_rate
+        self._max_rate = max_rate
+        self._max_concurrency = max_concurrency
+        self._latency_tolerance = latency_tolerance
+        self._rate = min(initial_rate, max_rate)
+        self._limit = 1.0
+        self._tokens = 1.0
+        self._last_refill = time.monotonic()
+        self._cond = threading.Condition()
+
+    # Waits for a slot and a token.
+    def acquire(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    max(1.0, self._rate),
+                    self._tokens + (now - self._last_refill) * self._rate)
+                self._last_refill = now
+                if self._in_flight < int(self._limit) and self._tokens >= 1:
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    return
+                # Woken by a release, or when the next token is due
+                self._cond.wait((1 - self._tokens) /
+                                self._rate if self._tokens < 1 else None)
+
+    # Returns the slot of a request which took latency seconds, with outcome
+    # one of "ok", "throttled" and "error", or None if the request says nothing
+    # about the host, eg. its url did not parse.
+    def release(self, latency, outcome):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify()
+            if outcome is None:
+                return
+            now = time.monotonic()
+            if outcome != "ok":
+                if outcome == "throttled":
+                    self._num_throttled += 1
+                else:
+                    self._num_errors += 1
+                self._decrease(now, 0.5)
+                return
+            if self._min_latency is None or latency < self._min_latency:
+                self._min_latency = latency
+            else:
+                self._min_latency *= 1.001
+            self._smoothed_latency = 0.8 * self._smoothed_latency + 0.2 * latency
+            # A few msecs of slack so that hosts answering in microseconds,
+            # eg. a local one, are not taken to be slow on noise.
+            if latency > self._latency_tolerance * self._min_latency + 0.005:
+                self._num_slow += 1
+                self._decrease(now, 0.9)
+                return
+            if self._slow_start:
+                self._rate = min(self._max_rate,
+                                 self._rate * (self._limit + 1) / self._limit)
+                self._limit = min(self._max_concurrency, self._limit + 1)
+                return
+            self._limit = min(self._max_concurrency,
+                              self._limit + 1 / self._limit)
+            self._rate = min(self._max_rate, self._rate + 1 / self._rate)
+
+    def get_stats(self):
+        with self._cond:
+            return {
+                'rate': round(self._rate, 2),
+                'concurrency': round(self._limit, 2),
+                'min_latency_ms': round((self._min_latency or 0) * 1000, 2),
+                'throttled': self._num_throttled,
+                'errors': self._num_errors,
+                'slow': self._num_slow
+            }
+
+    def _decrease(self, now, factor):
+        if now - self._last_decrease < max(self._smoothed_latency, 0.01):
+            return
+        self._last_decrease = now
+        self._slow_start = False
+        self._limit = max(1.0, self._limit * factor)
+        self._rate = max(self._min_rate, self._rate * factor)
+        logging.debug("Backing off %s to %.2f requests/sec, %.2f in flight",
+                      self.host, self._rate, self._limit)
+
+
+# The HostLimiter of every host a crawl fetches from, shared by all the
+# UrlCrawlers of a process, and the retry policy of their fetches: up to
+# max_retries more attempts of a request which got a RETRYABLE_STATUSES
+# response or failed, after an exponential backoff from backoff_seconds with
+# jitter, or after the Retry-After of the response when it has one.
+class HostScheduler:
+    max_retries = 0
+    _backoff_seconds = 0
+    _max_backoff_seconds = 0
+    _limiter_args = None
+    _limiters = None
+    _lock = None
+
+    # limiter_args are passed on to every HostLimiter.
+    def __init__(self,
+                 max_retries=3,
+                 backoff_seconds=0.5,
+                 max_backoff_seconds=30.0,
+                 **limiter_args):
+        self.max_retries = max_retries
+        self._backoff_seconds = backoff_seconds
+        self._max_backoff_seconds = max_backoff_seconds
+        self._limiter_args = limiter_args
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def get_limiter(self, url):
+        host = urlparse(url).netloc
+        limiter = self._limiters.get(host)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.setdefault(
+                    host, HostLimiter(host, **self._limiter_args))
+        return limiter
+
+    # Seconds to wait before attempt number attempt (from 1) of a request,
+    # retry_after is the Retry-After header of the last response, if any.
+    def get_backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            try:
+                return min(self._max_backoff_seconds,
+                           max(0.0, float(retry_after)))
+            except ValueError:
+                # An http date, which servers rarely send for throttling
+                pass
+        return min(self._max_backoff_seconds, self._backoff_seconds *
+                   2**(attempt - 1)) * random.uniform(0.5, 1.5)
+
+    def get_stats(self):
+        with self._lock:
+            limiters = list(self._limiters.values())
+        return {limiter.host: limiter.get_stats() for limiter in limiters}
@@ -0,0 +1,127 @@
+import logging
+import math
+import re
+import threading
+from urllib.parse import urlparse
+
+# Kinds of the page a link is found on, as told by url_parser.
+POEM_PAGE = "poem"
+INDEX_PAGE = "index"
+
+_WORD_SEPARATORS = re.compile(r"[_\s:/(),.-]+")
+_DIGITS = re.compile(r"\d+")
+
+
+# Features of the url pattern of url, eg. for kavitakosh.org/kk/Category:Kavi
+# the namespace "Category" and the first word "Kavi". Urls of the same kind of
+# page share most of them, whatever their title. Digits are all alike.
+def get_url_features(url):
+    parsed = urlparse(url)
+    segments = [segment for segment in parsed.path.split('/') if segment]
+    # The first segment is the site prefix, eg. kk, on most wikis
+    title = "/".join(segments[1:] if len(segments) > 1 else segments)
+    namespace, _, name = title.partition(':') if ':' in title.split(
+        '/')[0] else ("", "", title)
+    words = [word for word in _WORD_SEPARATORS.split(name) if word]
+    return [
+        "ns:" + namespace,
+        "word:" + _DIGITS.sub("#", words[0] if words else ""),
+        # Poems of kavitakosh are titled "poem / poet"
+        "parts:%d" % min(3,
+                         name.count('/') + 1),
+        "query:%d" % (len(parsed.query) > 0)
+    ]
+
+
+# Scores urls by the chance that fetching them stores a poem, from what
+# fetching urls with the same features (get_url_features() and the kind of
+# page the url was found on) has yielded so far in the crawl, and in earlier
+# crawls of the db, see load_history(). The harvest rate of each feature is
+# smoothed towards the overall rate by prior_weight fetches, and the features
+# are combined as independent evidence, ie. their log odds against the overall
+# rate add up.
+# The kind of page each url was found on is kept, for up to max_parents urls,
+# until the url is fetched. The scorer is shared by all the drivers of a
+# process.
+class LinkScorer:
+    _prior_weight = 0
+    _max_parents = 0
+    # Feature to [fetches, poems]
+    _stats = None
+    _fetches = 0
+    _poems = 0
+    # Url to the kind of page it was found on, oldest first
+    _parents = None
+    _lock = None
+
+    def __init__(self, prior_weight=5.0, max_parents=1000000):
+        self._prior_weight = prior_weight
+        self._max_parents = max_parents
+        self._stats = {}
+        self._parents = {}
+        self._lock = threading.Lock()
+
+    # Learns from the crawled and forbidden urls of db, the urls of
+    # fetched_content being those which yielded a poem. The kind of page they
+    # were found on is not kept in the db.
+    def load_history(self, db):
+        poems = set(db.iterate_table_urls("fetched_content"))
+        for table in ("crawled_urls", "forbidden_urls"):
+            for url in db.iterate_table_urls(table):
+                self._add(get_url_features(url), url in poems)
+        logging.info("Link scores from %d earlier fetches, %d of them poems",
+                     self._fetches, self._poems)
+
+    # Returns the scores of urls, found on a page of kind parent_kind.
+    def score_links(self, urls, parent_kind):
+        with self._lock:
+            for url in urls:
+                self._parents[url] = parent_kind
+            while len(self._parents) > self._max_parents:
+                del self._parents[next(iter(self._parents))]
+        return [self.score(url, parent_kind) for url in urls]
+
+    def score(self, url, parent_kind=None):
+        features = get_url_features(url)
+        if parent_kind is not None:
+            features.append("parent:" + parent_kind)
+        with self._lock:
+            overall = (self._poems + 1) / (self._fetches + 2)
+            prior = _log_odds(overall)
+            log_odds = prior
+            for feature in features:
+                fetches, poems = self._stats.get(feature, (0, 0))
+                log_odds += _log_odds((poems + self._prior_weight * overall) /
+                                      (fetches + self._prior_weight)) - prior
+        return 1 / (1 + math.exp(-log_odds))
+
+    # Learns whether fetching url stored a poem.
+    def observe(self, url, produced_poem):
+        features = get_url_features(url)
+        with self._lock:
+            parent_kind = self._parents.pop(url, None)
+        if parent_kind is not None:
+            features.append("parent:" + parent_kind)
+        self._add(features, produced_poem)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'fetches': self._fetches,
+                'poems': self._poems,
+                'features': len(self._stats),
+                'parents': len(self._parents)
+            }
+
+    def _add(self, features, produced_poem):
+        with self._lock:
+            self._fetches += 1
+            self._poems += produced_poem
+            for feature in features:
+                stats = self._stats.setdefault(feature, [0, 0])
+                stats[0] += 1
+                stats[1] += produced_poem
+
+
+def _log_odds(p):
+    return math.log(p / (1 - p))
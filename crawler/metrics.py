@@ -0,0 +1,301 @@
+import bisect
+import http.server
+import logging
+import os
+import threading
+import time
+
+# Upper bounds in seconds of the buckets of latency histograms.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# A count per value of an optional label, eg. pages by outcome.
+class Counter:
+    name = None
+    _help = None
+    _label = None
+    _values = None
+    _lock = None
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self._help = help
+        self._label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value=None, amount=1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value,
+                                                         0) + amount
+
+    def get(self, label_value=None):
+        return self._values.get(label_value, 0)
+
+    def get_total(self):
+        with self._lock:
+            return sum(self._values.values())
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self._help),
+            "# TYPE %s counter" % self.name
+        ]
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda item: str(item))
+        for label_value, value in values:
+            lines.append("%s%s %s" %
+                         (self.name, _labels(self._label, label_value), value))
+        return lines
+
+
+# Counts of observations by bucket per value of an optional label, rendered
+# with cumulative buckets as Prometheus expects.
+class Histogram:
+    name = None
+    _help = None
+    _label = None
+    _buckets = None
+    # Label value to [count per bucket and one past the last, sum]
+    _values = None
+    _lock = None
+
+    def __init__(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self._help = help
+        self._label = label
+        self._buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            counts = self._values.get(label_value)
+            if counts is None:
+                counts = self._values[label_value] = [[0] *
+                                                      (len(self._buckets) + 1),
+                                                      0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    # Returns the number of observations and their sum.
+    def get(self, label_value=None):
+        with self._lock:
+            counts = self._values.get(label_value)
+            if counts is None:
+                return 0, 0.0
+            return sum(counts[0]), counts[1]
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self._help),
+            "# TYPE %s histogram" % self.name
+        ]
+        with self._lock:
+            values = sorted(((label_value, list(counts[0]), counts[1])
+                             for label_value, counts in self._values.items()),
+                            key=lambda item: str(item[0]))
+        for label_value, counts, total in values:
+            labels = _labels(self._label, label_value)
+            cumulative = 0
+            for bound, count in zip(self._buckets + ('+Inf', ), counts):
+                cumulative += count
+                lines.append(
+                    "%s_bucket%s %d" %
+                    (self.name, _labels(self._label, label_value,
+                                        ('le', bound)), cumulative))
+            lines.append("%s_sum%s %s" % (self.name, labels, total))
+            lines.append("%s_count%s %d" % (self.name, labels, cumulative))
+        return lines
+
+
+def _labels(label, label_value, *extra):
+    pairs = ([] if label is None else [(label, label_value)]) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' %
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in pairs)
+
+
+# The metrics of a crawl, shared by all its threads. Parsing which runs in
+# pool processes is timed there and the time sent back with the parsed page
+# (see crawler/page_processor.py), so it is recorded here too.
+# Exposed in the Prometheus text format by an http server (serve()) and/or
+# written to a file every few seconds (write_periodically()).
+# Recording takes a lock and a bisect, about a microsecond, and nothing is
+# recorded when the crawl runs without metrics.
+class CrawlMetrics:
+    fetch_seconds = None
+    parse_seconds = None
+    db_seconds = None
+    frontier_seconds = None
+    link_discovery_seconds = None
+    pages = None
+    new_links = None
+    fetch_bytes = None
+    _gauges = None
+    _start_time = 0
+    _server = None
+    _stop = None
+    _file_writer = None
+
+    def __init__(self):
+        self.fetch_seconds = Histogram(
+            "crawler_fetch_seconds",
+            "Time to the response headers of page fetches by status", "status")
+        self.parse_seconds = Histogram(
+            "crawler_parse_seconds", "Cpu time of the thread parsing a page")
+        self.db_seconds = Histogram("crawler_db_seconds",
+                                    "Latency of UrlDb calls by method", "op")
+        self.frontier_seconds = Histogram(
+            "crawler_frontier_seconds",
+            "Latency of UrlFrontier calls by method", "op")
+        self.link_discovery_seconds = Histogram(
+            "crawler_link_discovery_seconds",
+            "Time to find and add the new links of a page")
+        self.pages = Counter("crawler_pages_total", "Fetched urls by outcome",
+                             "outcome")
+        self.new_links = Counter("crawler_new_links_total",
+                                 "Urls newly added to seen_urls from links")
+        self.fetch_bytes = Counter(
+            "crawler_fetch_bytes_total",
+            "Bytes of fetched pages, on the wire and decoded", "kind")
+        self._gauges = []
+        self._start_time = time.monotonic()
+        self._stop = threading.Event()
+        self.add_gauge("crawler_pages_per_second",
+                       "Fetched urls per second since the crawl started",
+                       self._get_pages_per_second)
+        self.add_gauge("crawler_poems_per_1000_fetches",
+                       "Harvest rate, poems stored per 1000 fetched urls",
+                       self._get_harvest_rate)
+
+    # func is called, on the thread rendering the metrics, for the value of
+    # the gauge.
+    def add_gauge(self, name, help, func):
+        self._gauges.append((name, help, func))
+
+    # Returns obj with each of its methods timed into histogram by name.
+    def instrument(self, obj, histogram):
+        return _Timed(obj, histogram)
+
+    def render(self):
+        lines = []
+        for metric in (self.fetch_seconds, self.parse_seconds, self.db_seconds,
+                       self.frontier_seconds, self.link_discovery_seconds,
+                       self.pages, self.new_links, self.fetch_bytes):
+            lines += metric.render()
+        for name, help, func in self._gauges:
+            try:
+                value = func()
+            except Exception as e:
+                logging.error("Reading gauge %s failed: %s", name, e)
+                continue
+            lines += [
+                "# HELP %s %s" % (name, help),
+                "# TYPE %s gauge" % name,
+                "%s %s" % (name, value)
+            ]
+        return "\n".join(lines) + "\n"
+
+    # Serves the metrics at http://<host>:<port>/metrics from a thread of its
+    # own.
+    def serve(self, port, host=""):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("Metrics request: " + format, *args)
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever,
+                         name="MetricsServer",
+                         daemon=True).start()
+        logging.info("Serving metrics on port %d",
+                     self._server.server_address[1])
+
+    # Writes the metrics to path every interval seconds, replacing the file
+    # whole so that readers never see a partial one.
+    def write_periodically(self, path, interval):
+
+        def run():
+            while not self._stop.wait(interval):
+                self.write(path)
+
+        self._file_writer = (path,
+                             threading.Thread(target=run,
+                                              name="MetricsWriter",
+                                              daemon=True))
+        self._file_writer[1].start()
+
+    def write(self, path):
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(self.render())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.error("Writing metrics to %s failed: %s", path, e)
+
+    # Stops serving and writes the metrics file a last time.
+    def close(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._file_writer is not None:
+            self._file_writer[1].join()
+            self.write(self._file_writer[0])
+
+    def _get_harvest_rate(self):
+        return round(
+            self.pages.get("stored") * 1000 / max(self.pages.get_total(), 1),
+            1)
+
+    def _get_pages_per_second(self):
+        return round(
+            self.pages.get_total() /
+            max(time.monotonic() - self._start_time, 1e-6), 3)
+
+
+# Wraps an object, timing the calls of its methods. The wrapper of a method is
+# made on its first call and kept, so later calls only pay for the timing.
+class _Timed:
+
+    def __init__(self, target, histogram):
+        self._target = target
+        self._histogram = histogram
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+        histogram = self._histogram
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, name)
+
+        setattr(self, name, timed)
+        return timed
@@ -0,0 +1,102 @@
+import collections
+import logging
+import time
+
+from crawler.url_canonicalizer import UrlCanonicalizer
+from crawler.url_filter import UrlFilter
+from url_parser.url_parser import UrlParser
+
+# What the crawler keeps of a page: whether it has the missing article marker,
+# its url_parser.Poem or None, the canonical urls of its links which pass
+# the url filter, without repeats, in the order they are on the page, and the
+# cpu seconds processing it took.
+ProcessedPage = collections.namedtuple(
+    'ProcessedPage', ['no_article_text', 'poem', 'links', 'parse_seconds'])
+
+
+# Parses a fetched page into a ProcessedPage. Uses no db, so it can run in a
+# pool process with only the raw page sent to it and the ProcessedPage sent
+# back.
+class PageProcessor:
+    _parser = None
+    _canonicalizer = None
+    _url_filter = None
+    _only_base_domain_urls = False
+
+    def __init__(self,
+                 base_domain,
+                 parser_backend,
+                 url_filter_config,
+                 only_base_domain_urls=True,
+                 canonicalize_cache_size=100000):
+        self._parser = UrlParser(backend=parser_backend)
+        self._canonicalizer = UrlCanonicalizer(base_domain,
+                                               canonicalize_cache_size)
+        self._url_filter = UrlFilter.from_file(url_filter_config)
+        self._only_base_domain_urls = only_base_domain_urls
+
+    def process(self, page):
+        start = time.thread_time()
+        return self._make_page(self._parser.extract(page), start)
+
+    # Returns a PageFeed to give the page to in chunks as it is fetched.
+    def start_page(self):
+        return PageFeed(self, self._parser.start_extract())
+
+    # parse_seconds are counted from start, a time.thread_time().
+    def _make_page(self, content, start):
+        if content.no_article_text:
+            return ProcessedPage(True, None, [], time.thread_time() - start)
+        links = dict.fromkeys(url for url in self._url_filter.filter(
+            self._canonicalizer.canonicalize_urls(content.hrefs))
+                              if self._only_base_domain_urls is False
+                              or self._canonicalizer.is_from_base_domain(url))
+        return ProcessedPage(False, self._parser.get_poem(content),
+                             list(links),
+                             time.thread_time() - start)
+
+    def get_canonicalize_stats(self):
+        return self._canonicalizer.get_canonicalize_stats()
+
+
+# Parses a page chunk by chunk, whose close() returns the ProcessedPage of
+# PageProcessor.process() for the whole page. parse_seconds are the cpu time
+# of all the feed() and close() calls.
+class PageFeed:
+    _processor = None
+    _extractor = None
+    _parse_seconds = 0
+
+    def __init__(self, processor, extractor):
+        self._processor = processor
+        self._extractor = extractor
+
+    def feed(self, chunk):
+        start = time.thread_time()
+        self._extractor.feed(chunk)
+        self._parse_seconds += time.thread_time() - start
+
+    def close(self):
+        start = time.thread_time() - self._parse_seconds
+        return self._processor._make_page(self._extractor.close(), start)
+
+
+# The PageProcessor of a pool process, see init_worker().
+_worker = None
+
+
+# Initializer of the processes of a pool running process_in_worker(), takes
+# the arguments of PageProcessor.
+def init_worker(*args):
+    global _worker
+    _worker = PageProcessor(*args)
+
+
+# Returns None if the page could not be parsed, as the exception may not be
+# picklable, eg. that of lxml.
+def process_in_worker(page):
+    try:
+        return _worker.process(page)
+    except Exception as e:
+        logging.error("Parsing a page failed: %s", e)
+        return None
@@ -0,0 +1,26 @@
+import datetime
+
+_SECONDS_PER_DAY = 24 * 60 * 60
+
+
+# Picks when a crawled url should be fetched again. The change rate of a page
+# is estimated as (num_changes + 1) / (age + initial interval), so a new page
+# is revisited after the initial interval, a page which keeps changing is
+# revisited more often and one which never changes less and less often as it
+# ages. The interval is bounded by the min and max.
+class RecrawlPolicy:
+    _min_seconds = 0
+    _initial_seconds = 0
+    _max_seconds = 0
+
+    def __init__(self, min_days=1, initial_days=30, max_days=365):
+        assert 0 < min_days <= initial_days <= max_days
+        self._min_seconds = min_days * _SECONDS_PER_DAY
+        self._initial_seconds = initial_days * _SECONDS_PER_DAY
+        self._max_seconds = max_days * _SECONDS_PER_DAY
+
+    def next_crawl_time(self, first_crawl_time, num_changes, now):
+        age = max(0.0, (now - first_crawl_time).total_seconds())
+        interval = (age + self._initial_seconds) / (num_changes + 1)
+        interval = min(self._max_seconds, max(self._min_seconds, interval))
+        return now + datetime.timedelta(seconds=interval)
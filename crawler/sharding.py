@@ -0,0 +1,217 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+
+# The shard, of num_shards, which owns url, by a hash of it which is the same
+# in every process and on every machine. url has to be canonical.
+def shard_of(url, num_shards):
+    digest = hashlib.md5(url.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+# Forwards the links a shard of a sharded crawl finds to the shards which own
+# them, through a spool directory all the shards share, eg. on local disk or a
+# network file system:
+#   spool_dir/inbox_<shard>/<from shard>_<run>_<seq>.urls  a batch of urls for
+#       shard, a json [priority, url] line each, so that any url fits on a
+#       line, written under another name and renamed so that it shows up
+#       whole. run is new in every process, so a restarted shard does not
+#       overwrite the batches it sent before. A batch which does not parse is
+#       renamed to .bad and left for a look, not received again.
+#   spool_dir/state_<shard>  "active", "idle <n>" or "done", see is_finished()
+# Urls for a shard are sent once batch_size of them are buffered, or with
+# flush(). The last max_forwarded urls sent are not sent again.
+# A received batch is removed once handled, so a crash at worst has its urls
+# handled twice. The router is shared by all the drivers of a process.
+class ShardRouter:
+    shard_index = 0
+    num_shards = 0
+    _spool_dir = None
+    _batch_size = 0
+    _max_forwarded = 0
+    # Shard to the [(url, priority)] waiting to be sent and when the first of
+    # them was buffered
+    _outbox = None
+    _outbox_start = None
+    # Urls sent, oldest first
+    _forwarded = None
+    _run = None
+    _seq = 0
+    _state = None
+    _num_idle = 0
+    _num_sent = 0
+    _num_received = 0
+    _lock = None
+
+    def __init__(self,
+                 spool_dir,
+                 shard_index,
+                 num_shards,
+                 batch_size=500,
+                 max_forwarded=1000000):
+        assert 0 <= shard_index < num_shards, (shard_index, num_shards)
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        self._spool_dir = spool_dir
+        self._batch_size = batch_size
+        self._max_forwarded = max_forwarded
+        self._outbox = {}
+        self._outbox_start = {}
+        self._forwarded = {}
+        self._run = uuid.uuid4().hex
+        self._lock = threading.RLock()
+        os.makedirs(self._get_inbox(shard_index), exist_ok=True)
+        self._set_state("active")
+
+    def owns(self, url):
+        return shard_of(url, self.num_shards) == self.shard_index
+
+    # Buffers urls, owned by other shards, to be sent to their owners along
+    # with their priorities, if given.
+    def forward(self, urls, priorities=None):
+        if priorities is None:
+            priorities = [0] * len(urls)
+        with self._lock:
+            for url, priority in zip(urls, priorities):
+                if url in self._forwarded:
+                    continue
+                self._forwarded[url] = True
+                shard = shard_of(url, self.num_shards)
+                self._outbox_start.setdefault(shard, time.monotonic())
+                self._outbox.setdefault(shard, []).append((url, priority))
+                if len(self._outbox[shard]) >= self._batch_size:
+                    self._send(shard)
+            while len(self._forwarded) > self._max_forwarded:
+                del self._forwarded[next(iter(self._forwarded))]
+
+    # Sends the urls buffered for more than max_age_seconds.
+    def flush(self, max_age_seconds=0):
+        now = time.monotonic()
+        with self._lock:
+            for shard in list(self._outbox):
+                if now - self._outbox_start[shard] >= max_age_seconds:
+                    self._send(shard)
+
+    # Calls handler(urls, priorities) for each batch sent to this shard and
+    # removes the batch once it returns. Returns the number of urls received.
+    def receive(self, handler):
+        num_urls = 0
+        with self._lock:
+            inbox = self._get_inbox(self.shard_index)
+            names = sorted(name for name in os.listdir(inbox)
+                           if name.endswith(".urls"))
+            if len(names) == 0:
+                return 0
+            # Before the batches are gone, see is_finished()
+            self._set_state("active")
+            for name in names:
+                path = os.path.join(inbox, name)
+                urls, priorities = [], []
+                try:
+                    with open(path, encoding="utf-8") as f:
+                        for line in f:
+                            priority, url = json.loads(line)
+                            urls.append(url)
+                            priorities.append(float(priority))
+                except (ValueError, TypeError) as e:
+                    logging.error(
+                        "Setting aside batch %s which does not "
+                        "parse: %s", path, e)
+                    os.replace(path, path[:-len(".urls")] + ".bad")
+                    continue
+                handler(urls, priorities)
+                os.remove(path)
+                num_urls += len(urls)
+            self._num_received += num_urls
+        logging.debug("Received %d urls from other shards", num_urls)
+        return num_urls
+
+    # True if the crawl of every shard is over, to be asked once this shard
+    # has nothing left to crawl: no shard can find more urls once every one
+    # of them is idle or done and no batches are waiting. Every shard marks
+    # itself active before it takes a batch in, and with a new number each
+    # time it goes idle, so a shard which took a batch in while the others
+    # were checked shows up as changed when they are checked again.
+    def is_finished(self):
+        with self._lock:
+            self.flush()
+            if self._has_batches(self.shard_index):
+                return False
+            if self._state is None or not self._state.startswith("idle"):
+                self._num_idle += 1
+                self._set_state("idle %d" % self._num_idle)
+            states = self._read_states()
+            if any(state is None or state == "active" for state in states):
+                return False
+            for shard, state in enumerate(states):
+                if state != "done" and self._has_batches(shard):
+                    return False
+            return self._read_states() == states
+
+    # Sends what is buffered and tells the other shards this one is no longer
+    # crawling, eg. its budget is used up. Batches sent to it after that stay
+    # in its inbox for a later crawl.
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._set_state("done")
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'shard': self.shard_index,
+                'shards': self.num_shards,
+                'sent': self._num_sent,
+                'received': self._num_received,
+                'buffered': sum(len(urls) for urls in self._outbox.values())
+            }
+
+    def _send(self, shard):
+        urls = self._outbox.pop(shard)
+        del self._outbox_start[shard]
+        inbox = self._get_inbox(shard)
+        os.makedirs(inbox, exist_ok=True)
+        self._seq += 1
+        name = "%d_%s_%d.urls" % (self.shard_index, self._run, self._seq)
+        tmp_path = os.path.join(inbox, name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for url, priority in urls:
+                f.write(json.dumps([float(priority), url]) + "\n")
+        os.replace(tmp_path, os.path.join(inbox, name))
+        self._num_sent += len(urls)
+        logging.debug("Sent %d urls to shard %d", len(urls), shard)
+
+    def _get_inbox(self, shard):
+        return os.path.join(self._spool_dir, "inbox_%d" % shard)
+
+    def _has_batches(self, shard):
+        try:
+            return any(
+                name.endswith(".urls")
+                for name in os.listdir(self._get_inbox(shard)))
+        except FileNotFoundError:
+            return False
+
+    def _set_state(self, state):
+        path = os.path.join(self._spool_dir, "state_%d" % self.shard_index)
+        with open(path + ".tmp", "w") as f:
+            f.write(state)
+        os.replace(path + ".tmp", path)
+        self._state = state
+
+    # States of all the shards, None for the ones not started yet
+    def _read_states(self):
+        states = []
+        for shard in range(self.num_shards):
+            try:
+                with open(os.path.join(self._spool_dir,
+                                       "state_%d" % shard)) as f:
+                    states.append(f.read())
+            except FileNotFoundError:
+                states.append(None)
+        return states
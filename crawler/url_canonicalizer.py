@@ -0,0 +1,70 @@
+import functools
+import logging
+from urllib.parse import urlparse, ParseResult, unquote
+
+
+# The form a link, url, on a page of the site whose base domain is base, a
+# urlparse() of it, is crawled and stored under: on the scheme and host of
+# base, without a fragment, unquoted and without leading or trailing slashes.
+def canonicalize_url(base, url):
+    parsed = urlparse(url, allow_fragments=False)
+    new_parsed = ParseResult(base.scheme,
+                             base.netloc,
+                             parsed.path,
+                             parsed.params,
+                             parsed.query,
+                             fragment='')  # Empty fragment
+    new_url = sanitize_url(unquote(new_parsed.geturl()))
+    logging.debug("New formed url: %s", new_url)
+    return new_url
+
+
+def sanitize_url(url):
+    return url.strip('/')
+
+
+# True if url is relative or on the host of base, a urlparse().
+def is_from_base_domain(base, url):
+    parsed = urlparse(url, allow_fragments=False)
+    return len(parsed.netloc) == 0 or parsed.netloc == base.netloc
+
+
+# canonicalize_url() for the links of the site at base_domain, remembering
+# the canonical form of up to cache_size urls. Pages of a site repeat the same
+# navigation links, so most lookups hit. Holds no connections, so that parse
+# processes can canonicalize without a UrlCrawler.
+class UrlCanonicalizer:
+    _base = None
+    _canonicalize_cached = None
+
+    def __init__(self, base_domain, cache_size=100000):
+        self._base = urlparse(base_domain, allow_fragments=False)
+        logging.info("Netloc of base: %s", self._base.netloc)
+        assert len(self._base.netloc) > 0
+        self._canonicalize_cached = functools.lru_cache(maxsize=cache_size)(
+            functools.partial(canonicalize_url, self._base))
+
+    def canonicalize_url(self, url):
+        assert url is not None and len(url) > 0
+        return self._canonicalize_cached(url)
+
+    # Canonicalizes all the hrefs of a page. Empty hrefs point to the page
+    # itself and are dropped.
+    def canonicalize_urls(self, urls):
+        canonicalize = self._canonicalize_cached
+        return [
+            canonicalize(url) for url in urls
+            if url is not None and len(url) > 0
+        ]
+
+    def is_from_base_domain(self, url):
+        return is_from_base_domain(self._base, url)
+
+    def get_canonicalize_stats(self):
+        info = self._canonicalize_cached.cache_info()
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'size': info.currsize,
+            'max_size': info.maxsize
+        }
@@ -0,0 +1,114 @@
+import json
+import logging
+import os
+import re
+
+# Rules for kavitakosh.org, used when no config is given.
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "kavitakosh_filter.json")
+
+
+# Decides which urls are worth crawling from include and exclude rules read
+# from a json config of the form
+#   {
+#     "ignore_case": true,
+#     "exclude": {"substrings": [...], "prefixes": [...], "regexes": [...]},
+#     "include": {...},
+#     "domains": {
+#       "kavitakosh.org": {
+#         "exclude": {"substrings": [...], "path_prefixes": [...],
+#                     "regexes": [...]},
+#         "include": {...}
+#       }
+#     }
+#   }
+# A url is crawled if it matches no exclude rule and, when there are include
+# rules, at least one of them.
+# Each side compiles to one prefix tuple for a single startswith, a tuple of
+# substrings and one regex combining all the regex and domain substring rules.
+# A combined regex of all the rules was measured to be slower than the C level
+# substring scans on CPython, so literals are kept out of the regex.
+class UrlFilter:
+    _ignore_case = False
+    _exclude = None
+    _include = None
+
+    def __init__(self, config):
+        self._ignore_case = config.get('ignore_case', False)
+        domains = config.get('domains', {})
+        self._exclude = _Rules(config.get('exclude', {}), {
+            d: rules.get('exclude', {})
+            for d, rules in domains.items()
+        }, self._ignore_case)
+        self._include = _Rules(config.get('include', {}), {
+            d: rules.get('include', {})
+            for d, rules in domains.items()
+        }, self._ignore_case)
+        if self._include.is_empty():
+            self._include = None
+        logging.info("Compiled url filter rules")
+
+    @classmethod
+    def from_file(cls, path=DEFAULT_CONFIG):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def should_crawl(self, url):
+        key = url.lower() if self._ignore_case else url
+        if self._exclude.matches(key):
+            return False
+        return self._include is None or self._include.matches(key)
+
+    # Returns the urls which should be crawled, in order.
+    def filter(self, urls):
+        return [url for url in urls if self.should_crawl(url)]
+
+
+class _Rules:
+    _prefixes = None
+    _substrings = None
+    _regex = None
+
+    def __init__(self, rules, domain_rules, ignore_case):
+        norm = (lambda s: s.lower()) if ignore_case else (lambda s: s)
+        prefixes = [norm(p) for p in rules.get('prefixes', [])]
+        substrings = [norm(s) for s in rules.get('substrings', [])]
+        patterns = ["(?:%s)" % r for r in rules.get('regexes', [])]
+        for domain, rules in domain_rules.items():
+            for path in rules.get('path_prefixes', []):
+                prefixes += [
+                    norm("%s://%s%s" % (scheme, domain, path))
+                    for scheme in ["http", "https"]
+                ]
+            anchor = _domain_anchor(domain)
+            patterns += [
+                anchor + ".*?" + re.escape(s)
+                for s in rules.get('substrings', [])
+            ]
+            patterns += [
+                anchor + "(?:%s)" % r for r in rules.get('regexes', [])
+            ]
+        self._prefixes = tuple(prefixes)
+        self._substrings = tuple(substrings)
+        if len(patterns) > 0:
+            self._regex = re.compile("|".join(patterns),
+                                     re.IGNORECASE if ignore_case else 0)
+
+    def is_empty(self):
+        return len(self._prefixes) == 0 and len(
+            self._substrings) == 0 and self._regex is None
+
+    def matches(self, url):
+        if len(self._prefixes) > 0 and url.startswith(self._prefixes):
+            return True
+        for substring in self._substrings:
+            if substring in url:
+                return True
+        return self._regex is not None and self._regex.search(url) is not None
+
+
+# Matches the scheme, optional user info and the host of a url up to the start
+# of its path.
+def _domain_anchor(domain):
+    return r"^[a-zA-Z][a-zA-Z0-9+.-]*://(?:[^/@]*@)?" + re.escape(
+        domain) + r"(?::\d+)?(?=[/?#]|$)"
@@ -0,0 +1,169 @@
+import concurrent.futures
+import logging
+import queue
+import sys
+import threading
+import time
+
+from db.url_db import UrlDb
+
+# How many times a commit which failed, eg. as the db stayed locked past the
+# timeout, is tried again before its writes are reported failed.
+_COMMIT_RETRIES = 5
+
+
+# Applies the writes of all the UrlDb instances of a process (see
+# UrlDb(writer=...)) on one connection owned by a thread of its own, so that
+# the threads of a crawl never compete for the sqlite write lock.
+# Writes are applied in the order they are submitted. The writer takes all the
+# writes waiting in its queue, up to max_batch_writes, and commits them in one
+# transaction, so the more threads write the fewer commits each write costs.
+# The future of a write is resolved with what the UrlDb method returned once
+# the write is committed, or False if the commit failed. A commit is tried
+# again up to _COMMIT_RETRIES times, while a write which fails on its own, eg.
+# as the db stayed locked past timeout, is not: its future is resolved with
+# the failure the UrlDb method returned, or its exception.
+# If the db can not be opened, or the writer thread dies, the error is raised
+# from the constructor or from submit(), and the futures queued are failed
+# with it.
+class DbWriter:
+    _db_path = None
+    _membership = None
+    _timeout = 0
+    _max_batch_writes = 0
+    _queue = None
+    _thread = None
+    _started = None
+    # The exception the writer thread died of, if it did
+    _error = None
+    _lock = None
+    _num_writes = 0
+    _num_commits = 0
+
+    # membership is the db.membership.UrlMembership of the process, if any,
+    # which is updated as the writes are applied. timeout is how long the
+    # writer waits for other connections, eg. of the frontier, to release the
+    # db.
+    def __init__(self,
+                 db_path,
+                 membership=None,
+                 max_batch_writes=10000,
+                 timeout=60.0):
+        self._db_path = db_path
+        self._membership = membership
+        self._timeout = timeout
+        self._max_batch_writes = max_batch_writes
+        self._queue = queue.Queue()
+        self._started = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run,
+                                        name="DbWriter",
+                                        daemon=True)
+        self._thread.start()
+        # Readers open the db read only, so it has to exist before they do.
+        self._started.wait()
+        if self._error is not None:
+            raise self._error
+
+    # Queues a call of the UrlDb method with args and returns its future.
+    def submit(self, method, *args):
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._error is not None:
+                raise self._error
+            self._queue.put((future, method, args))
+        return future
+
+    # Applies the writes queued so far and stops the writer.
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def get_stats(self):
+        return {
+            'writes': self._num_writes,
+            'commits': self._num_commits,
+            'writes_per_commit': self._num_writes / max(1, self._num_commits)
+        }
+
+    def _run(self):
+        try:
+            db = UrlDb(self._db_path,
+                       batch_writes=True,
+                       max_batch_rows=sys.maxsize,
+                       max_batch_ms=float('inf'),
+                       membership=self._membership,
+                       timeout=self._timeout)
+        except BaseException as e:
+            # Eg. the SystemExit of a db which could not be opened
+            logging.critical("Opening %s for the writer failed: %s",
+                             self._db_path, e)
+            self._fail([], e)
+            return
+        finally:
+            self._started.set()
+        batch = []
+        try:
+            self._apply_writes(db, batch)
+        except BaseException as e:
+            logging.critical("Writer of %s failed: %s", self._db_path, e)
+            self._fail(batch, e)
+        finally:
+            db.close()
+
+    # Fails the futures of batch and of the writes queued, and every write
+    # submitted from now on, with error.
+    def _fail(self, batch, error):
+        with self._lock:
+            self._error = error
+        while True:
+            try:
+                write = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if write is not None:
+                batch.append(write)
+        for future, _, _ in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    # Applies the queued writes until close(), with batch the writes taken
+    # off the queue and not yet resolved.
+    def _apply_writes(self, db, batch):
+        closed = False
+        while not closed:
+            batch.clear()
+            while len(batch) < self._max_batch_writes:
+                try:
+                    # Waits only for the first write of a batch
+                    write = self._queue.get(block=len(batch) == 0)
+                except queue.Empty:
+                    break
+                if write is None:
+                    closed = True
+                    break
+                batch.append(write)
+            if len(batch) == 0:
+                continue
+            results = []
+            for future, method, args in batch:
+                try:
+                    results.append(getattr(db, method)(*args))
+                except Exception as e:
+                    logging.critical("Queued %s failed: %s", method, e)
+                    results.append(e)
+            committed = self._commit(db)
+            for (future, _, _), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result if committed else False)
+            self._num_writes += len(batch)
+
+    def _commit(self, db):
+        for attempt in range(_COMMIT_RETRIES):
+            if db.flush():
+                self._num_commits += 1
+                return True
+            time.sleep(0.1 * (attempt + 1))
+        return False
@@ -0,0 +1,280 @@
+import datetime
+import logging
+import random
+import sqlite3
+import sys
+import threading
+import uuid
+
+# Priority of the urls due for a revisit, above the chance a new url is a poem
+# which is that of the others, see crawler/link_scorer.py.
+REVISIT_PRIORITY = 2.0
+
+
+# Hands out urls from pending_urls (see db/url_db.py#_FRONTIER_SCHEMA) to
+# crawl workers. A claimed url is leased to exactly one worker until it is
+# completed, released or the lease expires (eg. the worker died), after which
+# any worker can claim it again.
+# Every worker (thread or process) should use its own UrlFrontier instance on
+# the same db file.
+#
+# The order in which urls are handed out is one of
+#   random: urls sampled at random positions in pending_urls
+#   fifo: oldest seen first, ie. breadth first
+#   lifo: newest seen first
+#   priority: highest priority first, see crawler/link_scorer.py, in the order
+#       seen among equals
+# except that urls due for a revisit (see schedule_due()) take up to
+# revisit_share of every claim, oldest first, and the rest of it if there are
+# not enough other urls. They are at REVISIT_PRIORITY, above that of any new
+# url, so that new urls being found all the time do not hold them back.
+# Each claim costs in proportion to the batch size and not to the number of
+# pending urls, as it is a range scan on the integer primary key or on the
+# priority index, or for random an index lookup per url.
+class UrlFrontier:
+    _conn = None
+    _owner = None
+    _lease_seconds = 0
+    _order = None
+    _revisit_share = 0
+
+    def __init__(self,
+                 db_path,
+                 lease_seconds=600,
+                 owner=None,
+                 order="random",
+                 revisit_share=0.25):
+        assert order in ["random", "fifo", "lifo", "priority"], order
+        try:
+            # Transactions are managed explicitly so that a claim is atomic
+            # across connections.
+            self._conn = sqlite3.connect(db_path,
+                                         timeout=30.0,
+                                         isolation_level=None)
+        except sqlite3.OperationalError as e:
+            logging.critical("Initializing frontier failed: %s", e)
+            sys.exit("DB connection error. Aborting")
+        self._owner = owner if owner is not None else uuid.uuid4().hex
+        self._lease_seconds = lease_seconds
+        self._order = order
+        self._revisit_share = revisit_share
+
+    def get_owner(self):
+        return self._owner
+
+    # Leases up to max_to_claim urls which are not crawled, forbidden or
+    # leased by another worker and returns them.
+    def claim(self, max_to_claim=100):
+        now = datetime.datetime.now()
+        expiry = now + datetime.timedelta(seconds=self._lease_seconds)
+        curr = self._conn.cursor()
+        try:
+            curr.execute("begin immediate;")
+            rows = self._select_unleased(curr, now.isoformat(), max_to_claim)
+            curr.executemany(
+                "update pending_urls set lease_owner = (?), lease_expiry = (?) where id = (?);",
+                [(self._owner, expiry.isoformat(), row[0]) for row in rows])
+            curr.execute("commit;")
+        except sqlite3.OperationalError as e:
+            logging.critical("Claiming urls from frontier failed: %s", e)
+            self._rollback()
+            return []
+        logging.info("Claimed %d urls for %s", len(rows), self._owner)
+        return [row[1] for row in rows]
+
+    # Adds up to max_to_schedule crawled urls which are due for a revisit, as
+    # per crawl_state, to the frontier. Returns the number added.
+    def schedule_due(self, max_to_schedule=100):
+        curr = self._conn.cursor()
+        try:
+            curr.execute("begin immediate;")
+            curr.execute(
+                "insert or ignore into pending_urls(url, priority) select url, (?) from crawl_state where next_crawl_time <= (?) and url not in (select url from pending_urls) and url not in (select url from forbidden_urls) order by next_crawl_time limit (?);",
+                (REVISIT_PRIORITY, datetime.datetime.now().isoformat(),
+                 max_to_schedule))
+            num_scheduled = curr.rowcount
+            curr.execute("commit;")
+        except sqlite3.OperationalError as e:
+            logging.critical("Scheduling revisits failed: %s", e)
+            self._rollback()
+            return 0
+        logging.info("Scheduled %d urls for a revisit", num_scheduled)
+        return num_scheduled
+
+    # Drops a url which has been handled from the frontier. Crawled and
+    # forbidden urls are dropped by the triggers anyway, this covers the urls
+    # which were skipped or redirected.
+    def complete(self, url):
+        return self._write(
+            "delete from pending_urls where url = (?) and lease_owner = (?);",
+            [(url, self._owner)])
+
+    # Gives back urls which were claimed but not processed.
+    def release(self, urls):
+        return self._write(
+            "update pending_urls set lease_owner = null, lease_expiry = null where url = (?) and lease_owner = (?);",
+            [(url, self._owner) for url in urls])
+
+    # Gives back a claimed url which could not be fetched for now, eg. the
+    # host was throttling, so that no worker claims it for seconds.
+    def defer(self, url, seconds):
+        expiry = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+        return self._write(
+            "update pending_urls set lease_owner = null, lease_expiry = (?) where url = (?) and lease_owner = (?);",
+            [(expiry.isoformat(), url, self._owner)])
+
+    def release_all(self):
+        return self._write(
+            "update pending_urls set lease_owner = null, lease_expiry = null where lease_owner = (?);",
+            [(self._owner, )])
+
+    # True if any worker holds a live lease, ie. more urls may still show up
+    # in the frontier once those are processed.
+    def has_active_leases(self):
+        curr = self._conn.cursor()
+        try:
+            curr.execute(
+                "select 1 from pending_urls where lease_expiry > (?) limit 1;",
+                (datetime.datetime.now().isoformat(), ))
+        except sqlite3.OperationalError as e:
+            logging.critical("Checking leases in frontier failed: %s", e)
+            return False
+        return curr.fetchone() is not None
+
+    # Returns the number of pending urls, leased or not, or -1.
+    def get_size(self):
+        curr = self._conn.cursor()
+        try:
+            curr.execute("select count(*) from pending_urls;")
+        except sqlite3.OperationalError as e:
+            logging.critical("Counting the frontier failed: %s", e)
+            return -1
+        return curr.fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+    def _select_unleased(self, curr, now, max_to_claim):
+        num_revisits = min(max_to_claim,
+                           int(max_to_claim * self._revisit_share + 0.5))
+        rows = self._select_revisits(curr, now, num_revisits)
+        rows += self._select_new(curr, now, max_to_claim - len(rows))
+        if len(rows) < max_to_claim:
+            rows += self._select_revisits(curr, now, max_to_claim - len(rows),
+                                          num_revisits)
+        return rows
+
+    def _select_revisits(self, curr, now, max_to_claim, offset=0):
+        if max_to_claim <= 0:
+            return []
+        curr.execute(
+            "select id, url from pending_urls where priority >= (?) and (lease_expiry is null or lease_expiry <= (?)) order by priority desc, id limit (?) offset (?);",
+            (REVISIT_PRIORITY, now, max_to_claim, offset))
+        return curr.fetchall()
+
+    def _select_new(self, curr, now, max_to_claim):
+        if max_to_claim <= 0:
+            return []
+        unleased = "(lease_expiry is null or lease_expiry <= (?)) and priority < %r" % REVISIT_PRIORITY
+        if self._order == "lifo":
+            curr.execute(
+                "select id, url from pending_urls where %s order by id desc limit (?);"
+                % unleased, (now, max_to_claim))
+            return curr.fetchall()
+        if self._order == "priority":
+            curr.execute(
+                "select id, url from pending_urls where %s order by priority desc, id limit (?);"
+                % unleased, (now, max_to_claim))
+            return curr.fetchall()
+        if self._order != "random":
+            curr.execute(
+                "select id, url from pending_urls where %s order by id limit (?);"
+                % unleased, (now, max_to_claim))
+            return curr.fetchall()
+        # Separate subqueries, as sqlite only answers each of min and max
+        # from the primary key on its own.
+        curr.execute(
+            "select (select min(id) from pending_urls), (select max(id) from pending_urls);"
+        )
+        min_id, max_id = curr.fetchone()
+        if min_id is None:
+            return []
+        # The first unleased url at or after each of a number of random ids,
+        # an index lookup each. Ids drawn twice or past the last unleased url
+        # are drawn again, a bounded number of times.
+        rows = {}
+        for _ in range(2 * max_to_claim):
+            if len(rows) == max_to_claim:
+                break
+            curr.execute(
+                "select id, url from pending_urls where id >= (?) and %s order by id limit 1;"
+                % unleased, (random.randint(min_id, max_id), now))
+            row = curr.fetchone()
+            if row is not None:
+                rows[row[0]] = row
+        if len(rows) < max_to_claim:
+            # Few unleased urls left, take them in order
+            curr.execute(
+                "select id, url from pending_urls where %s order by id limit (?);"
+                % unleased, (now, max_to_claim + len(rows)))
+            for row in curr.fetchall():
+                if len(rows) == max_to_claim:
+                    break
+                rows.setdefault(row[0], row)
+        return list(rows.values())
+
+    def _write(self, query, params):
+        curr = self._conn.cursor()
+        try:
+            curr.execute("begin immediate;")
+            curr.executemany(query, params)
+            curr.execute("commit;")
+        except sqlite3.OperationalError as e:
+            logging.critical("Updating leases failed: %s", e)
+            self._rollback()
+            return False
+        return True
+
+    def _rollback(self):
+        try:
+            self._conn.execute("rollback;")
+        except sqlite3.OperationalError:
+            pass
+
+
+# A max_urls_to_process budget shared by all the workers of a crawl. A worker
+# reserves a slot before processing a url and commits it if the url counted as
+# processed, otherwise releases it for other workers.
+class CrawlBudget:
+    _limit = 0
+    _used = 0
+    _reserved = 0
+    _lock = None
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            if self._used + self._reserved >= self._limit:
+                return False
+            self._reserved += 1
+            return True
+
+    def commit(self):
+        with self._lock:
+            self._reserved -= 1
+            self._used += 1
+
+    def release(self):
+        with self._lock:
+            self._reserved -= 1
+
+    def is_exhausted(self):
+        with self._lock:
+            return self._used >= self._limit
+
+    def get_used(self):
+        with self._lock:
+            return self._used
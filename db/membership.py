@@ -0,0 +1,191 @@
+import collections
+import hashlib
+import logging
+import math
+import sys
+import threading
+import time
+
+
+# A 64 bit hash of key which is the same in every process and run, unlike the
+# builtin str hash which is seeded per process (see PYTHONHASHSEED).
+def _hash64(key):
+    return int.from_bytes(
+        hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+# Fixed size Bloom filter over strings. Answers "definitely not added" or
+# "probably added".
+# Bit positions come from _hash64(), so a filter has the same bits for the
+# same keys in every process and run, and its false positives can be
+# reproduced.
+class BloomFilter:
+    _bits = None
+    _num_bits = 0
+    _num_hashes = 0
+    _num_added = 0
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(1, capacity)
+        self._num_bits = max(
+            8, int(-capacity * math.log(error_rate) / (math.log(2)**2)))
+        self._num_hashes = max(
+            1, int(round(self._num_bits / capacity * math.log(2))))
+        self._bits = bytearray((self._num_bits + 7) // 8)
+
+    def add(self, key):
+        bits = self._bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self._num_added += 1
+
+    # Same as add() for each key, inlined as this is what warm up spends its
+    # time on.
+    def add_all(self, keys):
+        bits = self._bits
+        num_bits = self._num_bits
+        hashes = range(self._num_hashes)
+        num_added = 0
+        for key in keys:
+            h = _hash64(key)
+            h1 = h & 0xFFFFFFFF
+            h2 = ((h >> 32) & 0xFFFFFFFF) | 1
+            for i in hashes:
+                pos = (h1 + i * h2) % num_bits
+                bits[pos >> 3] |= 1 << (pos & 7)
+            num_added += 1
+        self._num_added += num_added
+
+    def __contains__(self, key):
+        bits = self._bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def get_memory_bytes(self):
+        return len(self._bits)
+
+    # False positive rate expected for the number of keys added so far.
+    def get_expected_error_rate(self):
+        return (1 - math.exp(-self._num_hashes * self._num_added /
+                             self._num_bits))**self._num_hashes
+
+    # Double hashing of the two halves of a 64 bit hash, see Kirsch and
+    # Mitzenmacher.
+    def _positions(self, key):
+        h = _hash64(key)
+        h1 = h & 0xFFFFFFFF
+        h2 = ((h >> 32) & 0xFFFFFFFF) | 1
+        return [(h1 + i * h2) % self._num_bits
+                for i in range(self._num_hashes)]
+
+
+# Membership of urls in one table, kept in front of the sql lookups.
+# lookup() returns False when the url is definitely absent (Bloom filter
+# miss), True when it is definitely present (in the set of recently added or
+# confirmed urls) and None when only sql can tell. Removed urls stay in the
+# Bloom filter, they just fall back to sql.
+# Only writes made through the UrlDb instances sharing this filter are seen, so
+# a url added by another process can be reported absent. Adds are idempotent,
+# so this only costs an ignored insert.
+class MembershipFilter:
+    _bloom = None
+    _recent = None
+    _max_recent = 0
+    _lock = None
+    _lookups = 0
+    _bloom_misses = 0
+    _recent_hits = 0
+    _false_positives = 0
+
+    def __init__(self, capacity, error_rate=0.01, max_recent=100000):
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._recent = collections.OrderedDict()
+        self._max_recent = max_recent
+        self._lock = threading.Lock()
+
+    def add(self, url):
+        with self._lock:
+            self._bloom.add(url)
+            self._add_recent(url)
+
+    def add_all(self, urls):
+        with self._lock:
+            self._bloom.add_all(urls)
+
+    def discard(self, url):
+        with self._lock:
+            self._recent.pop(url, None)
+
+    def lookup(self, url):
+        with self._lock:
+            self._lookups += 1
+            if url not in self._bloom:
+                self._bloom_misses += 1
+                return False
+            if url in self._recent:
+                self._recent.move_to_end(url)
+                self._recent_hits += 1
+                return True
+            return None
+
+    # Records the answer from sql for a url for which lookup() returned None.
+    def record(self, url, present):
+        with self._lock:
+            if present:
+                self._add_recent(url)
+            else:
+                self._false_positives += 1
+
+    def get_stats(self):
+        with self._lock:
+            # Keys are shared with the callers, count only the container.
+            recent_bytes = sys.getsizeof(self._recent)
+            fallbacks = self._lookups - self._bloom_misses - self._recent_hits
+            return {
+                'memory_bytes':
+                self._bloom.get_memory_bytes() + recent_bytes,
+                'expected_error_rate':
+                self._bloom.get_expected_error_rate(),
+                # Share of absent urls which the Bloom filter let through.
+                'observed_error_rate':
+                self._false_positives /
+                max(1, self._false_positives + self._bloom_misses),
+                'lookups':
+                self._lookups,
+                'sql_fallbacks':
+                fallbacks,
+            }
+
+    def _add_recent(self, url):
+        self._recent[url] = True
+        self._recent.move_to_end(url)
+        if len(self._recent) > self._max_recent:
+            self._recent.popitem(last=False)
+
+
+# The filters for seen_urls and forbidden_urls, shared by all the UrlDb
+# instances of a process.
+class UrlMembership:
+    seen = None
+    forbidden = None
+
+    # Sizes the filters for the current tables with room to grow and loads
+    # them from the db.
+    def __init__(self, db, error_rate=0.01, growth=4):
+        start = time.monotonic()
+        self.seen = MembershipFilter(max(100000, growth * db.get_total_seen()),
+                                     error_rate)
+        self.forbidden = MembershipFilter(
+            max(100000, growth * db.get_total_forbidden()), error_rate)
+        self.seen.add_all(db.iterate_table_urls("seen_urls"))
+        self.forbidden.add_all(db.iterate_table_urls("forbidden_urls"))
+        logging.info("Loaded url membership filters in %.2f secs",
+                     time.monotonic() - start)
+
+    def get_stats(self):
+        return {
+            'seen_urls': self.seen.get_stats(),
+            'forbidden_urls': self.forbidden.get_stats()
+        }
@@ -0,0 +1,215 @@
+import hashlib
+import logging
+import unicodedata
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Largest prime below 2**32, so that signature values fit in 32 bits and
+# a * x + b never overflows 64 bits for 32 bit shingle hashes.
+_PRIME = 4294967291
+
+# Number of shingle hashes put through the permutations at a time by
+# MinHasher.signatures(), bounds its memory to num_perm * 8 bytes each.
+_MAX_BATCH_SHINGLES = 50000
+
+
+# Shingled MinHash signatures of poems. Poems are compared on the set of their
+# runs of shingle_size words after dropping case, punctuation and spacing, so
+# poems differing only in those or in a line or two, eg. an attribution, have
+# most of their signature in common.
+# Shingles are hashed with crc32 and permutations come from a fixed seed, so
+# signatures are the same across processes and can be stored.
+class MinHasher:
+    num_perm = 0
+    _shingle_size = 0
+    _a = None
+    _b = None
+
+    def __init__(self, num_perm=128, shingle_size=3, seed=1):
+        if numpy is None:
+            raise ImportError("Near duplicate detection needs numpy")
+        self.num_perm = num_perm
+        self._shingle_size = shingle_size
+        rng = numpy.random.RandomState(seed)
+        self._a = rng.randint(1, _PRIME, size=num_perm,
+                              dtype=numpy.uint64)[:, None]
+        self._b = rng.randint(0, _PRIME, size=num_perm,
+                              dtype=numpy.uint64)[:, None]
+
+    # Returns the signature of text as a uint32 array, or None if it has no
+    # words.
+    def signature(self, text):
+        hashes = self._shingle_hashes(text)
+        if len(hashes) == 0:
+            return None
+        return ((self._a * hashes + self._b) % _PRIME).min(axis=1).astype(
+            numpy.uint32)
+
+    # Same as signature() for each of texts, with the permutations applied to
+    # the shingles of many texts at once.
+    def signatures(self, texts):
+        results = [None] * len(texts)
+        batch, hashes, num_shingles = [], [], 0
+        for i, text in enumerate(texts):
+            text_hashes = self._shingle_hashes(text)
+            if len(text_hashes) == 0:
+                continue
+            batch.append(i)
+            hashes.append(text_hashes)
+            num_shingles += len(text_hashes)
+            if num_shingles >= _MAX_BATCH_SHINGLES:
+                self._fill_signatures(results, batch, hashes)
+                batch, hashes, num_shingles = [], [], 0
+        if len(batch) > 0:
+            self._fill_signatures(results, batch, hashes)
+        return results
+
+    def _fill_signatures(self, results, batch, hashes):
+        offsets = numpy.cumsum([0] + [len(h) for h in hashes[:-1]])
+        permuted = (self._a * numpy.concatenate(hashes) + self._b) % _PRIME
+        mins = numpy.minimum.reduceat(permuted, offsets,
+                                      axis=1).astype(numpy.uint32)
+        for column, i in enumerate(batch):
+            results[i] = mins[:, column].copy()
+
+    def _shingle_hashes(self, text):
+        words = _normalize(text).split()
+        size = min(self._shingle_size, len(words))
+        shingles = set(' '.join(words[i:i + size])
+                       for i in range(len(words) - size +
+                                      1)) if size > 0 else ()
+        return numpy.fromiter((zlib.crc32(s.encode()) for s in shingles),
+                              dtype=numpy.uint64,
+                              count=len(shingles))
+
+
+def _normalize(text):
+    return ''.join(' ' if unicodedata.category(c)[0] in 'PSZC' else c
+                   for c in text.lower())
+
+
+# Fraction of the positions at which two signatures agree, an estimate of the
+# Jaccard similarity of the shingles of their texts.
+def similarity(signature, other):
+    return float(numpy.mean(signature == other))
+
+
+# Locality sensitive hashing index of the MinHash signatures of the poems in
+# fetched_content, kept in the db next to them (poem_signatures and poem_lsh).
+# A signature is cut into num_bands bands, each of which is hashed to a
+# bucket. Poems sharing a bucket in any band are candidates, which are then
+# checked against threshold on their full signatures. The default 16 bands of
+# 8 rows make poems with a similarity of 0.7 candidates half the time and of
+# 0.9 almost always.
+# Lookups are a few indexed queries whatever the size of the corpus.
+class NearDupIndex:
+    _db = None
+    _hasher = None
+    _num_bands = 0
+    _rows = 0
+    _threshold = 0
+
+    def __init__(self, db, num_perm=128, num_bands=16, threshold=0.8):
+        assert num_perm % num_bands == 0, (num_perm, num_bands)
+        self._db = db
+        self._hasher = MinHasher(num_perm)
+        self._num_bands = num_bands
+        self._rows = num_perm // num_bands
+        self._threshold = threshold
+
+    def get_hasher(self):
+        return self._hasher
+
+    # Indexes the poem of url. Returns the (url, similarity) of the already
+    # indexed poems similar to it, most similar first.
+    def add(self, url, poem):
+        signature = self._hasher.signature(poem)
+        if signature is None:
+            return []
+        similar = self._find_similar(signature, url)
+        self.add_signature(url, signature)
+        return similar
+
+    def add_signature(self, url, signature):
+        return self._db.add_poem_signature(url, signature.tobytes(),
+                                           self._buckets(signature))
+
+    # Returns the (url, similarity) of the indexed poems similar to poem, most
+    # similar first.
+    def find_similar(self, poem):
+        signature = self._hasher.signature(poem)
+        if signature is None:
+            return []
+        return self._find_similar(signature)
+
+    def find_similar_to_url(self, url):
+        signatures = self._db.read_poem_signatures([url])
+        if url not in signatures:
+            return []
+        return self._find_similar(_from_bytes(signatures[url]), url)
+
+    # Returns the groups of two or more urls whose poems are similar, directly
+    # or through others, largest first.
+    def cluster(self):
+        parents = {}
+
+        def find(url):
+            root = url
+            while parents.get(root, root) != root:
+                root = parents[root]
+            while url != root:
+                parents[url], url = root, parents[url]
+            return root
+
+        for urls in self._db.iterate_lsh_buckets():
+            signatures = {
+                url: _from_bytes(signature)
+                for url, signature in self._db.read_poem_signatures(
+                    urls).items()
+            }
+            urls = list(signatures)
+            for url in urls:
+                parents.setdefault(url, url)
+            for i, url in enumerate(urls):
+                for other in urls[i + 1:]:
+                    if find(url) != find(other) and similarity(
+                            signatures[url],
+                            signatures[other]) >= self._threshold:
+                        parents[find(other)] = find(url)
+        clusters = {}
+        for url in list(parents):
+            clusters.setdefault(find(url), []).append(url)
+        return sorted([urls for urls in clusters.values() if len(urls) > 1],
+                      key=len,
+                      reverse=True)
+
+    def _find_similar(self, signature, url=None):
+        candidates = self._db.find_lsh_candidates(self._buckets(signature))
+        candidates.discard(url)
+        similar = []
+        for candidate, other in self._db.read_poem_signatures(
+                list(candidates)).items():
+            score = similarity(signature, _from_bytes(other))
+            if score >= self._threshold:
+                similar.append((candidate, score))
+        logging.debug("%d of %d lsh candidates are similar", len(similar),
+                      len(candidates))
+        return sorted(similar, key=lambda item: item[1], reverse=True)
+
+    # Returns (band, bucket) of each band of signature.
+    def _buckets(self, signature):
+        return [(band,
+                 int.from_bytes(
+                     hashlib.blake2b(signature[band * self._rows:(band + 1) *
+                                               self._rows].tobytes(),
+                                     digest_size=8).digest(),
+                     'little',
+                     signed=True)) for band in range(self._num_bands)]
+
+
+def _from_bytes(signature):
+    return numpy.frombuffer(signature, dtype=numpy.uint32)
@@ -0,0 +1,259 @@
+import datetime
+import logging
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Codecs of a record. zstd needs the zstandard package.
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODECS = {"none": CODEC_NONE, "zlib": CODEC_ZLIB, "zstd": CODEC_ZSTD}
+
+# magic, codec, url length, fetch time length, page length, payload length
+_HEADER = struct.Struct("<4sBHBII")
+_MAGIC = b"PGA1"
+
+_INDEX_SCHEMA = "create table if not exists pages(url text primary key, segment text, offset integer, length integer, page_length integer, fetch_time text, content_hash text);"
+
+
+# Append only archive of raw fetched pages in a directory, so that pages can be
+# extracted again without refetching them.
+# Pages are appended as records to segment files, each record compressed on
+# its own so that a page is read back with one seek and one decompression:
+#   header (_HEADER), url, fetch time, compressed page
+# A segment is closed once it grows past max_segment_bytes. Every writer
+# (process) appends to segments of its own, named after its start time and
+# pid, so concurrent crawls never write to the same file.
+# index.db in the directory maps every url to the record of its latest page.
+# A record written just before a crash may be missing from the index, it is
+# then only seen by iterate(latest_only=False).
+# An instance can be shared by the threads of a process.
+class PageArchive:
+    _dir = None
+    _codec = CODEC_ZLIB
+    _level = 6
+    _max_segment_bytes = 0
+    _index = None
+    _lock = None
+    _writer_prefix = None
+    _segment = None
+    _segment_file = None
+    _num_segments = 0
+
+    # codec is one of CODECS, zstd falls back to zlib when zstandard is not
+    # installed. level is that of the codec.
+    def __init__(self,
+                 archive_dir,
+                 codec="zlib",
+                 level=None,
+                 max_segment_bytes=1 << 30):
+        assert codec in CODECS, codec
+        if codec == "zstd" and zstandard is None:
+            logging.warning("zstandard is not installed, archiving with zlib")
+            codec = "zlib"
+        self._dir = archive_dir
+        self._codec = CODECS[codec]
+        if level is not None:
+            self._level = level
+        elif self._codec == CODEC_ZSTD:
+            self._level = 3
+        self._max_segment_bytes = max_segment_bytes
+        self._lock = threading.Lock()
+        self._writer_prefix = "pages-%s-%d" % (
+            datetime.datetime.now().strftime("%Y%m%d%H%M%S"), os.getpid())
+        try:
+            os.makedirs(archive_dir, exist_ok=True)
+            self._index = sqlite3.connect(os.path.join(archive_dir,
+                                                       "index.db"),
+                                          timeout=30.0,
+                                          check_same_thread=False)
+            self._index.execute("pragma journal_mode = wal;")
+            self._index.execute("pragma synchronous = normal;")
+            self._index.execute(_INDEX_SCHEMA)
+            self._index.commit()
+        except (OSError, sqlite3.OperationalError) as e:
+            logging.critical("Initializing page archive failed: %s", e)
+            sys.exit("Page archive error. Aborting")
+
+    # Appends page, the raw bytes fetched for url, and points the index of url
+    # to it.
+    def put(self, url, page, content_hash=None, fetch_time=None):
+        if fetch_time is None:
+            fetch_time = datetime.datetime.now().isoformat()
+        url_bytes = url.encode()
+        time_bytes = fetch_time.encode()
+        payload = self._compress(page)
+        record = _HEADER.pack(_MAGIC, self._codec, len(url_bytes),
+                              len(time_bytes), len(page),
+                              len(payload)) + url_bytes + time_bytes + payload
+        with self._lock:
+            try:
+                segment, offset = self._append(record)
+                self._index.execute(
+                    "insert or replace into pages values(?, ?, ?, ?, ?, ?, ?);",
+                    (url, segment, offset, len(record), len(page), fetch_time,
+                     content_hash))
+                self._index.commit()
+            except (OSError, sqlite3.OperationalError) as e:
+                logging.critical("Archiving %s failed: %s", url, e)
+                return False
+        logging.debug("Archived %s, %d bytes in %d", url, len(page),
+                      len(record))
+        return True
+
+    # Returns the latest archived page of url as bytes, or None.
+    def get(self, url):
+        with self._lock:
+            row = self._index.execute(
+                "select segment, offset, length from pages where url = (?);",
+                (url, )).fetchone()
+        if row is None:
+            return None
+        segment, offset, length = row
+        with open(os.path.join(self._dir, segment), 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        if len(data) < length:
+            logging.error("Truncated record of %s in %s", url, segment)
+            return None
+        _, (_, _, page) = _decode_record(data)
+        return page
+
+    def contains(self, url):
+        with self._lock:
+            return self._index.execute("select 1 from pages where url = (?);",
+                                       (url, )).fetchone() is not None
+
+    # Yields (url, fetch_time, page) of all the records, one segment after the
+    # other in the order they were written, reading each segment sequentially.
+    # With latest_only, pages superseded by a later fetch of their url are
+    # skipped.
+    def iterate(self, latest_only=True):
+        for segment in self.get_segments():
+            latest = None
+            if latest_only:
+                with self._lock:
+                    latest = set(row[0] for row in self._index.execute(
+                        "select offset from pages where segment = (?);", (
+                            segment, )))
+            for offset, url, fetch_time, page in _read_segment(
+                    os.path.join(self._dir, segment)):
+                if latest is None or offset in latest:
+                    yield url, fetch_time, page
+
+    def get_segments(self):
+        return sorted(name for name in os.listdir(self._dir)
+                      if name.startswith("pages-") and name.endswith(".seg"))
+
+    # Number of pages in the index, their raw size and their archived size.
+    def get_stats(self):
+        with self._lock:
+            pages, page_bytes, stored_bytes = self._index.execute(
+                "select count(*), coalesce(sum(page_length), 0), coalesce(sum(length), 0) from pages;"
+            ).fetchone()
+        return {
+            'pages': pages,
+            'page_bytes': page_bytes,
+            'stored_bytes': stored_bytes,
+            'ratio': stored_bytes / max(1, page_bytes),
+        }
+
+    def close(self):
+        with self._lock:
+            if self._segment_file is not None:
+                self._segment_file.close()
+                self._segment_file = None
+            self._index.close()
+
+    def _compress(self, page):
+        if self._codec == CODEC_ZSTD:
+            # Compressors can not be shared between threads
+            return zstandard.ZstdCompressor(level=self._level).compress(page)
+        if self._codec == CODEC_ZLIB:
+            return zlib.compress(page, self._level)
+        return page
+
+    # Returns the segment and offset record was written at.
+    def _append(self, record):
+        if self._segment_file is None or self._segment_file.tell(
+        ) >= self._max_segment_bytes:
+            if self._segment_file is not None:
+                self._segment_file.close()
+            self._segment = "%s-%04d.seg" % (self._writer_prefix,
+                                             self._num_segments)
+            self._num_segments += 1
+            self._segment_file = open(os.path.join(self._dir, self._segment),
+                                      'ab')
+            logging.info("Archiving pages to %s", self._segment)
+        offset = self._segment_file.tell()
+        self._segment_file.write(record)
+        # Readers open the segment on their own
+        self._segment_file.flush()
+        return self._segment, offset
+
+
+# Returns (url, fetch_time, page) of a whole record and its length from the
+# start of data, or None if data has no complete record.
+def _decode_record(data, start=0):
+    if len(data) - start < _HEADER.size:
+        return None
+    magic, codec, url_length, time_length, page_length, payload_length = _HEADER.unpack_from(
+        data, start)
+    if magic != _MAGIC:
+        raise ValueError("Bad page archive record at %d" % start)
+    pos = start + _HEADER.size
+    end = pos + url_length + time_length + payload_length
+    if len(data) < end:
+        return None
+    url = data[pos:pos + url_length].decode()
+    pos += url_length
+    fetch_time = data[pos:pos + time_length].decode()
+    pos += time_length
+    page = _decompress(codec, data[pos:end], page_length)
+    return end - start, (url, fetch_time, page)
+
+
+def _decompress(codec, payload, page_length):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ImportError("Reading zstd records needs zstandard")
+        return zstandard.ZstdDecompressor().decompress(
+            payload, max_output_size=page_length)
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(payload)
+    return payload
+
+
+# Yields (offset, url, fetch_time, page) of the records of a segment. Stops at
+# a partly written record at the end.
+def _read_segment(path, chunk_bytes=1 << 20):
+    with open(path, 'rb') as f:
+        data = b''
+        base = 0
+        while True:
+            chunk = f.read(chunk_bytes)
+            if len(chunk) == 0:
+                if len(data) > 0:
+                    logging.warning("Incomplete record at %d in %s", base,
+                                    path)
+                return
+            data += chunk
+            start = 0
+            while True:
+                decoded = _decode_record(data, start)
+                if decoded is None:
+                    break
+                length, (url, fetch_time, page) = decoded
+                yield base + start, url, fetch_time, page
+                start += length
+            data = data[start:]
+            base += start
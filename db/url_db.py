@@ -1,132 +1,433 @@
 import datetime
 import logging
+import os
 import sqlite3
 import sys
+import time
+import urllib.request
 
+# Version of the table definitions below, stored in the db as the sqlite
+# user_version. Dbs created before versioning are at version 0 and can be
+# moved to the current version in place with tools/migrate_db.py.
+# 1: url primary keys and indexes.
+# 2: pending_urls, the frontier of db/frontier.py.
+# 3: crawl_state, for revisiting crawled urls.
+# 4: poem_signatures and poem_lsh, the near duplicate index of db/near_dup.py.
+# 5: priority of pending_urls, for the priority order of db/frontier.py.
+SCHEMA_VERSION = 5
 
+_TABLES = {
+    "seen_urls":
+    "create table seen_urls(url text primary key, seen_time datetime, crawl_time datetime);",
+    "crawled_urls":
+    "create table crawled_urls(url text primary key, seen_time datetime, crawl_time datetime);",
+    "forbidden_urls":
+    "create table forbidden_urls(url text primary key, seen_time datetime);",
+    "fetched_content":
+    "create table fetched_content(url text primary key, heading text, poem text, headingHash text, poemHash text);",
+}
+
+_INDEXES = [
+    "create index if not exists seen_urls_seen_time on seen_urls(seen_time);",
+    "create index if not exists crawled_urls_crawl_time on crawled_urls(crawl_time);",
+    "create index if not exists fetched_content_poem_hash on fetched_content(poemHash);",
+]
+
+# pending_urls holds the seen urls which are neither crawled nor forbidden and
+# is kept in sync by the triggers, so that whichever tool writes to the tables
+# the frontier stays right. Urls are numbered in the order they were seen, which
+# is what db/frontier.py samples on. priority is set by add_seen_urls when it
+# is given one and by db/frontier.py for urls due for a revisit, urls added
+# otherwise are at 0.
+_FRONTIER_SCHEMA = [
+    "create table pending_urls(id integer primary key, url text unique not null, lease_owner text, lease_expiry datetime, priority real not null default 0);",
+    "create index pending_urls_lease_expiry on pending_urls(lease_expiry);",
+    "create index pending_urls_priority on pending_urls(priority desc, id);",
+    "create trigger seen_urls_add_pending after insert on seen_urls when not exists (select 1 from crawled_urls where url = new.url) and not exists (select 1 from forbidden_urls where url = new.url) begin insert or ignore into pending_urls(url) values(new.url); end;",
+    "create trigger seen_urls_remove_pending after delete on seen_urls begin delete from pending_urls where url = old.url; end;",
+    "create trigger crawled_urls_remove_pending after insert on crawled_urls begin delete from pending_urls where url = new.url; end;",
+    "create trigger crawled_urls_add_pending after delete on crawled_urls when exists (select 1 from seen_urls where url = old.url) and not exists (select 1 from forbidden_urls where url = old.url) begin insert or ignore into pending_urls(url) values(old.url); end;",
+    "create trigger forbidden_urls_remove_pending after insert on forbidden_urls begin delete from pending_urls where url = new.url; end;",
+]
+
+_FRONTIER_PRIORITY_UPGRADE = [
+    "alter table pending_urls add column priority real not null default 0;",
+    "create index pending_urls_priority on pending_urls(priority desc, id);",
+]
+
+_FRONTIER_FILL = "insert or ignore into pending_urls(url) select url from seen_urls where url not in (select url from crawled_urls) and url not in (select url from forbidden_urls) order by seen_time;"
+
+# The http validators, hash of the raw page and revisit schedule of crawled
+# urls. num_changes counts the revisits which found a changed page.
+_RECRAWL_SCHEMA = [
+    "create table crawl_state(url text primary key, etag text, last_modified text, content_hash text, first_crawl_time datetime, last_crawl_time datetime, next_crawl_time datetime, num_checks integer, num_changes integer);",
+    "create index crawl_state_next_crawl_time on crawl_state(next_crawl_time);",
+]
+
+# The MinHash signature of the poem of each url of fetched_content and the
+# (band, bucket) of each of its bands, see db/near_dup.py. Removing content
+# removes it from the index. Signatures of older dbs are filled in by
+# tools/near_dups.py --backfill.
+_NEAR_DUP_SCHEMA = [
+    "create table poem_signatures(url text primary key, signature blob);",
+    "create table poem_lsh(band integer, bucket integer, url text);",
+    "create index poem_lsh_bucket on poem_lsh(band, bucket);",
+    "create index poem_lsh_url on poem_lsh(url);",
+    "create trigger fetched_content_remove_signature after delete on fetched_content begin delete from poem_signatures where url = old.url; delete from poem_lsh where url = old.url; end;",
+]
+
+# Crawled urls of older dbs have no validators, they are first revisited
+# _RECRAWL_BACKFILL_DAYS after they were crawled.
+_RECRAWL_BACKFILL_DAYS = 30
+_RECRAWL_BACKFILL = "insert or ignore into crawl_state select url, null, null, null, crawl_time, crawl_time, strftime('%%Y-%%m-%%dT%%H:%%M:%%f', crawl_time, '+%d days'), 1, 0 from crawled_urls where crawl_time is not null;" % _RECRAWL_BACKFILL_DAYS
+
+# Copy the rows of the db attached as shard, eg. of a shard of a sharded
+# crawl, see crawler/sharding.py, in an order which lets the triggers keep
+# pending_urls right: a url pending in one db and crawled or forbidden in the
+# other is dropped from it. Rows of urls this db has already are kept.
+_MERGE = [
+    ("pending_urls",
+     "insert or ignore into pending_urls(url, priority) select url, priority from shard.pending_urls where url not in (select url from crawled_urls) and url not in (select url from forbidden_urls) order by id;"
+     ),
+    ("seen_urls",
+     "insert or ignore into seen_urls select * from shard.seen_urls;"),
+    ("crawled_urls",
+     "insert or ignore into crawled_urls select * from shard.crawled_urls;"),
+    ("forbidden_urls",
+     "insert or ignore into forbidden_urls select * from shard.forbidden_urls;"
+     ),
+    ("fetched_content",
+     "insert or ignore into fetched_content select * from shard.fetched_content;"
+     ),
+    ("crawl_state",
+     "insert or ignore into crawl_state select * from shard.crawl_state;"),
+    # poem_lsh has no key, so before the signatures they belong to
+    ("poem_lsh",
+     "insert into poem_lsh select * from shard.poem_lsh where url not in (select url from poem_signatures);"
+     ),
+    ("poem_signatures",
+     "insert or ignore into poem_signatures select * from shard.poem_signatures;"
+     ),
+]
+
+# When a version 0 table has several rows for a url, the first one in this
+# order is kept while upgrading.
+_DEDUP_ORDER = {
+    "seen_urls": "seen_time",
+    "crawled_urls": "crawl_time desc",
+    "forbidden_urls": "seen_time",
+    "fetched_content": "rowid",
+}
+
+# Rows of fetched_content repeating a poemHash, all but the one with the
+# shortest heading (the first one on ties) of each are duplicates.
+_DUPLICATE_CONTENT = "select rowid from (select rowid, row_number() over (partition by poemHash order by length(heading), rowid) as rank from fetched_content where poemHash is not null) where rank > 1"
+
+
+# Writes are either committed one row at a time or, with batch_writes, grouped
+# into a transaction which is committed by flush(), or once max_batch_rows rows
+# or max_batch_ms milliseconds have been buffered. Buffered writes are visible
+# to reads on this UrlDb but not to other connections until flushed.
+#
+# Crash safety: a batch is a single sqlite transaction, so a crash loses the
+# whole of the unflushed batch or none of it, never a part. The crawler
+# flushes once per page, so a lost batch only means those pages get crawled
+# again. In WAL mode with synchronous=NORMAL a flushed batch survives a
+# process crash, a power loss may roll back the last few flushed batches but
+# never corrupts the db.
+#
+# With a writer (db/db_writer.py) the writes are instead queued to the one
+# connection of the writer, which every UrlDb of the process shares, and this
+# UrlDb only reads, on a read only connection. Writes return once queued and
+# flush() waits for them to be committed. Reads first wait for the writes
+# queued by this UrlDb, so they are visible to it as in batch_writes mode.
 class UrlDb:
     _conn = None
+    _batch_writes = False
+    _max_batch_rows = 0
+    _max_batch_ms = 0
+    _batch_rows = 0
+    _batch_start = None
+    _membership = None
+    _writer = None
+    # Futures of the writes queued to _writer since the last flush()
+    _pending_writes = None
 
-    def __init__(self, db_path):
+    # membership is an optional db.membership.UrlMembership which answers most
+    # of is_seen and is_forbidden without querying sqlite. It is updated by
+    # the UrlDb of the writer, if any. timeout is how long a write waits for
+    # other connections to release the db.
+    def __init__(self,
+                 db_path,
+                 batch_writes=False,
+                 max_batch_rows=1000,
+                 max_batch_ms=1000,
+                 wal=True,
+                 membership=None,
+                 timeout=5.0,
+                 writer=None):
         try:
+            if writer is not None:
+                db_path = "file:%s?mode=ro" % urllib.request.pathname2url(
+                    os.path.abspath(db_path))
             # PARSE_DECLTYPES for parsing dates as python format
             self._conn = sqlite3.connect(db_path,
-                                         detect_types=sqlite3.PARSE_DECLTYPES)
+                                         timeout=timeout,
+                                         detect_types=sqlite3.PARSE_DECLTYPES,
+                                         uri=writer is not None)
+            if wal and writer is None:
+                self._conn.execute("pragma journal_mode = wal;")
+                self._conn.execute("pragma synchronous = normal;")
+            self._conn.execute("pragma temp_store = memory;")
+            # In KiB when negative, ie. 64MB of page cache.
+            self._conn.execute("pragma cache_size = -65536;")
         except sqlite3.OperationalError as e:
             logging.critical("Initializing DB module failed: %s", e)
             sys.exit("DB connection error. Aborting")
+        self._batch_writes = batch_writes
+        self._max_batch_rows = max_batch_rows
+        self._max_batch_ms = max_batch_ms
+        self._membership = membership
+        self._writer = writer
+        self._pending_writes = []
+        version = self.get_schema_version()
+        if version < SCHEMA_VERSION and len(self._get_table_names()) > 0:
+            logging.warning(
+                "DB schema is at version %d, current is %d. Upgrade it "
+                "with tools/migrate_db.py", version, SCHEMA_VERSION)
 
     def add_seen_url(self, url, seen_time=None, crawl_time=None):
-        curr = self._conn.cursor()
+        if self._writer is not None:
+            return self._write("add_seen_url", url, seen_time, crawl_time)
+        curr = self._cursor()
         # seen_time can be the same as add time but the crawl time need to be provided by caller
         if seen_time is None:
             seen_time = datetime.datetime.now().isoformat()
         logging.debug("Inserting seen url: %s %s", url, seen_time)
         try:
-            curr.execute("insert into seen_urls values(?, ?, ?);",
+            curr.execute("insert or ignore into seen_urls values(?, ?, ?);",
                          (url, seen_time, crawl_time))
-            self._conn.commit()
+            self._commit()
+        except sqlite3.OperationalError as e:
+            logging.critical("Writing to DB failed %s", e)
+            return False
+        if self._membership is not None:
+            self._membership.seen.add(url)
+        return True
+
+    # Adds all of urls in one statement. Returns False if none could be added.
+    # priorities, if given, are those of urls in the frontier, see
+    # crawler/link_scorer.py.
+    def add_seen_urls(self, urls, seen_time=None, priorities=None):
+        if self._writer is not None:
+            return self._write("add_seen_urls", urls, seen_time, priorities)
+        curr = self._cursor()
+        if seen_time is None:
+            seen_time = datetime.datetime.now().isoformat()
+        logging.debug("Inserting %d seen urls", len(urls))
+        try:
+            curr.executemany(
+                "insert or ignore into seen_urls values(?, ?, ?);",
+                [(url, seen_time, None) for url in urls])
+            if priorities is not None:
+                # The urls were added to pending_urls by its trigger
+                curr.executemany(
+                    "update pending_urls set priority = (?) where url = (?);",
+                    zip(priorities, urls))
+            self._commit(len(urls))
         except sqlite3.OperationalError as e:
             logging.critical("Writing to DB failed %s", e)
             return False
+        if self._membership is not None:
+            for url in urls:
+                self._membership.seen.add(url)
         return True
 
     def add_crawled_url(self, url, seen_time=None, crawl_time=None):
-        curr = self._conn.cursor()
+        if self._writer is not None:
+            return self._write("add_crawled_url", url, seen_time, crawl_time)
+        curr = self._cursor()
         if crawl_time is None:
             crawl_time = datetime.datetime.now().isoformat()
         logging.debug("Inserting crawled url: %s %s", url, crawl_time)
         try:
-            curr.execute("insert into crawled_urls values(?, ?, ?);",
-                         (url, seen_time, crawl_time))
-            self._conn.commit()
+            # A revisit updates the crawl time
+            curr.execute(
+                "insert or replace into crawled_urls values(?, ?, ?);",
+                (url, seen_time, crawl_time))
+            self._commit()
         except sqlite3.OperationalError as e:
             logging.critical("Writing to crawled DB failed with: %s", e)
             return False
         return True
 
     def add_fetched_content(self, url, heading, headingHash, poem, poemHash):
-        curr = self._conn.cursor()
+        if self._writer is not None:
+            return self._write("add_fetched_content", url, heading,
+                               headingHash, poem, poemHash)
+        curr = self._cursor()
         if poem is None or heading is None:
             logging.debug("Both of heading or poem should be available: %s",
                           url)
             return False
         logging.debug("Inserting fetched content url: %s", url)
         try:
-            curr.execute("insert into fetched_content values(?, ?, ?, ?, ?);",
-                         (url, heading, poem, headingHash, poemHash))
-            self._conn.commit()
+            curr.execute(
+                "insert or ignore into fetched_content values(?, ?, ?, ?, ?);",
+                (url, heading, poem, headingHash, poemHash))
+            self._commit()
         except sqlite3.OperationalError as e:
             logging.critical("Writing to content DB failed with: %s", e)
             return False
         return True
 
     def add_forbidden_url(self, url, seen_time=None):
-        curr = self._conn.cursor()
+        if self._writer is not None:
+            return self._write("add_forbidden_url", url, seen_time)
+        curr = self._cursor()
         # seen_time can be the same as add time but the crawl time need to be provided by caller
         if seen_time is None:
             seen_time = datetime.datetime.now().isoformat()
         logging.debug("Inserting forbidden url: %s %s", url, seen_time)
         try:
-            curr.execute("insert into forbidden_urls values(?, ?);", (
-                url,
-                seen_time,
-            ))
-            self._conn.commit()
+            curr.execute("insert or ignore into forbidden_urls values(?, ?);",
+                         (
+                             url,
+                             seen_time,
+                         ))
+            self._commit()
         except sqlite3.OperationalError as e:
             logging.critical("Writing to forbidden DB failed %s", e)
             return False
+        if self._membership is not None:
+            self._membership.forbidden.add(url)
         return True
 
     def remove_from_seen(self, url):
-        curr = self._conn.cursor()
+        if self._writer is not None:
+            return self._write("remove_from_seen", url)
+        curr = self._cursor()
         logging.debug("Removing url: %s", url)
         try:
             curr.execute("delete from seen_urls where url = (?);", (url, ))
-            self._conn.commit()
+            self._commit()
         except sqlite3.OperationalError as e:
             logging.critical("Removing from seen DB failed with: %s", e)
             return False
+        if self._membership is not None:
+            self._membership.seen.discard(url)
         return True
 
     def remove_from_crawled(self, url):
-        curr = self._conn.cursor()
+        if self._writer is not None:
+            return self._write("remove_from_crawled", url)
+        curr = self._cursor()
         logging.debug("Removing url: %s", url)
         try:
             curr.execute("delete from crawled_urls where url = (?);", (url, ))
-            self._conn.commit()
+            self._commit()
         except sqlite3.OperationalError as e:
             logging.critical("Removing from crawled DB failed with: %s", e)
             return False
         return True
 
     def remove_from_fetched(self, url):
-        curr = self._conn.cursor()
+        if self._writer is not None:
+            return self._write("remove_from_fetched", url)
+        curr = self._cursor()
         logging.debug("Removing url: %s", url)
         try:
             curr.execute("delete from fetched_content where url = (?);",
                          (url, ))
-            self._conn.commit()
+            self._commit()
         except sqlite3.OperationalError as e:
             logging.critical("Removing from fetched DB failed with: %s", e)
             return False
         return True
 
     def remove_from_forbidden(self, url):
-        curr = self._conn.cursor()
+        if self._writer is not None:
+            return self._write("remove_from_forbidden", url)
+        curr = self._cursor()
         logging.debug("Removing url: %s from forbidden_urls", url)
         try:
             curr.execute("delete from forbidden_urls where url = (?);",
                          (url, ))
-            self._conn.commit()
+            self._commit()
         except sqlite3.OperationalError as e:
             logging.critical("Removing from forbidden DB failed with: %s", e)
             return False
+        if self._membership is not None:
+            self._membership.forbidden.discard(url)
         return True
 
+    # Commits the writes buffered in batch_writes mode, or waits for the writer
+    # to commit the queued writes. Returns False if any of them failed.
+    def flush(self):
+        if self._writer is not None:
+            return self._wait_for_writes()
+        if self._batch_rows == 0:
+            return True
+        try:
+            self._conn.commit()
+        except sqlite3.OperationalError as e:
+            logging.critical("Committing %d buffered writes failed: %s",
+                             self._batch_rows, e)
+            return False
+        logging.debug("Committed %d buffered writes", self._batch_rows)
+        self._batch_rows = 0
+        self._batch_start = None
+        return True
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def _cursor(self):
+        if len(self._pending_writes) > 0:
+            self._wait_for_writes()
+        return self._conn.cursor()
+
+    # Queues a call of method with args to the UrlDb of the writer.
+    def _write(self, method, *args):
+        self._pending_writes.append(self._writer.submit(method, *args))
+        return True
+
+    # Same as _write(), for writes whose caller needs what method returned.
+    def _write_and_wait(self, method, *args):
+        self._wait_for_writes()
+        return self._writer.submit(method, *args).result()
+
+    def _wait_for_writes(self):
+        pending, self._pending_writes = self._pending_writes, []
+        failed = 0
+        for write in pending:
+            if write.result() is False:
+                failed += 1
+        if failed > 0:
+            logging.critical("%d of %d queued writes failed", failed,
+                             len(pending))
+        return failed == 0
+
+    def _commit(self, num_rows=1):
+        if not self._batch_writes:
+            self._conn.commit()
+            return
+        if self._batch_start is None:
+            self._batch_start = time.monotonic()
+        self._batch_rows += num_rows
+        if self._batch_rows >= self._max_batch_rows or (
+                time.monotonic() -
+                self._batch_start) * 1000 >= self._max_batch_ms:
+            self.flush()
+
     def is_seen(self, url):
         assert len(url) > 0
-        curr = self._conn.cursor()
+        if self._membership is not None:
+            known = self._membership.seen.lookup(url)
+            if known is not None:
+                return known
+        curr = self._cursor()
         logging.debug("Checking existence of url in seen_urls : %s", url)
         try:
             curr.execute("select url from seen_urls where url = (?);", (url, ))
@@ -135,11 +436,13 @@ class UrlDb:
             return False
         num_entries = len(curr.fetchall())
         logging.debug("Number of entries found: %d", num_entries)
+        if self._membership is not None:
+            self._membership.seen.record(url, num_entries > 0)
         return num_entries > 0
 
     def is_crawled(self, url):
         assert len(url) > 0
-        curr = self._conn.cursor()
+        curr = self._cursor()
         logging.debug("Checking for crawled url: %s", url)
         try:
             curr.execute("select url from crawled_urls where url = (?);",
@@ -151,7 +454,7 @@ class UrlDb:
 
     def is_content_fetched(self, url):
         assert len(url) > 0
-        curr = self._conn.cursor()
+        curr = self._cursor()
         logging.debug("Checking existence of url in fetched_content: %s", url)
         try:
             curr.execute("select url from fetched_content where url = (?);",
@@ -164,7 +467,11 @@ class UrlDb:
 
     def is_forbidden(self, url):
         assert len(url) > 0
-        curr = self._conn.cursor()
+        if self._membership is not None:
+            known = self._membership.forbidden.lookup(url)
+            if known is not None:
+                return known
+        curr = self._cursor()
         logging.debug("Checking existence of forbidden url: %s", url)
         try:
             curr.execute("select url from forbidden_urls where url = (?);",
@@ -172,11 +479,57 @@ class UrlDb:
         except sqlite3.InterfaceError as e:
             logging.critical("Checking %s in forbidden DB failed: %s ", url, e)
             return False
-        return len(curr.fetchall()) > 0
+        found = len(curr.fetchall()) > 0
+        if self._membership is not None:
+            self._membership.forbidden.record(url, found)
+        return found
+
+    # Returns (etag, last_modified, content_hash, first_crawl_time,
+    # num_changes) of a crawled url or None.
+    def read_crawl_state(self, url):
+        curr = self._cursor()
+        try:
+            curr.execute(
+                "select etag, last_modified, content_hash, first_crawl_time, num_changes from crawl_state where url = (?);",
+                (url, ))
+        except sqlite3.OperationalError as e:
+            logging.critical("Reading crawl state of %s failed: %s", url, e)
+            return None
+        return curr.fetchone()
+
+    def update_crawl_state(self, url, etag, last_modified, content_hash,
+                           changed, crawl_time, next_crawl_time):
+        if self._writer is not None:
+            return self._write("update_crawl_state", url, etag, last_modified,
+                               content_hash, changed, crawl_time,
+                               next_crawl_time)
+        curr = self._cursor()
+        try:
+            curr.execute(
+                "insert into crawl_state values(?, ?, ?, ?, ?, ?, ?, 1, 0) on conflict(url) do update set etag = coalesce(excluded.etag, etag), last_modified = coalesce(excluded.last_modified, last_modified), content_hash = coalesce(excluded.content_hash, content_hash), last_crawl_time = excluded.last_crawl_time, next_crawl_time = excluded.next_crawl_time, num_checks = num_checks + 1, num_changes = num_changes + (?);",
+                (url, etag, last_modified, content_hash,
+                 crawl_time.isoformat(), crawl_time.isoformat(),
+                 next_crawl_time.isoformat(), 1 if changed else 0))
+            self._commit()
+        except sqlite3.OperationalError as e:
+            logging.critical("Writing crawl state of %s failed: %s", url, e)
+            return False
+        return True
+
+    def is_due_for_recrawl(self, url):
+        curr = self._cursor()
+        try:
+            curr.execute(
+                "select 1 from crawl_state where url = (?) and next_crawl_time <= (?);",
+                (url, datetime.datetime.now().isoformat()))
+        except sqlite3.OperationalError as e:
+            logging.critical("Checking crawl state of %s failed: %s", url, e)
+            return False
+        return curr.fetchone() is not None
 
     def read_fetched_content(self, url, max_to_read=1):
         assert len(url) > 0
-        curr = self._conn.cursor()
+        curr = self._cursor()
         logging.debug("Reading of url: %s", url)
         try:
             curr.execute(
@@ -189,7 +542,7 @@ class UrlDb:
 
     def read_seen_url(self, url, max_to_read=1):
         assert len(url) > 0
-        curr = self._conn.cursor()
+        curr = self._cursor()
         logging.debug("Reading of url: %s", url)
         try:
             curr.execute("select * from seen_urls where url = (?) limit (?);",
@@ -201,7 +554,7 @@ class UrlDb:
 
     def read_crawled_url(self, url, max_to_read=1):
         assert len(url) > 0
-        curr = self._conn.cursor()
+        curr = self._cursor()
         logging.debug("Reading of url: %s", url)
         try:
             curr.execute(
@@ -212,9 +565,133 @@ class UrlDb:
             return None
         return curr.fetchall()
 
+    # Returns the number of rows with a poemHash in fetched_content, the
+    # number of distinct poemHashes and how many of them repeat.
+    def get_duplicate_content_plan(self):
+        curr = self._cursor()
+        try:
+            curr.execute(
+                "select count(*), count(distinct poemHash) from fetched_content where poemHash is not null;"
+            )
+            num_rows, num_hashes = curr.fetchone()
+            curr.execute(
+                "select count(*) from (select 1 from fetched_content where poemHash is not null group by poemHash having count(*) > 1);"
+            )
+            num_repeated = curr.fetchone()[0]
+        except sqlite3.OperationalError as e:
+            logging.critical(
+                "Planning the dedup of fetched_content failed: %s", e)
+            return None
+        return num_rows, num_hashes, num_repeated
+
+    # Deletes the duplicates of _DUPLICATE_CONTENT in one transaction. Returns
+    # the number of rows deleted or -1.
+    def remove_duplicate_content(self):
+        if self._writer is not None:
+            return self._write_and_wait("remove_duplicate_content")
+        curr = self._cursor()
+        try:
+            curr.execute("delete from fetched_content where rowid in (%s);" %
+                         _DUPLICATE_CONTENT)
+            num_removed = curr.rowcount
+            self._conn.commit()
+        except sqlite3.OperationalError as e:
+            logging.critical("Removing duplicate content failed: %s", e)
+            self._conn.rollback()
+            return -1
+        logging.info("Removed %d duplicate rows from fetched_content",
+                     num_removed)
+        return num_removed
+
+    # Indexes the signature (bytes) of the poem of url under buckets, its
+    # (band, bucket) pairs, replacing what was indexed for url before.
+    def add_poem_signature(self, url, signature, buckets):
+        if self._writer is not None:
+            return self._write("add_poem_signature", url, signature, buckets)
+        curr = self._cursor()
+        logging.debug("Inserting poem signature of url: %s", url)
+        try:
+            curr.execute("delete from poem_lsh where url = (?);", (url, ))
+            curr.execute(
+                "insert or replace into poem_signatures values(?, ?);",
+                (url, signature))
+            curr.executemany("insert into poem_lsh values(?, ?, ?);",
+                             [(band, bucket, url) for band, bucket in buckets])
+            self._commit(1 + len(buckets))
+        except sqlite3.OperationalError as e:
+            logging.critical("Writing signature of %s failed with: %s", url, e)
+            return False
+        return True
+
+    # Returns the dict of url to signature of those of urls which have one.
+    def read_poem_signatures(self, urls):
+        curr = self._cursor()
+        signatures = {}
+        # Stays under the default limit of 999 sqlite variables
+        for start in range(0, len(urls), 500):
+            chunk = urls[start:start + 500]
+            try:
+                curr.execute(
+                    "select url, signature from poem_signatures where url in (%s);"
+                    % ", ".join("?" * len(chunk)), chunk)
+            except sqlite3.OperationalError as e:
+                logging.critical("Reading poem signatures failed: %s", e)
+                return signatures
+            signatures.update(curr.fetchall())
+        return signatures
+
+    # Returns the set of urls indexed under any of buckets.
+    def find_lsh_candidates(self, buckets):
+        if len(buckets) == 0:
+            return set()
+        curr = self._cursor()
+        try:
+            curr.execute(
+                "select distinct url from poem_lsh where %s;" %
+                " or ".join(["(band = ? and bucket = ?)"] * len(buckets)),
+                [value for bucket in buckets for value in bucket])
+        except sqlite3.OperationalError as e:
+            logging.critical("Looking up lsh buckets failed: %s", e)
+            return set()
+        return set(row[0] for row in curr.fetchall())
+
+    # Yields the list of urls of each lsh bucket holding more than one,
+    # reading one bucket at a time.
+    def iterate_lsh_buckets(self):
+        curr = self._cursor()
+        try:
+            curr.execute(
+                "select band, bucket, url from poem_lsh where (band, bucket) in (select band, bucket from poem_lsh group by band, bucket having count(*) > 1) order by band, bucket;"
+            )
+        except sqlite3.OperationalError as e:
+            logging.critical("Reading lsh buckets failed: %s", e)
+            return
+        key, urls = None, []
+        for band, bucket, url in curr:
+            if (band, bucket) != key:
+                if len(urls) > 1:
+                    yield urls
+                key, urls = (band, bucket), []
+            urls.append(url)
+        if len(urls) > 1:
+            yield urls
+
+    # Returns up to max_to_read (rowid, url, poem) of fetched_content with no
+    # poem signature, with rowids above after_rowid in increasing order.
+    def read_unsigned_content(self, after_rowid=0, max_to_read=1000):
+        curr = self._cursor()
+        try:
+            curr.execute(
+                "select rowid, url, poem from fetched_content f where rowid > (?) and not exists (select 1 from poem_signatures s where s.url = f.url) order by rowid limit (?);",
+                (after_rowid, max_to_read))
+        except sqlite3.OperationalError as e:
+            logging.critical("Reading unsigned content failed: %s", e)
+            return None
+        return curr.fetchall()
+
     def get_matching_content(self, poemHash):
         assert poemHash is not None
-        curr = self._conn.cursor()
+        curr = self._cursor()
         logging.debug("Getting matching content for: %s", poemHash)
         try:
             curr.execute(
@@ -242,7 +719,7 @@ class UrlDb:
         if order == "random":
             logging.info("Fetching %d urls from seen_urls in random order",
                          max_to_fetch)
-        curr = self._conn.cursor()
+        curr = self._cursor()
         try:
             if order == "seen_time":
                 curr.execute(
@@ -268,7 +745,7 @@ class UrlDb:
     def read_from_crawled(self, max_url_time=None, max_to_fetch=100):
         if max_url_time is None:
             max_url_time = datetime.datetime.now().isoformat()
-        curr = self._conn.cursor()
+        curr = self._cursor()
         logging.info("Reading urls which were crawled before: %s",
                      max_url_time)
         try:
@@ -289,7 +766,7 @@ class UrlDb:
         return ret_val
 
     def read_from_fetched(self, max_to_fetch=100):
-        curr = self._conn.cursor()
+        curr = self._cursor()
         logging.info("Reading %d urls from fetched content table",
                      max_to_fetch)
         try:
@@ -307,7 +784,7 @@ class UrlDb:
         return ret_val
 
     def get_total_seen(self):
-        curr = self._conn.cursor()
+        curr = self._cursor()
         logging.debug("Checking total number of urls in the seen_urls DB")
         try:
             curr.execute("select count(*) from seen_urls;")
@@ -317,7 +794,7 @@ class UrlDb:
         return curr.fetchone()[0]
 
     def get_total_crawled(self):
-        curr = self._conn.cursor()
+        curr = self._cursor()
         logging.debug("Checking total number of urls in the crawled DB")
         try:
             curr.execute("select count(*) from crawled_urls;")
@@ -327,7 +804,7 @@ class UrlDb:
         return curr.fetchone()[0]
 
     def get_total_fetched(self):
-        curr = self._conn.cursor()
+        curr = self._cursor()
         logging.debug(
             "Checking total number of urls in the fetched contents DB")
         try:
@@ -337,8 +814,165 @@ class UrlDb:
             return -1
         return curr.fetchone()[0]
 
+    def get_total_forbidden(self):
+        curr = self._cursor()
+        logging.debug("Checking total number of urls in the forbidden DB")
+        try:
+            curr.execute("select count(*) from forbidden_urls;")
+        except sqlite3.OperationalError as e:
+            logging.critical("Checking total urls in DB failed: %s", e)
+            return -1
+        return curr.fetchone()[0]
+
+    # Yields every url in table without loading the table in memory.
+    def iterate_table_urls(self, table, batch_size=10000):
+        return self.iterate_table(table, batch_size)
+
+    # Yields the urls of table or, with full_rows, its rows, in rowid order.
+    # The table is read batch_size rows at a time, each batch by a query
+    # starting after the last rowid of the one before, so that a pass holds
+    # one batch in memory and no read transaction open between batches,
+    # whatever the size of the table. Rows may be written while iterating:
+    # those written behind the last rowid read are not seen, new rows are.
+    def iterate_table(self, table, batch_size=1000, full_rows=False):
+        assert batch_size > 0, batch_size
+        after_rowid = 0
+        while True:
+            rows = self.read_table_rows(table, after_rowid, batch_size,
+                                        full_rows)
+            if rows is None or len(rows) == 0:
+                return
+            after_rowid = rows[-1][0]
+            for row in rows:
+                yield row[1:] if full_rows else row[1]
+
+    # Returns up to max_to_read (rowid, url) or, with full_rows, (rowid, *row)
+    # of table with rowids above after_rowid, in rowid order.
+    def read_table_rows(self,
+                        table,
+                        after_rowid=0,
+                        max_to_read=1000,
+                        full_rows=True):
+        assert table in _TABLES, table
+        curr = self._cursor()
+        try:
+            curr.execute(
+                "select rowid, %s from %s where rowid > (?) order by rowid limit (?);"
+                % ("*" if full_rows else "url", table),
+                (after_rowid, max_to_read))
+        except sqlite3.OperationalError as e:
+            logging.critical("Reading rows from %s failed: %s", table, e)
+            return None
+        return curr.fetchall()
+
+    # A bulk repair of a table (see tools/db_cleaner.py --bulk) stages the new
+    # rows in <table>_repair, keyed by the rowid of the row they replace and
+    # with remove set for rows to drop, and apply_repair() swaps them in with
+    # set based statements in one transaction. Staged rows are committed
+    # along with the last rowid examined, so an interrupted repair resumes
+    # after it and the table itself is either repaired or untouched.
+    # Returns the last rowid examined, 0 for a new repair, or -1.
+    def start_repair(self, table):
+        if self._writer is not None:
+            return self._write_and_wait("start_repair", table)
+        assert table in _TABLES, table
+        curr = self._cursor()
+        try:
+            curr.execute(
+                "create table if not exists repair_progress(table_name text primary key, last_rowid integer);"
+            )
+            curr.execute(
+                "create table if not exists %s_repair(source_rowid integer primary key, remove integer, %s);"
+                % (table, ", ".join(self._get_column_names(table))))
+            self._conn.commit()
+            curr.execute(
+                "select last_rowid from repair_progress where table_name = (?);",
+                (table, ))
+        except sqlite3.OperationalError as e:
+            logging.critical("Starting the repair of %s failed: %s", table, e)
+            return -1
+        row = curr.fetchone()
+        return 0 if row is None else row[0]
+
+    # Stages changes, (source_rowid, remove, *row), and records the rows up to
+    # last_rowid as examined, in one transaction.
+    def stage_repair(self, table, changes, last_rowid):
+        if self._writer is not None:
+            return self._write_and_wait("stage_repair", table, changes,
+                                        last_rowid)
+        assert table in _TABLES, table
+        curr = self._cursor()
+        try:
+            if len(changes) > 0:
+                curr.executemany(
+                    "insert or replace into %s_repair values(%s);" %
+                    (table, ", ".join("?" * len(changes[0]))), changes)
+            curr.execute(
+                "insert or replace into repair_progress values(?, ?);",
+                (table, last_rowid))
+            self._conn.commit()
+        except sqlite3.OperationalError as e:
+            logging.critical("Staging the repair of %s failed: %s", table, e)
+            self._conn.rollback()
+            return False
+        return True
+
+    # Swaps the staged rows into table and drops the staging. Returns the
+    # number of rows removed and rewritten or None, when table is unchanged.
+    # A rewritten row replaces any other row with its new url, and of several
+    # rows rewritten to the same url the one with the highest rowid is kept.
+    def apply_repair(self, table):
+        if self._writer is not None:
+            return self._write_and_wait("apply_repair", table)
+        assert table in _TABLES, table
+        columns = ", ".join(self._get_column_names(table))
+        curr = self._cursor()
+        try:
+            curr.execute("begin;")
+            curr.execute(
+                "select coalesce(sum(remove), 0), count(*) from %s_repair;" %
+                table)
+            num_removed, num_staged = curr.fetchone()
+            curr.execute(
+                "delete from %s where rowid in (select source_rowid from %s_repair);"
+                % (table, table))
+            curr.execute(
+                "delete from %s where url in (select url from %s_repair where remove = 0);"
+                % (table, table))
+            curr.execute(
+                "insert or replace into %s select %s from %s_repair where remove = 0 order by source_rowid;"
+                % (table, columns, table))
+            curr.execute("drop table %s_repair;" % table)
+            curr.execute("delete from repair_progress where table_name = (?);",
+                         (table, ))
+            self._conn.commit()
+        except sqlite3.OperationalError as e:
+            logging.critical("Applying the repair of %s failed: %s", table, e)
+            self._conn.rollback()
+            return None
+        return num_removed, num_staged - num_removed
+
+    # Drops what was staged for the repair of table.
+    def discard_repair(self, table):
+        if self._writer is not None:
+            return self._write_and_wait("discard_repair", table)
+        assert table in _TABLES, table
+        curr = self._cursor()
+        try:
+            curr.execute("drop table if exists %s_repair;" % table)
+            if "repair_progress" in self._get_table_names():
+                curr.execute(
+                    "delete from repair_progress where table_name = (?);",
+                    (table, ))
+            self._conn.commit()
+        except sqlite3.OperationalError as e:
+            logging.critical("Discarding the repair of %s failed: %s", table,
+                             e)
+            return False
+        return True
+
     def get_tables(self):
-        c = self._conn.cursor()
+        c = self._cursor()
         try:
             c.execute("SELECT name FROM sqlite_master WHERE type='table';")
         except sqlite3.OperationalError as e:
@@ -349,28 +983,145 @@ class UrlDb:
         return tables
 
     def reset_tables(self):
-        c = self._conn.cursor()
+        c = self._cursor()
         try:
-            c.execute("drop table seen_urls;")
-            c.execute("drop table crawled_urls;")
-            c.execute("drop table fetched_content;")
+            c.execute("drop table if exists pending_urls;")
+            c.execute("drop table if exists crawl_state;")
+            c.execute("drop table if exists poem_signatures;")
+            c.execute("drop table if exists poem_lsh;")
+            for table in _TABLES:
+                c.execute("drop table if exists %s;" % table)
         except sqlite3.OperationalError as e:
             logging.error("Error while dropping tables. Continuing")
             pass
         try:
-            c.execute(
-                "create table seen_urls(url text, seen_time datetime, crawl_time datetime);"
-            )
-            c.execute(
-                "create table crawled_urls(url text, seen_time datetime, crawl_time datetime);"
-            )
-            c.execute(
-                "create table forbidden_urls(url text, seen_time datetime);")
-            c.execute(
-                "create table fetched_content(url text, heading text, poem text, headingHash text, poemHash text);"
-            )
+            for create in _TABLES.values():
+                c.execute(create)
+            for index in _INDEXES:
+                c.execute(index)
+            for statement in (_FRONTIER_SCHEMA + _RECRAWL_SCHEMA +
+                              _NEAR_DUP_SCHEMA):
+                c.execute(statement)
+            c.execute("pragma user_version = %d;" % SCHEMA_VERSION)
         except sqlite3.OperationalError as e:
             logging.critical("Resetting the tables failed: %s", e)
             return False
         logging.info("Successfully reset the tables")
         return True
+
+    def get_schema_version(self):
+        return self._conn.execute("pragma user_version;").fetchone()[0]
+
+    # Returns the number of rows and of distinct urls in each of the tables
+    # which upgrade_schema rewrites.
+    def get_upgrade_plan(self):
+        existing = self._get_table_names()
+        plan = {}
+        for table in _TABLES:
+            if table not in existing:
+                plan[table] = (0, 0)
+                continue
+            plan[table] = self._conn.execute(
+                "select count(*), count(distinct url) from %s;" %
+                table).fetchone()
+        return plan
+
+    # Moves an older db to SCHEMA_VERSION in place, in a single transaction.
+    # Rows repeating a url are dropped as per _DEDUP_ORDER.
+    def upgrade_schema(self):
+        version = self.get_schema_version()
+        if version == SCHEMA_VERSION:
+            logging.info("DB schema is already at version %d", version)
+            return True
+        assert version < SCHEMA_VERSION, version
+        existing = self._get_table_names()
+        c = self._cursor()
+        try:
+            c.execute("begin;")
+            if version < 1:
+                for table, create in _TABLES.items():
+                    if table not in existing:
+                        c.execute(create)
+                        continue
+                    c.execute("alter table %s rename to %s_v0;" %
+                              (table, table))
+                    c.execute(create)
+                    c.execute(
+                        "insert or ignore into %s select * from %s_v0 order by %s;"
+                        % (table, table, _DEDUP_ORDER[table]))
+                    c.execute("drop table %s_v0;" % table)
+                for index in _INDEXES:
+                    c.execute(index)
+            if version < 2:
+                # Leases used to be kept in a table of their own.
+                c.execute("drop table if exists url_leases;")
+                for statement in _FRONTIER_SCHEMA:
+                    c.execute(statement)
+                c.execute(_FRONTIER_FILL)
+            if version < 3:
+                for statement in _RECRAWL_SCHEMA:
+                    c.execute(statement)
+                c.execute(_RECRAWL_BACKFILL)
+            if version < 4:
+                for statement in _NEAR_DUP_SCHEMA:
+                    c.execute(statement)
+            if version >= 2 and version < 5:
+                # Made with the priority column otherwise
+                for statement in _FRONTIER_PRIORITY_UPGRADE:
+                    c.execute(statement)
+            c.execute("pragma user_version = %d;" % SCHEMA_VERSION)
+            self._conn.commit()
+        except sqlite3.OperationalError as e:
+            logging.critical("Upgrading the schema failed: %s", e)
+            self._conn.rollback()
+            return False
+        logging.info("Upgraded DB schema from version %d to %d", version,
+                     SCHEMA_VERSION)
+        return True
+
+    # Adds the rows of the db at shard_path, which has to be at SCHEMA_VERSION,
+    # in a single transaction. Returns the number of rows added to each table
+    # or None if the merge failed.
+    def merge_from(self, shard_path):
+        assert self._writer is None
+        self.flush()
+        added = {}
+        try:
+            self._conn.execute("attach database (?) as shard;", (shard_path, ))
+        except sqlite3.OperationalError as e:
+            logging.critical("Attaching %s failed: %s", shard_path, e)
+            return None
+        try:
+            version = self._conn.execute(
+                "pragma shard.user_version;").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                logging.critical(
+                    "%s is at schema version %d, current is %d. Upgrade it "
+                    "with tools/migrate_db.py", shard_path, version,
+                    SCHEMA_VERSION)
+                return None
+            c = self._cursor()
+            c.execute("begin;")
+            for table, statement in _MERGE:
+                c.execute(statement)
+                added[table] = c.rowcount
+            self._conn.commit()
+        except sqlite3.OperationalError as e:
+            logging.critical("Merging %s failed: %s", shard_path, e)
+            self._conn.rollback()
+            return None
+        finally:
+            self._conn.execute("detach database shard;")
+        return added
+
+    def _get_column_names(self, table):
+        return [
+            row[1]
+            for row in self._conn.execute("pragma table_info(%s);" % table)
+        ]
+
+    def _get_table_names(self):
+        return [
+            row[0] for row in self._conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table';")
+        ]
@@ -1,33 +1,150 @@
 import argparse
+import asyncio
+import collections
 import concurrent.futures
+import datetime
+import functools
 import hashlib
 import logging
-import random
+import os
+import queue
+import threading
+import time
 
-from crawler.crawler import UrlCrawler
+from crawler.crawler import UrlCrawler, make_pool
+from crawler.host_limiter import HostScheduler
+from crawler.link_scorer import INDEX_PAGE, POEM_PAGE, LinkScorer
+from crawler import page_processor
+from crawler.metrics import CrawlMetrics
+from crawler.page_processor import PageProcessor
+from crawler.sharding import ShardRouter
+from crawler.recrawl import RecrawlPolicy
+from crawler.url_filter import DEFAULT_CONFIG, UrlFilter
+from db.db_writer import DbWriter
+from db.frontier import CrawlBudget, UrlFrontier
+from db.membership import UrlMembership
+from db.near_dup import NearDupIndex, numpy
+from db.page_archive import CODECS, PageArchive, zstandard
 from db.url_db import UrlDb
-from url_parser.url_parser import UrlParser
+from url_parser.url_parser import BACKENDS, lxml
+
+# How long a worker waits for other workers to add urls to the frontier or
+# release their share of the budget.
+_FRONTIER_POLL_SECONDS = 0.5
+
+# Longest a url found for another shard waits to be sent to it.
+_SHARD_FLUSH_SECONDS = 1.0
+
+# How often the pipeline logs the depths of its stages.
+_DEPTH_LOG_SECONDS = 10
+
 
 class CrawlDriver:
     _db = None
     _base_url = None
-    _parser = None
+    _processor = None
     _crawler = None
-    _max_urls_to_process = 0
+    _url_filter = None
+    _frontier = None
+    _budget = None
     _urls_processed = 0
     _content_fetched_urls = 0
     _only_base_domain_urls = False
     _dropped_urls = 0
     _total_visited = 0
     _no_contents = 0
+    _not_modified = 0
+    _unchanged = 0
+    _start_time = 0
+    _recrawl = False
+    _recrawl_policy = None
+    _archive = None
+    _near_dups = None
+    _near_duplicates = 0
+    _metrics = None
+    _scheduler = None
+    _fetch_timeout = 0
+    _canonicalize_cache_size = 0
+    _num_deferred = 0
+    # Url to the number of times its fetch was deferred
+    _deferrals = None
+    _max_deferrals = 0
+    _defer_seconds = 0
+    _pool = None
+    _wire_bytes = 0
+    _decoded_bytes = 0
+    _max_page_bytes = 0
+    _stream_parse = False
+    _scorer = None
+    _num_fetches = 0
+    _shards = None
 
-    def __init__(self, flags):
-        self._db = UrlDb(flags['db_path'])
-        self._crawler = UrlCrawler(flags['base_domain'])
-        self._parser = UrlParser()
+    # budget is shared by all the drivers of a crawl, by default each driver
+    # gets its own of max_urls_to_process. membership, if given, is the
+    # UrlMembership shared by all the drivers of the process, archive, if
+    # given, the PageArchive the fetched pages are kept in, writer, if given,
+    # the DbWriter all the db writes go through, metrics, if given, the
+    # CrawlMetrics of the crawl, scheduler, if given, the HostScheduler pacing
+    # the fetches of all the drivers of the process, pool, if given, the
+    # connection pool they share (see crawler/crawler.py#make_pool), scorer,
+    # if given, the LinkScorer setting the priority of new urls and shards, if
+    # given, the ShardRouter of the shard of a sharded crawl the process runs.
+    def __init__(self,
+                 flags,
+                 budget=None,
+                 membership=None,
+                 archive=None,
+                 writer=None,
+                 metrics=None,
+                 scheduler=None,
+                 pool=None,
+                 scorer=None,
+                 shards=None):
+        self._db = UrlDb(flags['db_path'],
+                         batch_writes=flags['batch_writes'],
+                         membership=membership,
+                         writer=writer)
+        self._crawler = UrlCrawler(flags['base_domain'],
+                                   flags['canonicalize_cache_size'], metrics,
+                                   scheduler, flags['fetch_timeout'], pool,
+                                   flags['max_page_bytes'])
+        self._processor = PageProcessor(flags['base_domain'],
+                                        flags['parser_backend'],
+                                        flags['url_filter_config'],
+                                        flags['only_include_base_domain_urls'],
+                                        flags['canonicalize_cache_size'])
+        self._url_filter = UrlFilter.from_file(flags['url_filter_config'])
+        self._frontier = UrlFrontier(flags['db_path'],
+                                     flags['lease_seconds'],
+                                     order=flags['frontier_order'])
+        if metrics is not None:
+            self._db = metrics.instrument(self._db, metrics.db_seconds)
+            self._frontier = metrics.instrument(self._frontier,
+                                                metrics.frontier_seconds)
+        self._metrics = metrics
+        self._scheduler = scheduler
+        self._pool = pool
+        self._max_page_bytes = flags['max_page_bytes']
+        self._stream_parse = flags['stream_parse']
+        self._scorer = scorer
+        self._shards = shards
+        self._fetch_timeout = flags['fetch_timeout']
+        self._canonicalize_cache_size = flags['canonicalize_cache_size']
+        self._deferrals = {}
+        self._max_deferrals = flags['max_deferrals']
+        self._defer_seconds = flags['defer_seconds']
+        self._budget = budget if budget is not None else CrawlBudget(
+            flags['max_urls_to_process'])
         self._base_url = flags['base_domain']
-        self._max_urls_to_process = flags['max_urls_to_process']
+        self._recrawl = flags['recrawl']
+        self._recrawl_policy = RecrawlPolicy(flags['min_recrawl_days'],
+                                             flags['initial_recrawl_days'],
+                                             flags['max_recrawl_days'])
         self._only_base_domain_urls = flags['only_include_base_domain_urls']
+        self._archive = archive
+        if flags['near_duplicates']:
+            self._near_dups = NearDupIndex(
+                self._db, threshold=flags['near_duplicate_threshold'])
 
     # We start with the base_url as the base crawl point and go from there
     # Steps in the flow
@@ -35,132 +152,703 @@ class CrawlDriver:
     # b. Fetch the url, update it in the Db
     # c. Get all the links from the page and insert all of them
     #        in the db (which do not already exist and matches the base domain)
-    # d. Read the db and fetch more
+    # d. Claim a batch of urls from the frontier and fetch more
     def run(self):
+        self._start_time = time.monotonic()
         logging.info("Total URLs in the DB: %d", self._db.get_total_seen())
-        urls = [self._base_url]
+        self._add_base_url()
+        num_new = 0
+        urls = collections.deque()
+        while not self._budget.is_exhausted():
+            if len(urls) == 0:
+                urls = self._get_seen_urls(100)
+                if len(urls) == 0:
+                    if self._is_crawl_finished():
+                        break
+                    # Other workers may still add urls to the frontier.
+                    time.sleep(_FRONTIER_POLL_SECONDS)
+                    continue
+            while len(urls) > 0 and self._budget.reserve():
+                num_new += self._process_claimed_url(urls.popleft())
+            if len(urls) > 0:
+                # Other workers hold the remaining budget.
+                time.sleep(_FRONTIER_POLL_SECONDS)
+        self._db.flush()
+        self._frontier.release_all()
+        self._print_summary(num_new)
+
+    # The crawl starts from the base url, on the shard which owns it if
+    # sharded.
+    def _add_base_url(self):
+        if self._shards is not None and not self._shards.owns(
+                self._crawler.canonicalize_url(self._base_url)):
+            return
         if not self._db.is_seen(self._base_url):
             self._db.add_seen_url(self._base_url)
-        num_new = 0
-        while len(
-                urls) > 0 and self._urls_processed < self._max_urls_to_process:
-            for u in urls:
-                if self._urls_processed > self._max_urls_to_process:
-                    logging.debug("Max number of URLs processed. Skipping.")
-                    break
-                num_new += self._process_url(u)
-            urls = self._get_seen_urls(100)
-            random.shuffle(urls)
+            self._db.flush()
+
+    # True if no more urls can show up in the frontier, once it has none left
+    # to claim: no other worker holds a lease and, if sharded, no other shard
+    # can send any.
+    def _is_crawl_finished(self):
+        if self._frontier.has_active_leases():
+            return False
+        return self._shards is None or self._shards.is_finished()
+
+    # Processes a url leased from the frontier with a reserved budget slot.
+    def _process_claimed_url(self, url):
+        processed, deferred = self._urls_processed, self._num_deferred
+        num_new = self._process_url(url)
+        self._finish_claimed_url(url, self._urls_processed > processed,
+                                 self._num_deferred > deferred)
+        return num_new
+
+    # A deferred url goes back to the frontier to be claimed again after
+    # --defer_seconds.
+    def _finish_claimed_url(self, url, counted, deferred=False):
+        # Writes for the url have to be visible to other workers before its
+        # lease is dropped, else they could claim it again.
+        self._db.flush()
+        if deferred:
+            self._frontier.defer(url, self._defer_seconds)
+        else:
+            self._frontier.complete(url)
+        if counted:
+            self._budget.commit()
+        else:
+            self._budget.release()
+
+    def _print_summary(self, num_new):
+        elapsed = time.monotonic() - self._start_time
         logging.info("Total URLs in the DB: %d", self._db.get_total_seen())
-        print("Total visited: ", self._total_visited, ", num new urls found: ",
-              num_new, "  num fetched: ", self._content_fetched_urls,
-              ", no contents: ", self._no_contents)
+        print(
+            "Total visited: ", self._total_visited, ", num new urls found: ",
+            num_new, "  num fetched: ", self._content_fetched_urls,
+            ", no contents: ", self._no_contents, ", not modified: ",
+            self._not_modified, ", unchanged: ", self._unchanged,
+            ", near duplicates: ", self._near_duplicates, ", deferred: ",
+            self._num_deferred, ", bytes on wire/decoded: ",
+            "%d/%d" % (self._wire_bytes, self._decoded_bytes),
+            ", poems per 1000 fetches: ",
+            round(
+                self._content_fetched_urls * 1000 / max(self._num_fetches, 1),
+                1), ", pages/sec: ",
+            round(self._urls_processed / max(elapsed, 1e-6), 2))
+        logging.info("Url canonicalization cache: %s",
+                     self._processor.get_canonicalize_stats())
+        if self._scheduler is not None:
+            logging.info("Host limits: %s", self._scheduler.get_stats())
+        if self._scorer is not None:
+            logging.info("Link scores: %s", self._scorer.get_stats())
+        if self._shards is not None:
+            logging.info("Shard: %s", self._shards.get_stats())
 
     def _process_url(self, url):
+        url = self._pre_process_url(url)
+        if url is None:
+            return 0
+        state = self._db.read_crawl_state(url)
+        etag, last_modified = self._get_validators(state)
+        feed = None
+        # A page crawled before may turn out unchanged, which needs no parsing
+        if self._stream_parse and state is None:
+            feed = self._processor.start_page()
+        fetched = self._crawler.fetch(url, etag, last_modified,
+                                      None if feed is None else feed.feed)
+        return self._post_process_url(url, self._crawler, fetched, feed)
+
+    # Returns the canonical form of url if it needs to be fetched, else None.
+    def _pre_process_url(self, url):
         self._total_visited += 1
         url = self._crawler.canonicalize_url(url)
         logging.info("Processing url: %s", url)
 
-        # TODO: This should check for the time when this was crawled eg. is_recently_crawled(url)
-        if not self._should_crawl_url(url) or self._db.is_crawled(
-                url) or self._db.is_forbidden(url):
+        if not self._url_filter.should_crawl(url) or self._db.is_forbidden(
+                url) or (self._db.is_crawled(url)
+                         and not (self._recrawl
+                                  and self._db.is_due_for_recrawl(url))):
             logging.debug("Url crawled or invalid. Skipping.")
+            return None
+        return url
+
+    # Returns the etag and last modified validators to fetch a url with, of
+    # its state, see UrlDb.read_crawl_state().
+    def _get_validators(self, state):
+        if state is None:
+            return None, None
+        return state[0], state[1]
+
+    # Updates the db with the result of crawler.fetch(url) and returns the
+    # number of new urls discovered from the page. feed, if given, is the
+    # PageFeed the page was parsed with as it was fetched.
+    def _post_process_url(self, url, crawler, fetched, feed=None):
+        url = self._accept_fetched(url, crawler, fetched)
+        if url is None:
             return 0
+        if feed is not None:
+            return self._store_page(url, self._parse_page(url, feed.close))
+        return self._store_page(
+            url,
+            self._parse_page(url, self._processor.process,
+                             crawler.get_contents()))
 
-        if not self._crawler.fetch(url) or self._crawler.get_contents() == '':
+    # Returns parse(*args), the ProcessedPage of url, or None if parsing it
+    # failed.
+    def _parse_page(self, url, parse, *args):
+        try:
+            return parse(*args)
+        except Exception as e:
+            logging.error("Parsing %s failed: %s", url, e)
+            return None
+
+    # Records the outcome of crawler.fetch(url) in the db. Returns the url the
+    # page is to be stored under or None if the page needs no processing.
+    def _accept_fetched(self, url, crawler, fetched):
+        self._num_fetches += 1
+        if not fetched and crawler.is_transient_failure() and self._defer(url):
+            logging.info("Deferring url: %s", url)
+            return None
+        if fetched and crawler.is_not_modified():
+            self._count_page("not_modified")
+            self._not_modified += 1
+            self._urls_processed += 1
+            self._record_crawl_state(url, crawler, None, False,
+                                     self._db.read_crawl_state(url))
+            return None
+        if not fetched or crawler.get_contents() == '':
             logging.info("Could not fetch base url: %s", url)
+            rejection = crawler.get_rejection()
+            self._count_page(rejection if rejection is not None else "failed")
+            self._observe_harvest(url, False)
             if self._db.remove_from_seen(url):
                 self._dropped_urls += 1
                 self._db.add_forbidden_url(url)
-            return 0
+            return None
+
+        self._wire_bytes += crawler.get_wire_bytes()
+        self._decoded_bytes += len(crawler.get_contents())
+        # A revisit of a page which did not change needs no parsing. Pages
+        # crawled before their hash was kept are processed again.
+        content_hash = hashlib.md5(crawler.get_contents()).hexdigest()
+        state = self._db.read_crawl_state(url)
+        known_hash = state is not None and state[2] is not None
+        changed = known_hash and state[2] != content_hash
+        self._record_crawl_state(url, crawler, content_hash, changed, state)
+        if known_hash and not changed:
+            logging.debug("Page did not change since last crawl: %s", url)
+            self._count_page("unchanged")
+            self._unchanged += 1
+            self._urls_processed += 1
+            return None
+        if state is not None:
+            logging.debug("Processing revisited page again: %s", url)
+            self._db.remove_from_fetched(url)
+        if self._archive is not None:
+            self._archive.put(url, crawler.get_contents(), content_hash)
 
         # If this was a redirect, then set to the actual url and add this to the seen table, if eligible
-        if self._crawler.is_redirect():
-            url = self._crawler.canonicalize_url(
-                self._crawler.get_fetched_url())
-            if self._only_base_domain_urls is False or self._crawler.is_from_base_domain(
+        if crawler.is_redirect():
+            url = crawler.canonicalize_url(crawler.get_fetched_url())
+            if self._only_base_domain_urls is False or crawler.is_from_base_domain(
                     url):
                 if not self._db.is_seen(url):
                     self._db.add_seen_url(url)
             else:
                 logging.debug("Skipping a non domain redirect url: ", url)
-                return 0
+                self._count_page("off_domain_redirect")
+                return None
+        return url
 
-        self._parser.set_data(self._crawler.get_contents())
+    # Returns True if url, whose fetch failed for now, is to be fetched again
+    # later rather than taken as failed, which it is after --max_deferrals.
+    def _defer(self, url):
+        num_deferrals = self._deferrals.get(url, 0)
+        if num_deferrals >= self._max_deferrals:
+            return False
+        self._deferrals[url] = num_deferrals + 1
+        self._count_page("deferred")
+        self._num_deferred += 1
+        return True
+
+    # Stores the ProcessedPage of url, None if it could not be parsed, and
+    # returns the number of new urls discovered from it.
+    def _store_page(self, url, page):
+        if self._metrics is not None and page is not None:
+            self._metrics.parse_seconds.observe(page.parse_seconds)
         # If fails, it's not a critical error to stop processing
         if not self._db.add_crawled_url(url):
             logging.critical("Adding %s to crawled db failed: ", url)
 
+        # A page which could not be parsed is not fetched again
+        if page is None:
+            self._count_page("parse_failed")
+            self._observe_harvest(url, False)
+            self._db.add_forbidden_url(url)
+            return 0
+
         # Update the db with the contents of this url.
         # If the URL is empty contents then skip it and add to forbidden
-        if self._process_content(url) is None:
+        if self._process_content(url, page) is None:
             logging.debug("Page is empty. Skipping collecting links.")
             self._db.add_forbidden_url(url)
             return 0
 
         # Counting a url which wasn't empty as processing it.
         self._urls_processed += 1
-        return self._add_new_seen_urls()
+        parent_kind = POEM_PAGE if page.poem is not None else INDEX_PAGE
+        if self._metrics is None:
+            return self._add_new_seen_urls(page.links, parent_kind)
+        start = time.perf_counter()
+        num_new = self._add_new_seen_urls(page.links, parent_kind)
+        self._metrics.link_discovery_seconds.observe(time.perf_counter() -
+                                                     start)
+        self._metrics.new_links.inc(amount=num_new)
+        return num_new
+
+    def _count_page(self, outcome):
+        if self._metrics is not None:
+            self._metrics.pages.inc(outcome)
+
+    # state is the crawl state of url before this fetch, if any.
+    def _record_crawl_state(self, url, crawler, content_hash, changed, state):
+        now = datetime.datetime.now()
+        first_crawl_time, num_changes = now, 0
+        if state is not None and state[3] is not None:
+            first_crawl_time = datetime.datetime.fromisoformat(state[3])
+            num_changes = state[4]
+        if changed:
+            num_changes += 1
+        self._db.update_crawl_state(
+            url, crawler.get_etag(), crawler.get_last_modified(), content_hash,
+            changed, now,
+            self._recrawl_policy.next_crawl_time(first_crawl_time, num_changes,
+                                                 now))
 
-    def _process_content(self, url):
+    def _process_content(self, url, page):
         assert not self._db.is_content_fetched(url), url
-        no_content = self._parser.find_element('div', 'class', 'noarticletext')
-        if no_content is not None:
+        self._observe_harvest(url, page.poem is not None)
+        if page.no_article_text:
+            self._count_page("no_content")
             self._no_contents += 1
             return None
-        heading = self._parser.find_element('h1', 'class', 'firstHeading')
-        poem = self._parser.find_element('div', 'class', 'poem')
-        if heading is None or poem is None or len(heading) == 0 or len(
-                poem) == 0:
+        if page.poem is None:
             logging.debug("Partial content. Skipping adding %s", url)
+            self._count_page("partial")
             return False
-        heading = self._parser.sanitize_text(heading)
-        poem = self._parser.sanitize_text(poem)
-        headingHash = hashlib.md5(heading.encode()).hexdigest()
-        poemHash = hashlib.md5(poem.encode()).hexdigest()
-        self._db.add_fetched_content(url, heading, headingHash, poem, poemHash)
+        self._db.add_fetched_content(url, *page.poem)
+        self._count_page("stored")
         self._content_fetched_urls += 1
+        if self._near_dups is not None:
+            similar = self._near_dups.add(url, page.poem.poem)
+            if len(similar) > 0:
+                logging.info("%s is a near duplicate of %s (%.2f)", url,
+                             *similar[0])
+                self._near_duplicates += 1
         return True
 
+    # Claims up to num_to_fetch urls, to be taken from the left in the order
+    # the frontier hands them out, eg. the revisits first.
     def _get_seen_urls(self, num_to_fetch=10):
-        return self._db.read_from_seen(max_to_fetch=num_to_fetch,
-                                       order="random")
-
-    # Static set of rules for some urls which need not be crawled.
-    @staticmethod
-    def _should_crawl_url(url):
-        # TODO: Make these comparisons case insensitive
-        return url.count(":Random") == 0 and url.count(
-            "MobileEditor"
-        ) == 0 and url.count("&printable") == 0 and url.count(
-            "oldid") == 0 and url.count("&search=") == 0 and url.count(
-                "&limit=") == 0 and url.count("action=") == 0 and url.count(
-                    "mobileaction"
-                ) == 0 and url.count("returnto") == 0 and url.count(
-                    "RecentChangesLinked"
-                ) == 0 and url.count("otherapps") == 0 and url.count(
-                    "hidelinks"
-                ) == 0 and url.count("hideredirs") == 0 and not url.startswith(
-                    "http://kavitakosh.org/share") and not url.startswith(
-                        "http://kavitakosh.org/kk/images")
-
-    def _add_new_seen_urls(self):
-        a_tags = self._parser.find_all("a")
-        logging.debug("All href links in the page %d", len(a_tags))
+        if self._shards is not None:
+            self._shards.flush(_SHARD_FLUSH_SECONDS)
+            self._shards.receive(self._add_forwarded_urls)
+        if self._recrawl:
+            self._frontier.schedule_due(num_to_fetch)
+        return collections.deque(self._frontier.claim(num_to_fetch))
+
+    # Teaches the scorer, if any, whether fetching url stored a poem.
+    def _observe_harvest(self, url, produced_poem):
+        if self._scorer is not None:
+            self._scorer.observe(url, produced_poem)
+
+    # Sends the links owned by other shards to them and returns the others.
+    def _forward_links(self, links, parent_kind):
+        local, foreign = [], []
+        for url in links:
+            (local if self._shards.owns(url) else foreign).append(url)
+        if len(foreign) > 0:
+            self._shards.forward(
+                foreign, None if self._scorer is None else
+                [self._scorer.score(url, parent_kind) for url in foreign])
+        return local
+
+    # Adds the urls other shards found for this one, with the priorities they
+    # scored them at.
+    def _add_forwarded_urls(self, urls, priorities):
+        new_urls, new_priorities = [], []
+        for url, priority in zip(urls, priorities):
+            if not self._db.is_seen(url) and not self._db.is_forbidden(url):
+                new_urls.append(url)
+                new_priorities.append(priority)
+        if len(new_urls) > 0:
+            self._db.add_seen_urls(
+                new_urls,
+                priorities=None if self._scorer is None else new_priorities)
+        # Visible to the other workers before the batch is gone
+        self._db.flush()
+
+    # links are canonical, filtered and without repeats, see
+    # crawler/page_processor.py. parent_kind is the kind of page they were
+    # found on, see crawler/link_scorer.py.
+    def _add_new_seen_urls(self, links, parent_kind):
+        logging.debug("All href links in the page %d", len(links))
+        if self._shards is not None:
+            links = self._forward_links(links, parent_kind)
+        new_urls = [
+            url for url in links
+            if not self._db.is_seen(url) and not self._db.is_forbidden(url)
+        ]
+        if len(new_urls) > 0 and self._scorer is not None:
+            self._db.add_seen_urls(new_urls,
+                                   priorities=self._scorer.score_links(
+                                       new_urls, parent_kind))
+        elif len(new_urls) > 0:
+            self._db.add_seen_urls(new_urls)
+        logging.debug("Number of new URLs found: %s", len(new_urls))
+        return len(new_urls)
+
+
+# Keeps up to max_in_flight fetches outstanding at a time. Fetches run on a
+# thread pool while parsing and all db access stay on the event loop thread, so
+# network wait overlaps with the processing of already fetched pages.
+class AsyncCrawlDriver(CrawlDriver):
+    _max_in_flight = 1
+    _in_flight = None
+
+    def __init__(self,
+                 flags,
+                 budget=None,
+                 membership=None,
+                 archive=None,
+                 writer=None,
+                 metrics=None,
+                 scheduler=None,
+                 pool=None,
+                 scorer=None,
+                 shards=None):
+        super().__init__(flags, budget, membership, archive, writer, metrics,
+                         scheduler, pool, scorer, shards)
+        self._max_in_flight = max(1, flags['max_in_flight'])
+        self._in_flight = set()
+
+    def run(self):
+        asyncio.run(self._run())
+
+    async def _run(self):
+        self._start_time = time.monotonic()
+        logging.info("Total URLs in the DB: %d", self._db.get_total_seen())
+        # Each in flight fetch gets its own crawler as UrlCrawler keeps the
+        # state of the last fetch.
+        crawlers = asyncio.Queue()
+        for _ in range(self._max_in_flight):
+            crawlers.put_nowait(
+                UrlCrawler(self._base_url,
+                           self._canonicalize_cache_size,
+                           metrics=self._metrics,
+                           scheduler=self._scheduler,
+                           timeout=self._fetch_timeout,
+                           pool=self._pool,
+                           max_page_bytes=self._max_page_bytes))
+        executor = concurrent.futures.ThreadPoolExecutor(self._max_in_flight)
+        self._add_base_url()
         num_new = 0
-        for a_tag in a_tags:
-            if a_tag.has_attr('href'):
-                url = self._crawler.canonicalize_url(a_tag['href'])
-                if self._should_crawl_url(url) and (
-                        self._only_base_domain_urls is False
-                        or self._crawler.is_from_base_domain(url)
-                ) and not self._db.is_seen(url) and not self._db.is_forbidden(
-                        url):
-                    self._db.add_seen_url(url)
-                    num_new += 1
-        logging.debug("Number of new URLs found: %s", num_new)
+        urls = collections.deque()
+        pending = set()
+        while True:
+            while len(urls) > 0 and len(
+                    pending) < self._max_in_flight and self._budget.reserve():
+                claimed = urls.popleft()
+                url = self._pre_process_url(claimed)
+                if url is None or url in self._in_flight:
+                    self._finish_claimed_url(claimed, False)
+                    continue
+                self._in_flight.add(url)
+                pending.add(
+                    asyncio.ensure_future(
+                        self._fetch_and_process(claimed, url, crawlers,
+                                                executor)))
+            if len(pending) == 0:
+                if self._budget.is_exhausted():
+                    break
+                if len(urls) == 0:
+                    urls = self._get_seen_urls(100)
+                    if len(urls) > 0:
+                        continue
+                    if self._is_crawl_finished():
+                        break
+                # Other workers hold the remaining budget or may still add
+                # urls to the frontier.
+                await asyncio.sleep(_FRONTIER_POLL_SECONDS)
+                continue
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                num_new += task.result()
+            if len(urls) == 0 and not self._budget.is_exhausted():
+                urls = self._get_seen_urls(100)
+        executor.shutdown(wait=True)
+        self._db.flush()
+        self._frontier.release_all()
+        self._print_summary(num_new)
+
+    async def _fetch_and_process(self, claimed, url, crawlers, executor):
+        crawler = await crawlers.get()
+        counted = deferred = False
+        try:
+            etag, last_modified = self._get_validators(
+                self._db.read_crawl_state(url))
+            try:
+                fetched = await asyncio.get_running_loop().run_in_executor(
+                    executor, crawler.fetch, url, etag, last_modified)
+            except Exception as e:
+                logging.error("Fetching %s failed: %s", url, e)
+                return 0
+            # Runs to completion without yielding, so the change in
+            # _urls_processed is due to this url alone.
+            processed, num_deferred = self._urls_processed, self._num_deferred
+            num_new = self._post_process_url(url, crawler, fetched)
+            counted = self._urls_processed > processed
+            deferred = self._num_deferred > num_deferred
+            return num_new
+        finally:
+            self._finish_claimed_url(claimed, counted, deferred)
+            self._in_flight.discard(url)
+            crawlers.put_nowait(crawler)
+
+
+# Runs the crawl as stages connected by bounded queues, each sized on its own:
+#   fetch: --fetch_workers threads fetching the urls of the fetch queue
+#   parse: a pool of --parse_workers processes parsing the raw pages into
+#       ProcessedPages
+#   store: the driver thread, the only one using the db. It claims urls from
+#       the frontier into the fetch queue and writes out the parsed pages of
+#       the store queue.
+# A fetched page holds on to its UrlCrawler until it is stored and there are
+# --fetch_workers + --parse_queue_size of them, so a slow parse or store stage
+# stalls the fetch workers rather than growing a queue.
+# The depth of every stage is sampled as the store stage goes, the stage which
+# stays full is the bottleneck.
+class PipelineCrawlDriver(CrawlDriver):
+    _fetch_workers = 1
+    _fetch_queue_size = 1
+    _parse_workers = 1
+    _parse_queue_size = 1
+    _in_flight = None
+    _parsing = 0
+    _parsing_lock = None
+    _processor_args = None
+    # Set once the store stage is done, whether it finished or failed
+    _stopping = None
+    # Stage to the sum and max of its sampled depths
+    _depths = None
+    _num_samples = 0
+    _last_depth_log = 0
+
+    def __init__(self,
+                 flags,
+                 budget=None,
+                 membership=None,
+                 archive=None,
+                 writer=None,
+                 metrics=None,
+                 scheduler=None,
+                 pool=None,
+                 scorer=None,
+                 shards=None):
+        super().__init__(flags, budget, membership, archive, writer, metrics,
+                         scheduler, pool, scorer, shards)
+        self._fetch_workers = max(1, flags['fetch_workers'])
+        self._fetch_queue_size = max(1, flags['fetch_queue_size'])
+        self._parse_workers = max(1, flags['parse_workers'])
+        self._parse_queue_size = max(1, flags['parse_queue_size'])
+        self._in_flight = set()
+        self._parsing_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._depths = {'fetch': [0, 0], 'parse': [0, 0], 'store': [0, 0]}
+        self._processor_args = (flags['base_domain'], flags['parser_backend'],
+                                flags['url_filter_config'],
+                                flags['only_include_base_domain_urls'],
+                                flags['canonicalize_cache_size'])
+
+    def run(self):
+        self._start_time = time.monotonic()
+        logging.info("Total URLs in the DB: %d", self._db.get_total_seen())
+        self._add_base_url()
+        fetch_queue = queue.Queue(self._fetch_queue_size)
+        # Every fetched page holds one of these crawlers until it is stored.
+        crawlers = queue.Queue()
+        for _ in range(self._fetch_workers + self._parse_queue_size):
+            crawlers.put_nowait(
+                UrlCrawler(self._base_url,
+                           self._canonicalize_cache_size,
+                           metrics=self._metrics,
+                           scheduler=self._scheduler,
+                           timeout=self._fetch_timeout,
+                           pool=self._pool,
+                           max_page_bytes=self._max_page_bytes))
+        store_queue = queue.Queue(crawlers.qsize())
+        parse_pool = concurrent.futures.ProcessPoolExecutor(
+            self._parse_workers,
+            initializer=page_processor.init_worker,
+            initargs=self._processor_args)
+        fetchers = [
+            threading.Thread(target=self._fetch_stage,
+                             args=(fetch_queue, crawlers, parse_pool,
+                                   store_queue))
+            for _ in range(self._fetch_workers)
+        ]
+        for fetcher in fetchers:
+            fetcher.start()
+        try:
+            num_new = self._store_stage(fetch_queue, crawlers, store_queue)
+        finally:
+            # Not sentinels on the bounded fetch queue, which a failed store
+            # stage may have left full with the fetchers waiting for crawlers
+            # it will not give back.
+            self._stopping.set()
+            for fetcher in fetchers:
+                fetcher.join()
+            parse_pool.shutdown(wait=True)
+        self._db.flush()
+        self._frontier.release_all()
+        self._print_summary(num_new)
+
+    def _store_stage(self, fetch_queue, crawlers, store_queue):
+        num_new = 0
+        urls = collections.deque()
+        in_flight = 0
+        while True:
+            while len(urls) > 0 and not fetch_queue.full(
+            ) and self._budget.reserve():
+                claimed = urls.popleft()
+                url = self._pre_process_url(claimed)
+                if url is None or url in self._in_flight:
+                    self._finish_claimed_url(claimed, False)
+                    continue
+                self._in_flight.add(url)
+                fetch_queue.put_nowait(
+                    (claimed, url, self._db.read_crawl_state(url)))
+                in_flight += 1
+            if in_flight == 0:
+                if self._budget.is_exhausted():
+                    break
+                if len(urls) == 0:
+                    urls = self._get_seen_urls(100)
+                    if len(urls) > 0:
+                        continue
+                    if self._is_crawl_finished():
+                        break
+                # Other workers hold the remaining budget or may still add
+                # urls to the frontier.
+                time.sleep(_FRONTIER_POLL_SECONDS)
+                continue
+            self._sample_depths(fetch_queue, store_queue)
+            try:
+                # Times out to keep the fetch queue topped up
+                item = store_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            in_flight -= 1
+            num_new += self._store_fetched(*item, crawlers)
+            if len(urls) == 0 and not self._budget.is_exhausted():
+                urls = self._get_seen_urls(100)
         return num_new
 
+    def _store_fetched(self, claimed, fetched_url, crawler, fetched, parsed,
+                       crawlers):
+        processed, deferred = self._urls_processed, self._num_deferred
+        try:
+            if fetched is None:
+                # The fetch raised
+                return 0
+            url = self._accept_fetched(fetched_url, crawler, fetched)
+            if url is None:
+                return 0
+            if parsed is not None:
+                # None if the worker failed to parse it
+                page = self._parse_page(url, parsed.result)
+            else:
+                # The page changed since the fetch stage saw its crawl state
+                page = self._parse_page(url, self._processor.process,
+                                        crawler.get_contents())
+            return self._store_page(url, page)
+        finally:
+            self._finish_claimed_url(claimed, self._urls_processed > processed,
+                                     self._num_deferred > deferred)
+            self._in_flight.discard(fetched_url)
+            crawlers.put_nowait(crawler)
+
+    # Fetches the urls of fetch_queue until the driver is stopping. Pages which
+    # need parsing are sent to parse_pool, and all of them end up in
+    # store_queue as (claimed url, url, crawler, fetch result, parse future or
+    # None).
+    def _fetch_stage(self, fetch_queue, crawlers, parse_pool, store_queue):
+        while True:
+            item = self._get_unless_stopping(fetch_queue)
+            if item is None:
+                return
+            claimed, url, state = item
+            crawler = self._get_unless_stopping(crawlers)
+            if crawler is None:
+                return
+            etag, last_modified = self._get_validators(state)
+            try:
+                fetched = crawler.fetch(url, etag, last_modified)
+            except Exception as e:
+                logging.error("Fetching %s failed: %s", url, e)
+                store_queue.put((claimed, url, crawler, None, None))
+                continue
+            if not fetched or crawler.is_not_modified() or len(
+                    crawler.get_contents()) == 0 or (
+                        state is not None and state[2] == hashlib.md5(
+                            crawler.get_contents()).hexdigest()):
+                store_queue.put((claimed, url, crawler, fetched, None))
+                continue
+            with self._parsing_lock:
+                self._parsing += 1
+            parsed = parse_pool.submit(page_processor.process_in_worker,
+                                       crawler.get_contents())
+            parsed.add_done_callback(
+                functools.partial(self._on_parsed, store_queue,
+                                  (claimed, url, crawler, fetched, parsed)))
+
+    # Returns the next item of q, or None once the driver is stopping.
+    def _get_unless_stopping(self, q):
+        while not self._stopping.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def _on_parsed(self, store_queue, item, parsed):
+        with self._parsing_lock:
+            self._parsing -= 1
+        store_queue.put(item)
+
+    def _sample_depths(self, fetch_queue, store_queue):
+        depths = {
+            'fetch': fetch_queue.qsize(),
+            'parse': self._parsing,
+            'store': store_queue.qsize()
+        }
+        for stage, depth in depths.items():
+            self._depths[stage][0] += depth
+            self._depths[stage][1] = max(self._depths[stage][1], depth)
+        self._num_samples += 1
+        now = time.monotonic()
+        if now - self._last_depth_log >= _DEPTH_LOG_SECONDS:
+            self._last_depth_log = now
+            logging.info("Stage queue depths: %s", depths)
+
+    def _print_summary(self, num_new):
+        super()._print_summary(num_new)
+        print(
+            "Stage queue depths, avg/max of", self._num_samples, "samples: ",
+            ", ".join("%s: %.1f/%d" %
+                      (stage, total / max(1, self._num_samples), most)
+                      for stage, (total, most) in self._depths.items()))
+
 
 # Sets the global logging config
 def SetupLogger(flags):
@@ -210,12 +898,247 @@ def ProcessArgs():
                         help='Number of threads',
                         type=int,
                         default=1)
+    parser.add_argument(
+        '--batch_writes',
+        help='Commit the db writes for a page in one transaction',
+        type=int,
+        default=1,
+        choices=[0, 1],  # 0 = false, 1 = true
+        required=False)
+    parser.add_argument(
+        '--membership_cache',
+        help='Answer most seen and forbidden url checks from memory',
+        type=int,
+        default=1,
+        choices=[0, 1],  # 0 = false, 1 = true
+        required=False)
+    parser.add_argument(
+        '--db_writer',
+        help='Send the db writes of all the threads to a single writer '
+        'thread, which commits them in groups',
+        type=int,
+        default=0,
+        choices=[0, 1],  # 0 = false, 1 = true
+        required=False)
+    parser.add_argument('--lease_seconds',
+                        help='Seconds after which urls claimed by a worker '
+                        'which did not finish them can be claimed again',
+                        type=int,
+                        default=600)
+    parser.add_argument('--frontier_order',
+                        help='Order in which urls are picked for crawling, '
+                        'priority picks the urls most likely to be poems '
+                        'first and random samples them from anywhere in the '
+                        'frontier',
+                        type=str,
+                        default="priority",
+                        choices=["random", "fifo", "lifo", "priority"])
+    parser.add_argument('--num_shards',
+                        help='Number of processes, each with its own '
+                        '--db_path, the urls are split between, see '
+                        'tools/shard_crawl.py',
+                        type=int,
+                        default=1)
+    parser.add_argument('--shard_index',
+                        help='Shard of the urls this process crawls, from 0',
+                        type=int,
+                        default=0)
+    parser.add_argument('--shard_spool_dir',
+                        help='Directory all the shards send each other the '
+                        'urls they find through',
+                        type=str,
+                        default="shard_spool")
+    parser.add_argument('--url_filter_config',
+                        help='Json file with the rules for urls to crawl',
+                        type=str,
+                        default=DEFAULT_CONFIG)
+    parser.add_argument('--canonicalize_cache_size',
+                        help='Number of canonical urls to remember',
+                        type=int,
+                        default=100000)
+    parser.add_argument('--parser_backend',
+                        help='How pages are parsed, bs4 is the reference',
+                        type=str,
+                        default="lxml" if lxml is not None else "stream",
+                        choices=BACKENDS)
+    parser.add_argument(
+        '--recrawl',
+        help='Also revisit crawled urls which are due as per their change '
+        'rate, with conditional requests',
+        type=int,
+        default=0,
+        choices=[0, 1],  # 0 = false, 1 = true
+        required=False)
+    parser.add_argument('--min_recrawl_days',
+                        help='Least number of days between revisits of a url',
+                        type=float,
+                        default=1)
+    parser.add_argument('--initial_recrawl_days',
+                        help='Days after which a new url is first revisited',
+                        type=float,
+                        default=30)
+    parser.add_argument('--max_recrawl_days',
+                        help='Most number of days between revisits of a url',
+                        type=float,
+                        default=365)
+    parser.add_argument('--archive_dir',
+                        help='Directory to archive the fetched pages in, '
+                        'empty to not archive them',
+                        type=str,
+                        default='page_archive')
+    parser.add_argument('--archive_codec',
+                        help='Compression of the archived pages',
+                        type=str,
+                        default="zstd" if zstandard is not None else "zlib",
+                        choices=list(CODECS))
+    parser.add_argument('--crawl_mode',
+                        help='sync fetches one url at a time, async keeps '
+                        '--max_in_flight fetches outstanding per thread and '
+                        'pipeline runs fetching, parsing and storing as '
+                        'separate stages',
+                        type=str,
+                        default="sync",
+                        choices=["sync", "async", "pipeline"])
+    parser.add_argument('--max_in_flight',
+                        help='Number of concurrent fetches in async mode',
+                        type=int,
+                        default=8)
+    parser.add_argument('--fetch_workers',
+                        help='Number of fetching threads in pipeline mode',
+                        type=int,
+                        default=8)
+    parser.add_argument('--fetch_queue_size',
+                        help='Number of urls waiting to be fetched in '
+                        'pipeline mode',
+                        type=int,
+                        default=32)
+    parser.add_argument('--parse_workers',
+                        help='Number of parsing processes in pipeline mode',
+                        type=int,
+                        default=os.cpu_count())
+    parser.add_argument('--parse_queue_size',
+                        help='Number of fetched pages which can wait to be '
+                        'parsed or stored in pipeline mode, besides one per '
+                        'fetch worker',
+                        type=int,
+                        default=16)
+    parser.add_argument(
+        '--near_duplicates',
+        help='Index the MinHash signatures of the fetched poems and count '
+        'the near duplicates, needs numpy',
+        type=int,
+        default=1 if numpy is not None else 0,
+        choices=[0, 1],  # 0 = false, 1 = true
+        required=False)
+    parser.add_argument('--near_duplicate_threshold',
+                        help='Least estimated similarity of near duplicates',
+                        type=float,
+                        default=0.8)
+    parser.add_argument('--metrics_port',
+                        help='Port to serve the crawl metrics on at '
+                        '/metrics, 0 to not serve them',
+                        type=int,
+                        default=0)
+    parser.add_argument('--metrics_file',
+                        help='File to write the crawl metrics to every '
+                        '--metrics_interval seconds, empty to not write them',
+                        type=str,
+                        default="")
+    parser.add_argument('--metrics_interval',
+                        help='Seconds between writes of --metrics_file',
+                        type=float,
+                        default=10)
+    parser.add_argument(
+        '--host_rate_limit',
+        help='Pace the fetches of every host, adapting the request rate and '
+        'concurrency to how it copes, and retry throttled and failed fetches',
+        type=int,
+        default=1,
+        choices=[0, 1],  # 0 = false, 1 = true
+        required=False)
+    parser.add_argument('--host_initial_rate',
+                        help='Requests/sec to a host to start at',
+                        type=float,
+                        default=5)
+    parser.add_argument('--host_max_rate',
+                        help='Most requests/sec to a host',
+                        type=float,
+                        default=50)
+    parser.add_argument('--host_max_concurrency',
+                        help='Most concurrent requests to a host',
+                        type=int,
+                        default=16)
+    parser.add_argument('--latency_tolerance',
+                        help='Responses slower than this many times the '
+                        'fastest recent one make the crawl back off',
+                        type=float,
+                        default=2.0)
+    parser.add_argument('--fetch_retries',
+                        help='Most retries of a throttled or failed fetch',
+                        type=int,
+                        default=3)
+    parser.add_argument('--fetch_timeout',
+                        help='Seconds to wait for a connection and for every '
+                        'read of a fetch',
+                        type=float,
+                        default=5.0)
+    parser.add_argument('--defer_seconds',
+                        help='Seconds after which a url whose fetch failed '
+                        'even after the retries is fetched again',
+                        type=float,
+                        default=60)
+    parser.add_argument('--max_deferrals',
+                        help='Times a url is deferred before it is taken as '
+                        'failed',
+                        type=int,
+                        default=3)
+    parser.add_argument('--max_page_bytes',
+                        help='Pages larger than this, decoded, are dropped '
+                        'unread',
+                        type=int,
+                        default=4 * 1024 * 1024)
+    parser.add_argument(
+        '--stream_parse',
+        help='Parse new pages chunk by chunk as they are fetched, in sync '
+        'mode',
+        type=int,
+        default=0,
+        choices=[0, 1],  # 0 = false, 1 = true
+        required=False)
     args = parser.parse_args()
     flags = vars(args)
+    if flags['stream_parse'] == 1:
+        flags['stream_parse'] = True
+    else:
+        flags['stream_parse'] = False
+    if flags['host_rate_limit'] == 1:
+        flags['host_rate_limit'] = True
+    else:
+        flags['host_rate_limit'] = False
     if flags['reset_tables'] == 1:
         flags['reset_tables'] = True
     else:
         flags['reset_tables'] = False
+    if flags['batch_writes'] == 1:
+        flags['batch_writes'] = True
+    else:
+        flags['batch_writes'] = False
+    if flags['recrawl'] == 1:
+        flags['recrawl'] = True
+    else:
+        flags['recrawl'] = False
+    if flags['near_duplicates'] == 1:
+        flags['near_duplicates'] = True
+    else:
+        flags['near_duplicates'] = False
+    if flags['db_writer'] == 1:
+        flags['db_writer'] = True
+    else:
+        flags['db_writer'] = False
+    if flags['membership_cache'] == 1:
+        flags['membership_cache'] = True
+    else:
+        flags['membership_cache'] = False
     if flags['only_include_base_domain_urls'] == 1:
         flags['only_include_base_domain_urls'] = True
     else:
@@ -223,8 +1146,37 @@ def ProcessArgs():
     return flags
 
 
-def MakeAndCallDriver(flags):
-    driver = CrawlDriver(flags)
+# Gauge of the frontier size, read on a connection of its own as it is called
+# on the thread serving the metrics.
+def _read_frontier_size(db_path):
+    frontier = UrlFrontier(db_path)
+    try:
+        return frontier.get_size()
+    finally:
+        frontier.close()
+
+
+# Number of fetches a driver runs at a time.
+def _get_fetch_concurrency(flags):
+    if flags['crawl_mode'] == "async":
+        return max(1, flags['max_in_flight'])
+    if flags['crawl_mode'] == "pipeline":
+        return max(1, flags['fetch_workers'])
+    return 1
+
+
+def MakeAndCallDriver(flags, budget, membership, archive, writer, metrics,
+                      scheduler, pool, scorer, shards):
+    if flags['crawl_mode'] == "async":
+        driver = AsyncCrawlDriver(flags, budget, membership, archive, writer,
+                                  metrics, scheduler, pool, scorer, shards)
+    elif flags['crawl_mode'] == "pipeline":
+        driver = PipelineCrawlDriver(flags, budget, membership, archive,
+                                     writer, metrics, scheduler, pool, scorer,
+                                     shards)
+    else:
+        driver = CrawlDriver(flags, budget, membership, archive, writer,
+                             metrics, scheduler, pool, scorer, shards)
     driver.run()
 
 
@@ -239,15 +1191,86 @@ def main():
         db = UrlDb(flags['db_path'])
         assert db.reset_tables()
 
-    flags['max_urls_to_process'] = flags['max_urls_to_process'] / flags[
-        'num_threads'] + 1
-    executor = concurrent.futures.ThreadPoolExecutor()
+    membership = None
+    if flags['membership_cache'] is True:
+        membership = UrlMembership(UrlDb(flags['db_path']))
+
+    writer = None
+    if flags['db_writer'] is True:
+        writer = DbWriter(flags['db_path'], membership)
+
+    archive = None
+    if len(flags['archive_dir']) > 0:
+        archive = PageArchive(flags['archive_dir'], flags['archive_codec'])
+    metrics = None
+    if flags['metrics_port'] > 0 or len(flags['metrics_file']) > 0:
+        metrics = CrawlMetrics()
+        metrics.add_gauge(
+            "crawler_frontier_size", "Urls in the frontier",
+            functools.partial(_read_frontier_size, flags['db_path']))
+        if flags['metrics_port'] > 0:
+            metrics.serve(flags['metrics_port'])
+        if len(flags['metrics_file']) > 0:
+            metrics.write_periodically(flags['metrics_file'],
+                                       flags['metrics_interval'])
+
+    scheduler = None
+    if flags['host_rate_limit'] is True:
+        scheduler = HostScheduler(
+            flags['fetch_retries'],
+            initial_rate=flags['host_initial_rate'],
+            max_rate=flags['host_max_rate'],
+            max_concurrency=flags['host_max_concurrency'],
+            latency_tolerance=flags['latency_tolerance'])
+
+    # All the threads learn from and score with one LinkScorer
+    scorer = None
+    if flags['frontier_order'] == "priority":
+        scorer = LinkScorer()
+        scorer.load_history(UrlDb(flags['db_path']))
+
+    # This process crawls one shard of the urls, see crawler/sharding.py
+    shards = None
+    if flags['num_shards'] > 1:
+        shards = ShardRouter(flags['shard_spool_dir'], flags['shard_index'],
+                             flags['num_shards'])
+
+    # Enough connections are kept alive for all the fetches of all the
+    # threads to reuse one.
+    pool = make_pool(flags['num_threads'] * _get_fetch_concurrency(flags))
+
+    # All the threads share one budget and claim their urls from the frontier
+    budget = CrawlBudget(flags['max_urls_to_process'])
+    executor = concurrent.futures.ThreadPoolExecutor(flags['num_threads'])
     results = []
     for t in range(flags['num_threads']):
-        results.append(executor.submit(MakeAndCallDriver, flags))
+        results.append(
+            executor.submit(MakeAndCallDriver, flags, budget, membership,
+                            archive, writer, metrics, scheduler, pool, scorer,
+                            shards))
         print("Started ", t, "th thread.")
     print("Waiting for completion")
     executor.shutdown(wait=True)
+    for result in results:
+        result.result()
+    if writer is not None:
+        writer.close()
+        print("Db writer: ", writer.get_stats())
+    if membership is not None:
+        print("Url membership cache: ", membership.get_stats())
+    if scheduler is not None:
+        print("Host limits: ", scheduler.get_stats())
+    if scorer is not None:
+        print("Link scores: ", scorer.get_stats())
+    if shards is not None:
+        shards.close()
+        print("Shard: ", shards.get_stats())
+    pool.clear()
+    if archive is not None:
+        print("Page archive: ", archive.get_stats())
+        archive.close()
+    if metrics is not None:
+        metrics.close()
 
 
 if __name__ == "__main__":
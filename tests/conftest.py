@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The packages of the repo are imported from its root, as the tools do with
+# sys.path.append("../").
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
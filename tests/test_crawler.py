@@ -0,0 +1,77 @@
+import socket
+import threading
+
+import pytest
+
+from crawler.crawler import UrlCrawler
+from crawler.host_limiter import HostScheduler
+
+_PAGE = b"<html><body>poem</body></html>"
+
+
+# Serves connections on a local port as told by respond(n, conn), n counting
+# the connections accepted, until the test is over.
+@pytest.fixture
+def server():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(8)
+    state = {'respond': None, 'accepted': 0}
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            state['accepted'] += 1
+            with conn:
+                conn.recv(65536)
+                state['respond'](state['accepted'], conn)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield state, "http://127.0.0.1:%d" % listener.getsockname()[1]
+    listener.close()
+
+
+def _ok(conn):
+    conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n"
+                 b"Content-Length: %d\r\nConnection: close\r\n\r\n%s" %
+                 (len(_PAGE), _PAGE))
+
+
+def _killed_mid_response(conn):
+    conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n"
+                 b"Content-Length: 1000\r\n\r\n<html><body>po")
+
+
+def _killed_before_response(conn):
+    pass
+
+
+def _scheduler():
+    return HostScheduler(max_retries=2, backoff_seconds=0.01)
+
+
+@pytest.mark.parametrize("scheduler", [None, _scheduler])
+@pytest.mark.parametrize("respond",
+                         [_killed_mid_response, _killed_before_response])
+def test_killed_connection_is_transient(server, scheduler, respond):
+    state, base = server
+    state['respond'] = lambda n, conn: respond(conn)
+    crawler = UrlCrawler(base,
+                         timeout=2.0,
+                         scheduler=scheduler() if scheduler else None)
+    assert not crawler.fetch(base + "/kk/page")
+    assert crawler.is_transient_failure()
+
+
+def test_killed_connection_is_retried(server):
+    state, base = server
+    state['respond'] = lambda n, conn: _killed_before_response(
+        conn) if n == 1 else _ok(conn)
+    crawler = UrlCrawler(base, timeout=2.0, scheduler=_scheduler())
+    assert crawler.fetch(base + "/kk/page")
+    assert crawler.get_contents() == _PAGE
+    assert state['accepted'] == 2
@@ -0,0 +1,30 @@
+from crawler.url_filter import DEFAULT_CONFIG, UrlFilter
+from tools.db_cleaner import _repair_row
+from url_parser.url_parser import UrlParser
+
+_URL = "http://kavitakosh.org/kk/a"
+_HEADING_HASH = "2510c39011c5be704182423e3a695e91"
+_POEM_HASH = "83878c91171338902e0fe0fb97a8c47a"
+
+
+def _repair(table, *row):
+    return _repair_row(table, (7, ) + row, UrlParser(),
+                       UrlFilter.from_file(DEFAULT_CONFIG))
+
+
+def test_url_is_unquoted_once():
+    assert _repair("seen_urls", _URL + "%2520b", None,
+                   None) == (7, 0, _URL + "%20b", None, None)
+    assert _repair("seen_urls", _URL, None, None) is None
+
+
+def test_null_heading_is_removed():
+    row = (_URL, None, "p", "x", "y")
+    assert _repair("fetched_content", *row) == (7, 1) + row
+
+
+def test_poem_is_sanitized_and_rehashed():
+    assert _repair("fetched_content", _URL, " h ", " p ", "x",
+                   "y") == (7, 0, _URL, "h", "p", _HEADING_HASH, _POEM_HASH)
+    assert _repair("fetched_content", _URL, "h", "p", _HEADING_HASH,
+                   _POEM_HASH) is None
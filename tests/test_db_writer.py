@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+from db.db_writer import DbWriter
+from db.url_db import UrlDb
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "urls.db")
+    db = UrlDb(path)
+    assert db.reset_tables()
+    db.close()
+    return path
+
+
+class _WriterDied(BaseException):
+    pass
+
+
+def test_writes_are_committed(db_path):
+    writer = DbWriter(db_path)
+    db = UrlDb(db_path, writer=writer)
+    db.add_seen_url("http://a.org/1")
+    db.add_seen_urls(["http://a.org/2", "http://a.org/3"])
+    assert db.flush()
+    assert db.get_total_seen() == 3
+    writer.close()
+    assert writer.get_stats()['writes'] == 2
+
+
+def test_results_of_waited_writes(db_path):
+    writer = DbWriter(db_path)
+    db = UrlDb(db_path, writer=writer)
+    for i in range(3):
+        db.add_fetched_content("http://a.org/%d" % i, "h" * (i + 1), "hh",
+                               "poem", "ph")
+    assert db.remove_duplicate_content() == 2
+    assert db.start_repair("seen_urls") == 0
+    assert db.stage_repair("seen_urls", [], 0) is True
+    assert db.apply_repair("seen_urls") == (0, 0)
+    writer.close()
+
+
+def test_open_failure_is_raised(tmp_path):
+    with pytest.raises(SystemExit):
+        DbWriter(str(tmp_path / "missing" / "urls.db"))
+
+
+def test_failed_write_fails_its_future_only(db_path):
+    writer = DbWriter(db_path)
+    failed = writer.submit("no_such_method")
+    written = writer.submit("add_seen_url", "http://a.org/1")
+    with pytest.raises(AttributeError):
+        failed.result(timeout=5)
+    assert written.result(timeout=5) is True
+    writer.close()
+
+
+def test_writer_death_fails_pending_and_later_writes(db_path, monkeypatch):
+    writer = DbWriter(db_path)
+
+    def die(db):
+        raise _WriterDied()
+
+    monkeypatch.setattr(writer, "_commit", die)
+    future = writer.submit("add_seen_url", "http://a.org/1")
+    with pytest.raises(_WriterDied):
+        future.result(timeout=5)
+    writer._thread.join(timeout=5)
+    with pytest.raises(_WriterDied):
+        writer.submit("add_seen_url", "http://a.org/2")
+    writer.close()
+
+
+def test_failed_commit_fails_writes(db_path, monkeypatch):
+    writer = DbWriter(db_path)
+    monkeypatch.setattr(writer, "_commit", lambda db: False)
+    assert writer.submit("add_seen_url",
+                         "http://a.org/1").result(timeout=5) is False
+    writer.close()
+    assert os.path.exists(db_path)
@@ -0,0 +1,130 @@
+import datetime
+import sqlite3
+
+import pytest
+
+from db.frontier import REVISIT_PRIORITY, CrawlBudget, UrlFrontier
+from db.url_db import UrlDb
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "urls.db")
+    db = UrlDb(path)
+    assert db.reset_tables()
+    db.add_seen_urls(["http://a.org/kk/%d" % i for i in range(10)])
+    db.close()
+    return path
+
+
+def _expire_leases(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("update pending_urls set lease_expiry = (?);",
+                 ((datetime.datetime.now() -
+                   datetime.timedelta(seconds=1)).isoformat(), ))
+    conn.commit()
+    conn.close()
+
+
+# Crawls urls and makes them due for a revisit.
+def _make_due(db_path, urls):
+    db = UrlDb(db_path)
+    past = datetime.datetime.now() - datetime.timedelta(days=1)
+    for url in urls:
+        db.add_crawled_url(url)
+        db.update_crawl_state(url, None, None, "hash", False, past, past)
+    db.close()
+
+
+@pytest.mark.parametrize("order", ["random", "fifo", "lifo", "priority"])
+def test_claims_are_exclusive(db_path, order):
+    first = UrlFrontier(db_path, order=order)
+    second = UrlFrontier(db_path, order=order)
+    claimed = first.claim(6)
+    assert len(claimed) == 6
+    others = second.claim(100)
+    assert len(others) == 4
+    assert set(claimed) | set(others) == {
+        "http://a.org/kk/%d" % i
+        for i in range(10)
+    }
+    assert second.claim(100) == []
+
+
+def test_fifo_and_lifo_order(db_path):
+    assert UrlFrontier(db_path, order="fifo").claim(2) == [
+        "http://a.org/kk/0", "http://a.org/kk/1"
+    ]
+    assert UrlFrontier(db_path, order="lifo").claim(2) == [
+        "http://a.org/kk/9", "http://a.org/kk/8"
+    ]
+
+
+def test_expired_lease_can_be_claimed_again(db_path):
+    dead = UrlFrontier(db_path, lease_seconds=600)
+    claimed = dead.claim(10)
+    other = UrlFrontier(db_path)
+    assert other.claim(10) == []
+    assert dead.has_active_leases()
+    _expire_leases(db_path)
+    assert not other.has_active_leases()
+    assert sorted(other.claim(10)) == sorted(claimed)
+
+
+def test_released_and_completed_urls(db_path):
+    frontier = UrlFrontier(db_path, order="fifo")
+    claimed = frontier.claim(3)
+    assert frontier.release(claimed[:1])
+    assert frontier.complete(claimed[1])
+    assert frontier.get_size() == 9
+    assert UrlFrontier(db_path, order="fifo").claim(1) == claimed[:1]
+
+
+def test_deferred_url_waits(db_path):
+    frontier = UrlFrontier(db_path, order="fifo")
+    url = frontier.claim(1)[0]
+    assert frontier.defer(url, 600)
+    assert url not in UrlFrontier(db_path).claim(100)
+
+
+def test_revisits_take_their_share(db_path):
+    due = ["http://b.org/kk/%d" % i for i in range(10)]
+    _make_due(db_path, due)
+    frontier = UrlFrontier(db_path, order="priority", revisit_share=0.25)
+    assert frontier.schedule_due(100) == 10
+    claimed = frontier.claim(8)
+    # Revisits first, oldest first, then the new urls
+    assert claimed[:2] == due[:2]
+    assert all(url.startswith("http://a.org") for url in claimed[2:])
+
+
+def test_revisits_fill_the_rest_of_a_claim(db_path):
+    due = ["http://b.org/kk/%d" % i for i in range(10)]
+    _make_due(db_path, due)
+    frontier = UrlFrontier(db_path, order="fifo", revisit_share=0.25)
+    frontier.schedule_due(100)
+    claimed = frontier.claim(20)
+    assert len(claimed) == 20
+    assert set(claimed) >= set(due)
+
+
+def test_revisits_are_not_held_back_by_higher_new_priorities(db_path):
+    db = UrlDb(db_path)
+    db.add_seen_urls(["http://c.org/kk/%d" % i for i in range(10)],
+                     priorities=[REVISIT_PRIORITY - 0.01] * 10)
+    db.close()
+    _make_due(db_path, ["http://b.org/kk/0"])
+    frontier = UrlFrontier(db_path, order="priority", revisit_share=0.25)
+    frontier.schedule_due(100)
+    assert frontier.claim(4)[0] == "http://b.org/kk/0"
+
+
+def test_budget():
+    budget = CrawlBudget(2)
+    assert budget.reserve() and budget.reserve()
+    assert not budget.reserve()
+    budget.release()
+    assert budget.reserve()
+    budget.commit()
+    budget.commit()
+    assert budget.is_exhausted()
@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+
+from db.membership import BloomFilter
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_BITS_OF_FILTER = """
+import sys
+from db.membership import BloomFilter
+bloom = BloomFilter(1000)
+bloom.add_all("http://a.org/kk/%d" % i for i in range(500))
+sys.stdout.write(bytes(bloom._bits).hex())
+"""
+
+
+def _bits_with_hash_seed(seed):
+    return subprocess.run([sys.executable, "-c", _BITS_OF_FILTER],
+                          cwd=_ROOT,
+                          env=dict(os.environ, PYTHONHASHSEED=seed),
+                          capture_output=True,
+                          check=True,
+                          text=True).stdout
+
+
+def test_bits_are_the_same_in_every_process():
+    assert _bits_with_hash_seed("1") == _bits_with_hash_seed("2")
+
+
+def test_added_keys_are_found():
+    bloom = BloomFilter(1000, error_rate=0.01)
+    urls = ["http://a.org/kk/%d" % i for i in range(1000)]
+    bloom.add_all(urls[:500])
+    for url in urls[500:800]:
+        bloom.add(url)
+    assert all(url in bloom for url in urls[:800])
+    false_positives = sum("http://b.org/kk/%d" % i in bloom
+                          for i in range(10000))
+    assert false_positives < 300
@@ -0,0 +1,81 @@
+import os
+
+from crawler.sharding import ShardRouter, shard_of
+
+
+def _urls_of(shard, num_shards, count):
+    urls = []
+    i = 0
+    while len(urls) < count:
+        url = "http://a.org/kk/%d" % i
+        if shard_of(url, num_shards) == shard:
+            urls.append(url)
+        i += 1
+    return urls
+
+
+def _receive_all(router):
+    received = []
+    router.receive(
+        lambda urls, priorities: received.extend(zip(urls, priorities)))
+    return received
+
+
+def test_send_and_receive(tmp_path):
+    sender = ShardRouter(str(tmp_path), 0, 2, batch_size=3)
+    receiver = ShardRouter(str(tmp_path), 1, 2)
+    urls = _urls_of(1, 2, 4)
+    sender.forward(urls, [0.5, 1, 0, 2.0])
+    # A batch of 3 is sent, the last url waits for a flush
+    assert [url for url, _ in _receive_all(receiver)] == urls[:3]
+    sender.flush()
+    assert _receive_all(receiver) == [(urls[3], 2.0)]
+    assert _receive_all(receiver) == []
+    # Urls forwarded before are not sent again
+    sender.forward(urls)
+    sender.flush()
+    assert _receive_all(receiver) == []
+    assert sender.get_stats()['sent'] == 4
+    assert receiver.get_stats()['received'] == 4
+
+
+def test_url_with_newline_and_tab(tmp_path):
+    sender = ShardRouter(str(tmp_path), 0, 1)
+    url = "http://a.org/kk/a\nb\tc"
+    sender.forward([url], [0.25])
+    sender.flush()
+    assert _receive_all(sender) == [(url, 0.25)]
+
+
+def test_restarted_shard_does_not_overwrite_batches(tmp_path):
+    urls = _urls_of(1, 2, 2)
+    for url in urls:
+        sender = ShardRouter(str(tmp_path), 0, 2)
+        sender.forward([url])
+        sender.flush()
+    receiver = ShardRouter(str(tmp_path), 1, 2)
+    assert sorted(url for url, _ in _receive_all(receiver)) == sorted(urls)
+
+
+def test_bad_batch_is_set_aside(tmp_path):
+    router = ShardRouter(str(tmp_path), 0, 1)
+    inbox = os.path.join(str(tmp_path), "inbox_0")
+    with open(os.path.join(inbox, "0_old_1.urls"), "w") as f:
+        f.write("0.0\thttp://a.org/kk/a\n")
+    router.forward(["http://a.org/kk/b"])
+    router.flush()
+    assert _receive_all(router) == [("http://a.org/kk/b", 0.0)]
+    assert os.listdir(inbox) == ["0_old_1.bad"]
+    assert _receive_all(router) == []
+
+
+def test_is_finished_once_all_shards_idle(tmp_path):
+    first = ShardRouter(str(tmp_path), 0, 2)
+    second = ShardRouter(str(tmp_path), 1, 2)
+    first.forward(_urls_of(1, 2, 1))
+    # The batch sent to the second shard is waiting
+    assert not first.is_finished()
+    assert len(_receive_all(second)) == 1
+    assert not first.is_finished()
+    second.close()
+    assert first.is_finished()
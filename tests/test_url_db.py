@@ -0,0 +1,99 @@
+import sqlite3
+
+import pytest
+
+from db.url_db import SCHEMA_VERSION, UrlDb
+
+# The tables of a db made before the schema was versioned
+_V0_SCHEMA = [
+    "create table seen_urls(url text, seen_time datetime, crawl_time datetime);",
+    "create table crawled_urls(url text, seen_time datetime, crawl_time datetime);",
+    "create table forbidden_urls(url text, seen_time datetime);",
+    "create table fetched_content(url text, heading text, poem text, headingHash text, poemHash text);",
+]
+
+
+@pytest.fixture
+def v0_db_path(tmp_path):
+    path = str(tmp_path / "v0.db")
+    conn = sqlite3.connect(path)
+    for statement in _V0_SCHEMA:
+        conn.execute(statement)
+    conn.executemany("insert into seen_urls values(?, ?, ?);", [
+        ("http://a.org/kk/1", "2020-01-02T00:00:00", None),
+        ("http://a.org/kk/1", "2020-01-01T00:00:00", None),
+        ("http://a.org/kk/2", "2020-01-01T00:00:00", None),
+        ("http://a.org/kk/3", "2020-01-01T00:00:00", None),
+        ("http://a.org/kk/4", "2020-01-03T00:00:00", None),
+    ])
+    conn.executemany("insert into crawled_urls values(?, ?, ?);", [
+        ("http://a.org/kk/2", None, "2020-02-01T00:00:00"),
+        ("http://a.org/kk/2", None, "2020-03-01T00:00:00"),
+    ])
+    conn.execute("insert into forbidden_urls values(?, ?);",
+                 ("http://a.org/kk/3", "2020-01-01T00:00:00"))
+    conn.executemany("insert into fetched_content values(?, ?, ?, ?, ?);", [
+        ("http://a.org/kk/2", "first", "p", "h1", "p1"),
+        ("http://a.org/kk/2", "second", "p", "h2", "p1"),
+    ])
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_upgrade_from_v0(v0_db_path):
+    db = UrlDb(v0_db_path)
+    assert db.get_schema_version() == 0
+    assert db.get_upgrade_plan()['seen_urls'] == (5, 4)
+    assert db.upgrade_schema()
+    assert db.get_schema_version() == SCHEMA_VERSION
+    conn = db._conn
+    # The first row of each url in _DEDUP_ORDER is kept
+    assert conn.execute(
+        "select url, seen_time from seen_urls order by url;").fetchall() == [
+            ("http://a.org/kk/1", "2020-01-01T00:00:00"),
+            ("http://a.org/kk/2", "2020-01-01T00:00:00"),
+            ("http://a.org/kk/3", "2020-01-01T00:00:00"),
+            ("http://a.org/kk/4", "2020-01-03T00:00:00"),
+        ]
+    assert conn.execute("select crawl_time from crawled_urls;").fetchall() == [
+        ("2020-03-01T00:00:00", )
+    ]
+    assert conn.execute("select heading from fetched_content;").fetchall() == [
+        ("first", )
+    ]
+    # Seen urls neither crawled nor forbidden are pending, in the order seen
+    assert conn.execute(
+        "select url, lease_owner, priority from pending_urls order by id;"
+    ).fetchall() == [("http://a.org/kk/1", None, 0),
+                     ("http://a.org/kk/4", None, 0)]
+    # Crawled urls are first revisited 30 days after they were crawled
+    assert conn.execute(
+        "select url, first_crawl_time, next_crawl_time, num_checks from crawl_state;"
+    ).fetchall() == [("http://a.org/kk/2", "2020-03-01T00:00:00",
+                      "2020-03-31T00:00:00.000", 1)]
+    # The triggers keep pending_urls in sync from now on
+    db.add_crawled_url("http://a.org/kk/1")
+    db.add_seen_url("http://a.org/kk/5")
+    assert conn.execute(
+        "select url from pending_urls order by id;").fetchall() == [
+            ("http://a.org/kk/4", ), ("http://a.org/kk/5", )
+        ]
+    db.close()
+
+
+def test_upgrade_of_a_current_db(tmp_path):
+    db = UrlDb(str(tmp_path / "new.db"))
+    assert db.reset_tables()
+    assert db.get_schema_version() == SCHEMA_VERSION
+    assert db.upgrade_schema()
+    db.close()
+
+
+def test_iterate_table(tmp_path):
+    db = UrlDb(str(tmp_path / "urls.db"))
+    assert db.reset_tables()
+    urls = ["http://a.org/kk/%d" % i for i in range(25)]
+    db.add_seen_urls(urls)
+    assert list(db.iterate_table("seen_urls", batch_size=7)) == urls
+    db.close()
@@ -0,0 +1,270 @@
+# Benchmark suite of the crawler, run against a synthetic site served by
+# tools/standin_server.py so that runs are comparable:
+#   crawl_<mode>: poem_fetcher.py run end to end on a fresh db, for each of
+#       --crawl_modes, in pages/sec
+#   micro benchmarks of the per page and per link work: canonicalize_url,
+#       UrlFilter.should_crawl, find_element and UrlParser.extract of every
+#       backend, and UrlDb membership checks with and without the membership
+#       cache, each the best of --repeat runs
+# Results are written as json to --output. Given a --baseline json of an
+# earlier run, exits with an error if any result is more than --max_regression
+# worse than in it, eg.
+#   python bench_crawl.py --output base.json
+#   (make a change)
+#   python bench_crawl.py --output new.json --baseline base.json
+
+# export PYTHONPATH=/Users/avidullu/workspaces/PyCharm/poem_fetcher/
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+# This is ugly because of python packaging
+import sys
+import tempfile
+import time
+
+sys.path.append("../")
+
+from crawler.crawler import UrlCrawler
+from crawler.url_filter import UrlFilter
+from db.membership import UrlMembership
+from db.url_db import UrlDb
+from tools.standin_server import AddSiteArgs, MakeSite, StartServer
+from url_parser.url_parser import BACKENDS, UrlParser, lxml
+
+_POEM_FETCHER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                             "poem_fetcher.py")
+
+
+# Runs fn(item) for every item of items --repeat times and returns the best
+# microseconds per item.
+def best_usecs(fn, items, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            fn(item)
+        best = min(best, time.perf_counter() - start)
+    return best * 1e6 / len(items)
+
+
+def result(value, unit, higher_is_better):
+    return {
+        'value': round(value, 4),
+        'unit': unit,
+        'higher_is_better': higher_is_better
+    }
+
+
+def bench_crawl(flags, base_url, mode, tmp_dir):
+    db_path = os.path.join(tmp_dir, "crawl_%s.db" % mode)
+    start = time.monotonic()
+    subprocess.run([
+        sys.executable, _POEM_FETCHER, "--max_urls_to_process",
+        str(flags['crawl_pages']), "--db_path", db_path, "--reset_tables", "1",
+        "--base_domain", base_url, "--archive_dir", "", "--crawl_mode", mode,
+        "--host_max_rate",
+        str(flags['host_max_rate'])
+    ] + flags['crawl_args'].split(),
+                   check=True,
+                   stdout=subprocess.DEVNULL)
+    elapsed = time.monotonic() - start
+    conn = sqlite3.connect(db_path)
+    num_crawled = conn.execute(
+        "select count(*) from crawled_urls;").fetchone()[0]
+    num_fetched = conn.execute(
+        "select count(*) from fetched_content;").fetchone()[0]
+    conn.close()
+    print("crawl %-10s pages: %6d  poems: %6d  secs: %7.2f  pages/sec: %8.2f" %
+          (mode, num_crawled, num_fetched, elapsed,
+           num_crawled / max(elapsed, 1e-6)))
+    return result(num_crawled / max(elapsed, 1e-6), "pages/sec", True)
+
+
+def bench_micro(flags, site, results):
+    base_url = "http://kavitakosh.org"
+    pages = [
+        site.render("/kk/Kavita_%d" % i)[2]
+        for i in range(flags['micro_pages'])
+    ]
+    parser = UrlParser(backend="stream")
+    hrefs = [href for page in pages for href in parser.extract(page).hrefs]
+    repeat = flags['repeat']
+
+    uncached = UrlCrawler(base_url, canonicalize_cache_size=0)
+    results['canonicalize_url'] = result(
+        best_usecs(uncached.canonicalize_url, hrefs, repeat), "usecs/url",
+        False)
+    cached = UrlCrawler(base_url)
+    results['canonicalize_url_cached'] = result(
+        best_usecs(cached.canonicalize_url, hrefs, repeat), "usecs/url", False)
+
+    links = cached.canonicalize_urls(hrefs)
+    url_filter = UrlFilter.from_file()
+    results['should_crawl'] = result(
+        best_usecs(url_filter.should_crawl, links, repeat), "usecs/url", False)
+
+    bs4_parser = UrlParser()
+
+    def find_elements(page):
+        bs4_parser.set_data(page)
+        bs4_parser.find_element(*bs4_parser.heading_selector)
+        bs4_parser.find_element(*bs4_parser.poem_selector)
+
+    results['find_element'] = result(
+        best_usecs(find_elements, pages, repeat) / 1000, "msecs/page", False)
+    for backend in BACKENDS:
+        if backend == "lxml" and lxml is None:
+            print("Skipping lxml, it is not installed")
+            continue
+        results['extract_%s' % backend] = result(
+            best_usecs(UrlParser(backend=backend).extract, pages, repeat) /
+            1000, "msecs/page", False)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "membership.db")
+        db = UrlDb(db_path, batch_writes=True, max_batch_rows=100000)
+        assert db.reset_tables()
+        seen = links[:len(links) // 2]
+        db.add_seen_urls(seen)
+        db.close()
+        # Half of the checks are of seen urls
+        checked = links[len(links) // 4:len(links) * 3 // 4]
+        db = UrlDb(db_path)
+        results['is_seen'] = result(best_usecs(db.is_seen, checked, repeat),
+                                    "usecs/url", False)
+        db.close()
+        db = UrlDb(db_path, membership=UrlMembership(UrlDb(db_path)))
+        results['is_seen_membership'] = result(
+            best_usecs(db.is_seen, checked, repeat), "usecs/url", False)
+        db.close()
+    for name in sorted(results):
+        if not name.startswith("crawl_"):
+            print("%-24s %10.3f %s" %
+                  (name, results[name]['value'], results[name]['unit']))
+
+
+# Returns the names of the results which are more than max_regression worse
+# than in baseline.
+def find_regressions(results, baseline, max_regression):
+    regressions = []
+    for name, current in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['value'], current['value']
+        if before <= 0 or after <= 0:
+            continue
+        change = (before / after if current['higher_is_better'] else after /
+                  before) - 1
+        if change > max_regression:
+            print("Regression in %s: %s -> %s %s" %
+                  (name, before, after, current['unit']))
+            regressions.append(name)
+    return regressions
+
+
+def ProcessArgs():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the crawler against a synthetic site')
+    parser.add_argument('--crawl_modes',
+                        help='Comma separated --crawl_mode values to crawl '
+                        'with, empty to skip crawling',
+                        type=str,
+                        default="sync,async,pipeline")
+    parser.add_argument('--crawl_pages',
+                        help='--max_urls_to_process of every crawl',
+                        type=int,
+                        default=500)
+    parser.add_argument('--crawl_args',
+                        help='More flags for poem_fetcher.py',
+                        type=str,
+                        default="")
+    parser.add_argument('--host_max_rate',
+                        help='--host_max_rate of every crawl, high so that '
+                        'the crawl and not its politeness limit is measured',
+                        type=float,
+                        default=1000)
+    parser.add_argument('--micro',
+                        help='Run the micro benchmarks',
+                        type=int,
+                        default=1,
+                        choices=[0, 1])  # 0 = false, 1 = true
+    parser.add_argument('--micro_pages',
+                        help='Number of pages the micro benchmarks run on',
+                        type=int,
+                        default=200)
+    parser.add_argument('--repeat',
+                        help='Number of runs of every micro benchmark, the '
+                        'best is kept',
+                        type=int,
+                        default=5)
+    parser.add_argument('--output',
+                        help='Json file to write the results to',
+                        type=str,
+                        default="bench_crawl.json")
+    parser.add_argument('--baseline',
+                        help='Json file of an earlier run to compare with',
+                        type=str,
+                        default="")
+    parser.add_argument('--max_regression',
+                        help='Largest allowed slowdown against --baseline, '
+                        'eg. 0.1 for 10%%',
+                        type=float,
+                        default=0.1)
+    AddSiteArgs(parser)
+    args = parser.parse_args()
+    flags = vars(args)
+    if flags['micro'] == 1:
+        flags['micro'] = True
+    else:
+        flags['micro'] = False
+    return flags
+
+
+def main():
+    flags = ProcessArgs()
+    print(flags)
+    site = MakeSite(flags)
+    results = {}
+    modes = [mode for mode in flags['crawl_modes'].split(",") if len(mode) > 0]
+    if len(modes) > 0:
+        server = StartServer(site, flags)
+        base_url = "http://127.0.0.1:%d" % server.server_address[1]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for mode in modes:
+                results['crawl_%s' % mode] = bench_crawl(
+                    flags, base_url, mode, tmp_dir)
+        server.shutdown()
+    if flags['micro']:
+        bench_micro(flags, site, results)
+    with open(flags['output'], "w") as f:
+        json.dump(
+            {
+                'time': datetime.datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'flags': flags,
+                'results': results
+            },
+            f,
+            indent=2,
+            sort_keys=True)
+    print("Wrote results to", flags['output'])
+    if len(flags['baseline']) == 0:
+        return
+    with open(flags['baseline']) as f:
+        baseline = json.load(f)['results']
+    regressions = find_regressions(results, baseline, flags['max_regression'])
+    if len(regressions) > 0:
+        sys.exit("%d regressions against %s" %
+                 (len(regressions), flags['baseline']))
+    print("No regressions against", flags['baseline'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# Measures per page parse time and peak memory of each UrlParser backend on
+# saved pages, eg. fetched with
+#   wget -r -l 1 -P pages http://kavitakosh.org
+# Every backend runs in a fresh process, and its peak memory is the max RSS of
+# that process, which includes what libxml2 allocates, over what it was once
+# the pages were read.
+
+# export PYTHONPATH=/Users/avidullu/workspaces/PyCharm/poem_fetcher/
+
+import argparse
+import concurrent.futures
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.append("../")
+
+from url_parser.url_parser import BACKENDS, UrlParser, lxml
+
+
+def read_pages(pages_dir, max_pages):
+    pages = []
+    for root, _, files in os.walk(pages_dir):
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as f:
+                pages.append(f.read())
+            if len(pages) >= max_pages:
+                return pages
+    return pages
+
+
+# Runs in a process of its own, see main(). ru_maxrss is in KiB on linux.
+def bench(backend, pages_dir, max_pages, iterations):
+    pages = read_pages(pages_dir, max_pages)
+    parser = UrlParser(backend=backend)
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.monotonic()
+    for _ in range(iterations):
+        for page in pages:
+            parser.extract(page)
+    msecs = (time.monotonic() - start) * 1000 / (iterations * len(pages))
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return ("%-8s pages: %6d  msecs/page: %8.3f  peak RSS MiB: %8.1f  "
+            "parsing MiB: %8.1f" %
+            (backend, len(pages), msecs, peak_rss / 1024,
+             (peak_rss - base_rss) / 1024))
+
+
+def ProcessArgs():
+    parser = argparse.ArgumentParser(
+        description='Benchmark UrlParser backends')
+    parser.add_argument('--pages_dir',
+                        help='Directory with saved html pages',
+                        type=str,
+                        required=True)
+    parser.add_argument('--max_pages',
+                        help='Maximum number of pages to read',
+                        type=int,
+                        default=1000)
+    parser.add_argument('--iterations',
+                        help='Number of times to parse every page',
+                        type=int,
+                        default=3)
+    return vars(parser.parse_args())
+
+
+def main():
+    flags = ProcessArgs()
+    pages = read_pages(flags['pages_dir'], flags['max_pages'])
+    assert len(pages) > 0, "No pages found in " + flags['pages_dir']
+    for backend in BACKENDS:
+        if backend == "lxml" and lxml is None:
+            print("Skipping lxml, it is not installed")
+            continue
+        # Spawned, so that the process has nothing in it from this one or
+        # from the other backends.
+        with concurrent.futures.ProcessPoolExecutor(
+                1,
+                mp_context=multiprocessing.get_context("spawn")) as executor:
+            print(
+                executor.submit(bench, backend, flags['pages_dir'],
+                                flags['max_pages'],
+                                flags['iterations']).result())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# Measures UrlDb inserts/sec for a synthetic workload of seen urls, as the
+# crawler writes them: pages of --links_per_page new links each.
+# Compares the legacy config (rollback journal, a commit per row) with WAL and
+# batched commits. The per row modes are run on at most --max_unbatched_urls
+# urls as they are too slow to run on a 1M url workload.
+# Also measures how long claiming a batch from the frontier takes as the
+# number of pending urls grows, and pages/sec and failed writes of threads
+# each storing pages as the crawler does, with a UrlDb per thread against all
+# of them writing through a DbWriter.
+
+# export PYTHONPATH=/Users/avidullu/workspaces/PyCharm/poem_fetcher/
+
+import argparse
+import concurrent.futures
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append("../")
+
+from db.db_writer import DbWriter
+from db.frontier import UrlFrontier
+from db.url_db import UrlDb
+
+
+def run_workload(db, num_urls, links_per_page, batched):
+    start = time.monotonic()
+    for page_start in range(0, num_urls, links_per_page):
+        page_end = min(num_urls, page_start + links_per_page)
+        urls = [
+            "http://kavitakosh.org/kk/page_%d" % i
+            for i in range(page_start, page_end)
+        ]
+        if batched:
+            db.add_seen_urls(urls)
+            db.flush()
+        else:
+            for url in urls:
+                db.add_seen_url(url)
+    return time.monotonic() - start
+
+
+def bench(name, num_urls, flags, **db_args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = UrlDb(os.path.join(tmp_dir, "bench.db"), **db_args)
+        assert db.reset_tables()
+        elapsed = run_workload(db, num_urls, flags['links_per_page'],
+                               db_args.get('batch_writes', False))
+        assert db.get_total_seen() == num_urls
+        db.close()
+    print("%-32s urls: %9d  secs: %8.2f  inserts/sec: %10.0f" %
+          (name, num_urls, elapsed, num_urls / max(elapsed, 1e-6)))
+
+
+def bench_claim(num_urls, flags):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "bench.db")
+        db = UrlDb(db_path, batch_writes=True)
+        assert db.reset_tables()
+        run_workload(db, num_urls, flags['links_per_page'], True)
+        for order in ["random", "fifo"]:
+            frontier = UrlFrontier(db_path, order=order)
+            start = time.monotonic()
+            for _ in range(flags['num_claims']):
+                frontier.release(frontier.claim(flags['claim_size']))
+            elapsed = time.monotonic() - start
+            print("claim %-6s pending urls: %9d  msecs/claim: %8.3f" %
+                  (order, num_urls, elapsed * 1000 / flags['num_claims']))
+        db.close()
+
+
+# Stores num_pages pages as CrawlDriver does, with --parse_ms of work between
+# the first write of a page and its flush. Returns the number of failed writes.
+def store_pages(db_path, writer, thread, num_pages, flags):
+    db = UrlDb(db_path, batch_writes=True, writer=writer)
+    failed = 0
+    for page in range(num_pages):
+        url = "http://kavitakosh.org/kk/thread_%d_page_%d" % (thread, page)
+        failed += not db.add_crawled_url(url)
+        time.sleep(flags['parse_ms'] / 1000)
+        failed += not db.add_fetched_content(url, "heading", "hh", "poem",
+                                             "ph")
+        failed += not db.add_seen_urls(
+            ["%s/link_%d" % (url, i) for i in range(flags['links_per_page'])])
+        failed += not db.flush()
+    return failed
+
+
+def bench_threads(num_threads, use_writer, flags):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "bench.db")
+        assert UrlDb(db_path).reset_tables()
+        writer = DbWriter(db_path) if use_writer else None
+        num_pages = flags['pages_per_thread']
+        executor = concurrent.futures.ThreadPoolExecutor(num_threads)
+        start = time.monotonic()
+        results = [
+            executor.submit(store_pages, db_path, writer, thread, num_pages,
+                            flags) for thread in range(num_threads)
+        ]
+        failed = sum(result.result() for result in results)
+        elapsed = time.monotonic() - start
+        if writer is not None:
+            writer.close()
+        total_pages = num_threads * num_pages
+        assert UrlDb(db_path).get_total_crawled() <= total_pages
+    print("%-8s threads: %3d  pages/sec: %8.0f  failed writes: %d" %
+          ("writer" if use_writer else "per conn", num_threads,
+           total_pages / max(elapsed, 1e-6), failed))
+
+
+def ProcessArgs():
+    parser = argparse.ArgumentParser(description='Benchmark UrlDb writes')
+    parser.add_argument('--num_urls',
+                        help='Number of urls to insert',
+                        type=int,
+                        default=1000000)
+    parser.add_argument('--max_unbatched_urls',
+                        help='Number of urls to insert with a commit per row',
+                        type=int,
+                        default=20000)
+    parser.add_argument('--links_per_page',
+                        help='Number of new links found on each page',
+                        type=int,
+                        default=300)
+    parser.add_argument('--frontier_sizes',
+                        help='Comma separated numbers of pending urls to '
+                        'measure frontier claims at',
+                        type=str,
+                        default="10000,100000,1000000")
+    parser.add_argument('--claim_size',
+                        help='Number of urls per claim',
+                        type=int,
+                        default=100)
+    parser.add_argument('--num_claims',
+                        help='Number of claims to average over',
+                        type=int,
+                        default=100)
+    parser.add_argument('--thread_counts',
+                        help='Comma separated numbers of writing threads',
+                        type=str,
+                        default="1,2,4,8")
+    parser.add_argument('--pages_per_thread',
+                        help='Number of pages each writing thread stores',
+                        type=int,
+                        default=200)
+    parser.add_argument('--parse_ms',
+                        help='Milliseconds spent on a page between its writes',
+                        type=float,
+                        default=2)
+    return vars(parser.parse_args())
+
+
+def main():
+    flags = ProcessArgs()
+    unbatched = min(flags['num_urls'], flags['max_unbatched_urls'])
+    bench("rollback journal, row commits", unbatched, flags, wal=False)
+    bench("wal, row commits", unbatched, flags)
+    bench("wal, page commits", flags['num_urls'], flags, batch_writes=True)
+    for size in flags['frontier_sizes'].split(","):
+        bench_claim(int(size), flags)
+    for num_threads in flags['thread_counts'].split(","):
+        for use_writer in [False, True]:
+            bench_threads(int(num_threads), use_writer, flags)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# Compares UrlFilter with the chain of string scans it replaced, on links
+# extracted from saved pages (see tools/bench_parser.py) or read from a file
+# with one url per line.
+
+# export PYTHONPATH=/Users/avidullu/workspaces/PyCharm/poem_fetcher/
+
+import argparse
+import sys
+import time
+
+sys.path.append("../")
+
+from crawler.crawler import UrlCrawler
+from crawler.url_filter import DEFAULT_CONFIG, UrlFilter
+from tools.bench_parser import read_pages
+from url_parser.url_parser import UrlParser
+
+
+# The rules as they were hard coded in CrawlDriver._should_crawl_url
+def legacy_should_crawl(url):
+    return url.count(":Random") == 0 and url.count(
+        "MobileEditor") == 0 and url.count("&printable") == 0 and url.count(
+            "oldid") == 0 and url.count("&search=") == 0 and url.count(
+                "&limit=") == 0 and url.count("action=") == 0 and url.count(
+                    "mobileaction"
+                ) == 0 and url.count("returnto") == 0 and url.count(
+                    "RecentChangesLinked"
+                ) == 0 and url.count("otherapps") == 0 and url.count(
+                    "hidelinks"
+                ) == 0 and url.count("hideredirs") == 0 and not url.startswith(
+                    "http://kavitakosh.org/share") and not url.startswith(
+                        "http://kavitakosh.org/kk/images")
+
+
+def read_links(flags):
+    if flags['links_file']:
+        with open(flags['links_file']) as f:
+            return [line.strip() for line in f if len(line.strip()) > 0]
+    parser = UrlParser(backend="stream")
+    crawler = UrlCrawler(flags['base_domain'])
+    links = []
+    for page in read_pages(flags['pages_dir'], flags['max_pages']):
+        links += crawler.canonicalize_urls(parser.extract(page).hrefs)
+    return links
+
+
+def bench(name, fn, links, iterations):
+    start = time.monotonic()
+    for _ in range(iterations):
+        kept = fn(links)
+    usecs = (time.monotonic() - start) * 1e6 / (iterations * len(links))
+    print("%-16s links: %8d  kept: %8d  usecs/link: %7.3f" %
+          (name, len(links), len(kept), usecs))
+    return kept
+
+
+def ProcessArgs():
+    parser = argparse.ArgumentParser(description='Benchmark url filtering')
+    parser.add_argument('--links_file',
+                        help='File with one url per line',
+                        type=str,
+                        default="")
+    parser.add_argument('--pages_dir',
+                        help='Directory with saved html pages to take the '
+                        'links from, if no --links_file',
+                        type=str,
+                        default="")
+    parser.add_argument('--max_pages',
+                        help='Maximum number of pages to read',
+                        type=int,
+                        default=1000)
+    parser.add_argument('--base_domain',
+                        help='Domain the pages were saved from',
+                        type=str,
+                        default='http://kavitakosh.org')
+    parser.add_argument('--url_filter_config',
+                        help='Json file with the rules for urls to crawl',
+                        type=str,
+                        default=DEFAULT_CONFIG)
+    parser.add_argument('--iterations',
+                        help='Number of times to filter every link',
+                        type=int,
+                        default=10)
+    return vars(parser.parse_args())
+
+
+def main():
+    flags = ProcessArgs()
+    assert flags['links_file'] or flags['pages_dir'], \
+        "One of --links_file or --pages_dir is needed"
+    links = read_links(flags)
+    assert len(links) > 0, "No links found"
+    url_filter = UrlFilter.from_file(flags['url_filter_config'])
+    legacy = bench("legacy chain",
+                   lambda urls: [u for u in urls if legacy_should_crawl(u)],
+                   links, flags['iterations'])
+    bench("should_crawl",
+          lambda urls: [u for u in urls if url_filter.should_crawl(u)], links,
+          flags['iterations'])
+    compiled = bench("filter", url_filter.filter, links, flags['iterations'])
+    # The compiled rules ignore case, so they can only drop more links.
+    print("Links only dropped by the compiled rules: ",
+          len(set(legacy) - set(compiled)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+# Ingests a local mirror of pages into the db without crawling them, eg. to
+# bootstrap a new db from a mirror fetched with
+#   wget -r -P mirror http://kavitakosh.org
+# or from a tar of such a mirror. A page at <mirror>/<path> is taken to be the
+# page of the url --url_prefix<path>.
+# Every page goes through the same steps as a crawled one in poem_fetcher.py:
+# it is added to crawled_urls, its poem to fetched_content (or the url to
+# forbidden_urls if it has no article), its links to seen_urls and its hash to
+# crawl_state, so that it is revisited as per --*_recrawl_days. Files
+# whose url the crawl's url filter rejects, which are not html, eg. images,
+# or which are larger than --max_page_bytes are skipped, the last two without
+# reading more than the start of them.
+# Parsing is cpu bound so pages are parsed on a pool of processes, while the
+# main process reads the mirror a batch at a time and does all the db writes
+# in large transactions. Pages already in crawled_urls are skipped, so an
+# interrupted run can be started again.
+
+# export PYTHONPATH=/Users/avidullu/workspaces/PyCharm/poem_fetcher/
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import hashlib
+import logging
+import os
+# This is ugly because of python packaging
+import sys
+import tarfile
+import time
+
+sys.path.append("../")
+
+from crawler import page_processor
+from crawler.crawler import UrlCrawler
+from crawler.recrawl import RecrawlPolicy
+from crawler.url_filter import DEFAULT_CONFIG, UrlFilter
+from db.url_db import UrlDb
+from url_parser.url_parser import BACKENDS, lxml
+
+# Files which are never pages. Others are looked at, see _is_html().
+_NON_HTML_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".svg", ".ico",
+                        ".webp", ".css", ".js", ".json", ".xml", ".pdf",
+                        ".mp3", ".mp4", ".ogg", ".zip", ".gz", ".woff",
+                        ".woff2", ".ttf", ".eot")
+
+# Bytes of a file looked at to tell if it is html
+_HEAD_BYTES = 1024
+
+
+# Returns the pid of the pool process, the cpu seconds it spent on the batch
+# and (url, md5 of the page, ProcessedPage) of every (url, page) in batch.
+def _process_batch(batch):
+    start = time.process_time()
+    results = [(url, hashlib.md5(page).hexdigest(),
+                page_processor.process_in_worker(page)) for url, page in batch]
+    return os.getpid(), time.process_time() - start, results
+
+
+# Yields (url, page) of the html pages of the mirror whose url skip() is False
+# for, reading one page at a time.
+def iterate_pages(flags, crawler, skip):
+    for path, size, open_file in _iterate_files(flags):
+        if path.lower().endswith(_NON_HTML_EXTENSIONS):
+            continue
+        # wget saves the page of a directory url as index.html in it
+        if path == "index.html" or path.endswith("/index.html"):
+            path = path[:-len("index.html")]
+        if len(path) == 0:
+            continue
+        url = crawler.canonicalize_url(flags['url_prefix'] + path)
+        if skip(url):
+            continue
+        if size > flags['max_page_bytes']:
+            logging.debug("Skipping %s, it is %d bytes", url, size)
+            continue
+        with open_file() as f:
+            head = f.read(_HEAD_BYTES)
+            if not _is_html(head):
+                logging.debug("Skipping %s, it is not html", url)
+                continue
+            page = head + f.read()
+        yield url, page
+
+
+# True if head, the first _HEAD_BYTES of a page, starts like html does, ie.
+# with a tag, comment or doctype after any byte order mark and whitespace, and
+# is text.
+def _is_html(head):
+    return head.lstrip(b"\xef\xbb\xbf \t\r\n").startswith(
+        b"<") and b"\x00" not in head
+
+
+# Yields the path of every file of the mirror relative to it, its size and a
+# function opening it.
+def _iterate_files(flags):
+    if len(flags['pages_tar']) > 0:
+        # Streaming mode, members are read in the order they are stored.
+        with tarfile.open(flags['pages_tar'], 'r|*') as tar:
+            for member in tar:
+                if member.isfile():
+                    path = member.name
+                    if path.startswith("./"):
+                        path = path[2:]
+                    yield path, member.size, lambda: tar.extractfile(member)
+        return
+    for root, dirs, files in os.walk(flags['pages_dir']):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, flags['pages_dir']).replace(
+                os.sep, '/'), os.path.getsize(path), lambda: open(path, 'rb')
+
+
+class Ingester:
+    _db = None
+    _recrawl_policy = None
+    _pages = 0
+    _poems = 0
+    _no_article = 0
+    _partial = 0
+    _failed = 0
+    _new_urls = 0
+    # pid of a pool process to its number of pages and cpu seconds
+    _workers = None
+
+    def __init__(self, db, recrawl_policy):
+        self._db = db
+        self._recrawl_policy = recrawl_policy
+        self._workers = collections.defaultdict(lambda: [0, 0.0])
+
+    def store(self, pid, elapsed, results):
+        self._workers[pid][0] += len(results)
+        self._workers[pid][1] += elapsed
+        for url, content_hash, page in results:
+            self._pages += 1
+            # As for a first crawl, see poem_fetcher.py#_record_crawl_state
+            now = datetime.datetime.now()
+            self._db.update_crawl_state(
+                url, None, None, content_hash, False, now,
+                self._recrawl_policy.next_crawl_time(now, 0, now))
+            if page is None:
+                # Could not be parsed, see page_processor.process_in_worker()
+                self._failed += 1
+                self._db.add_seen_urls([url])
+                self._db.add_crawled_url(url)
+                self._db.add_forbidden_url(url)
+                continue
+            self._db.add_seen_urls([url] + page.links)
+            self._new_urls += len(page.links)
+            self._db.add_crawled_url(url)
+            if page.no_article_text:
+                self._no_article += 1
+                self._db.add_forbidden_url(url)
+            elif page.poem is None:
+                logging.debug("Partial content. Skipping adding %s", url)
+                self._partial += 1
+            else:
+                self._db.add_fetched_content(url, *page.poem)
+                self._poems += 1
+
+    def print_summary(self, elapsed):
+        for pid, (pages, busy) in sorted(self._workers.items()):
+            print("worker ", pid, ": pages: ", pages, ", pages/cpu sec: ",
+                  round(pages / max(busy, 1e-6), 2))
+        print("Pages: ", self._pages, ", poems: ", self._poems,
+              ", no contents: ", self._no_article, ", partial: ",
+              self._partial, ", failed: ", self._failed, ", links: ",
+              self._new_urls)
+        print("Wall secs: ", round(elapsed, 2), ", pages/sec: ",
+              round(self._pages / max(elapsed, 1e-6), 2))
+
+
+def ingest(flags, db):
+    start = time.monotonic()
+    ingester = Ingester(
+        db,
+        RecrawlPolicy(flags['min_recrawl_days'], flags['initial_recrawl_days'],
+                      flags['max_recrawl_days']))
+    crawler = UrlCrawler(flags['base_domain'])
+    url_filter = UrlFilter.from_file(flags['url_filter_config'])
+    # Urls sent to the pool which may not be written yet
+    submitted = set()
+
+    def skip(url):
+        if not url_filter.should_crawl(url):
+            return True
+        if url in submitted or db.is_crawled(url):
+            return True
+        submitted.add(url)
+        return False
+
+    num_workers = flags['num_workers']
+    with concurrent.futures.ProcessPoolExecutor(
+            num_workers,
+            initializer=page_processor.init_worker,
+            initargs=(flags['base_domain'], flags['parser_backend'],
+                      flags['url_filter_config'],
+                      flags['only_include_base_domain_urls'])) as executor:
+        pending = set()
+        batch = []
+        for url, page in iterate_pages(flags, crawler, skip):
+            batch.append((url, page))
+            if len(batch) < flags['batch_size']:
+                continue
+            pending.add(executor.submit(_process_batch, batch))
+            batch = []
+            # Bounds the pages held in memory
+            if len(pending) >= 2 * num_workers:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    ingester.store(*future.result())
+        if len(batch) > 0:
+            pending.add(executor.submit(_process_batch, batch))
+        for future in concurrent.futures.as_completed(pending):
+            ingester.store(*future.result())
+    db.flush()
+    ingester.print_summary(time.monotonic() - start)
+
+
+# Sets the global logging config
+def SetupLogger(flags):
+    logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s '
+                        '[%(filename)s:%(lineno)d] %(message)s',
+                        datefmt='%Y-%m-%d:%H:%M:%S',
+                        level=flags['log'])
+
+
+def ProcessArgs():
+    parser = argparse.ArgumentParser(
+        description='Ingest a local mirror of pages into the db')
+    parser.add_argument('--pages_dir',
+                        help='Directory of the mirror',
+                        type=str,
+                        default="")
+    parser.add_argument('--pages_tar',
+                        help='Tar of the mirror, read instead of --pages_dir',
+                        type=str,
+                        default="")
+    parser.add_argument('--url_prefix',
+                        help='Prefix making the url of a page from its path '
+                        'in the mirror',
+                        type=str,
+                        default="http://")
+    parser.add_argument('--log',
+                        help='logging level',
+                        type=str,
+                        default="WARNING")  # NOTSET
+    parser.add_argument('--db_path',
+                        help='Path to database',
+                        type=str,
+                        default="kavita_kosh2.db")
+    parser.add_argument('--base_domain',
+                        help='Base domain of the mirrored site',
+                        type=str,
+                        default='http://kavitakosh.org')
+    parser.add_argument('--only_include_base_domain_urls',
+                        help='Only add links to URLs from the base domain.',
+                        type=int,
+                        choices=[0, 1],
+                        default=1)
+    parser.add_argument('--url_filter_config',
+                        help='Json file with the rules for urls to crawl',
+                        type=str,
+                        default=DEFAULT_CONFIG)
+    parser.add_argument('--parser_backend',
+                        help='How pages are parsed, bs4 is the reference',
+                        type=str,
+                        default="lxml" if lxml is not None else "stream",
+                        choices=BACKENDS)
+    parser.add_argument('--min_recrawl_days',
+                        help='Least number of days between revisits of a url',
+                        type=float,
+                        default=1)
+    parser.add_argument('--initial_recrawl_days',
+                        help='Days after which a new url is first revisited',
+                        type=float,
+                        default=30)
+    parser.add_argument('--max_recrawl_days',
+                        help='Most number of days between revisits of a url',
+                        type=float,
+                        default=365)
+    parser.add_argument('--max_page_bytes',
+                        help='Pages larger than this are skipped unread',
+                        type=int,
+                        default=4 * 1024 * 1024)
+    parser.add_argument('--num_workers',
+                        help='Number of parsing processes',
+                        type=int,
+                        default=os.cpu_count())
+    parser.add_argument('--batch_size',
+                        help='Number of pages sent to a process at a time',
+                        type=int,
+                        default=64)
+    parser.add_argument('--max_batch_rows',
+                        help='Number of db writes per transaction',
+                        type=int,
+                        default=10000)
+    args = parser.parse_args()
+    flags = vars(args)
+    if flags['only_include_base_domain_urls'] == 1:
+        flags['only_include_base_domain_urls'] = True
+    else:
+        flags['only_include_base_domain_urls'] = False
+    return flags
+
+
+def main():
+    flags = ProcessArgs()
+    print(flags)
+    SetupLogger(flags)
+    if len(flags['pages_dir']) == 0 and len(flags['pages_tar']) == 0:
+        sys.exit("One of --pages_dir or --pages_tar is needed")
+    db = UrlDb(flags['db_path'],
+               batch_writes=True,
+               max_batch_rows=flags['max_batch_rows'],
+               max_batch_ms=10000)
+    ingest(flags, db)
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,161 +5,216 @@
 # export PYTHONPATH=/Users/avidullu/workspaces/PyCharm/poem_fetcher/
 
 import argparse
-import hashlib
+import collections
+import concurrent.futures
 import logging
+import os
 # This is ugly because of python packaging
 import sys
+import time
 from urllib.parse import unquote
 
 sys.path.append("../")
 
 from db.url_db import UrlDb
-from parser.parser import Parser
+from url_parser.url_parser import PageContent, UrlParser
 from crawler.crawler import UrlCrawler
+from crawler.url_filter import DEFAULT_CONFIG, UrlFilter
 
 
-# TODO: Pull this into a common library and share
-def should_include_url(url):
-    # TODO: Make these comparisons case insensitive
-    return url.count(":Random") == 0 and url.count(
-        "MobileEditor") == 0 and url.count("&printable") == 0 and url.count(
-            "oldid") == 0 and url.count("&search=") == 0 and url.count(
-                "&limit=") == 0 and url.count("action=") == 0 and url.count(
-                    "mobileaction"
-                ) == 0 and url.count("returnto") == 0 and url.count(
-                    "RecentChangesLinked"
-                ) == 0 and url.count("otherapps") == 0 and url.count(
-                    "hidelinks"
-                ) == 0 and url.count("hideredirs") == 0 and not url.startswith(
-                    "http://kavitakosh.org/share") and not url.startswith(
-                        "http://kavitakosh.org/kk/images")
-
-
-# TODO: Implement this and integrate with the main pipeline.
+# Of the rows of fetched_content with the same poemHash keeps the one with the
+# shortest heading, see UrlDb.remove_duplicate_content.
 def dedup_db(flags, db):
-    # For each row in the table, select all rows which have the same poemHash
-    # remove all of them and insert the one with the shortest heading length
-    total_fetched_count = db.get_total_fetched()
-    print("Total urls in fetched content: ", total_fetched_count)
-    all_urls = db.read_from_fetched(total_fetched_count)
-    num_correct, num_fixed = 0, 0
-    for url in all_urls:
-        contents = db.read_fetched_content(url, max_to_read=1)
-        assert len(contents[0]) == 5, url
-        # record the entire row here
-        nurl, heading, poem, hH, pH = contents[0][0], contents[0][1], contents[
-            0][2], contents[0][3], contents[0][4]
-        all_matching_urls = db.get_matching_content(poemHash=pH)
-        if len(all_matching_urls) == 1:
-            num_correct += 1
-            continue
-        logging.debug("Found %d matches for url %s", len(all_matching_urls),
-                      url)
-        for murl in all_matching_urls:
-            mcontents = db.read_fetched_content(murl, 1)
-            assert poem == mcontents[0][2]
-            assert murl == mcontents[0][0]
-            # Pick the heading which is shortest.
-            if len(mcontents[0][1]) < len(heading):
-                heading, nurl, hH = mcontents[0][1], murl, mcontents[0][3]
-            if not flags['dry_run']:
-                db.remove_from_fetched(murl)
-        if not flags['dry_run']:
-            db.add_fetched_content(nurl, heading, hH, poem, pH)
-        logging.debug("Adding url %s with heading: %s", nurl, heading)
-        num_fixed += 1
-    print("Num correct: ", num_correct, "  fixed: ", num_fixed)
-
-
-def sanitize_and_repopulate_fetched_contents(flags, db, parser):
-    total_fetched_count = db.get_total_fetched()
-    print("Total urls in fetched content: ", total_fetched_count)
-    all_urls = db.read_from_fetched(total_fetched_count)
+    plan = db.get_duplicate_content_plan()
+    if plan is None:
+        sys.exit("Planning the dedup failed. DB is unchanged.")
+    num_rows, num_hashes, num_repeated = plan
+    print("Total urls in fetched content: ", num_rows, ", distinct poems: ",
+          num_hashes)
+    print("Num correct: ", num_hashes - num_repeated, "  to fix: ",
+          num_repeated, "  rows to remove: ", num_rows - num_hashes)
+    if flags['dry_run'] or num_rows == num_hashes:
+        return
+    num_removed = db.remove_duplicate_content()
+    if num_removed < 0:
+        sys.exit("Removing duplicates failed. DB is unchanged.")
+    print("Num fixed: ", num_repeated, "  rows removed: ", num_removed)
+
+
+# Yields the rows, (rowid, *row), of table for a sanitize_and_repopulate_*
+# pass, which adds the changes it makes, (rowid, remove, *new row), to
+# changes. They are staged a batch at a time, see UrlDb.start_repair, and
+# swapped in by _apply_changes() once every row has been examined: a row
+# written back during the scan gets a new rowid and would be examined again,
+# eg. unquoted twice.
+def _scan_table(flags, db, table, changes):
+    if not flags['dry_run'] and (not db.discard_repair(table)
+                                 or db.start_repair(table) < 0):
+        sys.exit("Starting the repair failed. DB is unchanged.")
+    after_rowid = 0
+    while True:
+        rows = db.read_table_rows(table, after_rowid, flags['batch_size'])
+        if rows is None:
+            sys.exit("Reading the table failed. DB is unchanged.")
+        if len(rows) == 0:
+            return
+        yield from rows
+        after_rowid = rows[-1][0]
+        if not flags['dry_run'] and not db.stage_repair(
+                table, changes, after_rowid):
+            sys.exit("Staging the repair failed. DB is unchanged.")
+        changes.clear()
+
+
+def _apply_changes(flags, db, table):
+    if not flags['dry_run'] and db.apply_repair(table) is None:
+        sys.exit("Applying the repair failed. DB is unchanged.")
+
+
+# The change to make to row, (rowid, url, *rest) of table, as (rowid, remove,
+# *new row), see UrlDb.stage_repair, or None if it is fine as it is. Rows
+# whose url, unquoted or not, is not to be crawled are removed, as are
+# fetched_content rows without a poem, see UrlParser.get_poem. Others are
+# rewritten with a sanitized url and poem.
+def _repair_row(table, row, parser, url_filter):
+    rowid, url, *rest = row
+    newUrl = UrlCrawler.sanitize_url(unquote(url))
+    if not url_filter.should_crawl(newUrl) or not url_filter.should_crawl(url):
+        return (rowid, 1, url, *rest)
+    if table != "fetched_content":
+        return (rowid, 0, newUrl, *rest) if url != newUrl else None
+    prevHeading, prevPoem, prevHH, prevPH = rest
+    poem = parser.get_poem(PageContent(prevHeading, prevPoem, False, []))
+    if poem is None:
+        logging.critical("Empty poem or heading found in DB for %s", url)
+        return (rowid, 1, url, *rest)
+    if prevHH != poem.headingHash or prevPH != poem.poemHash or url != newUrl:
+        return (rowid, 0, newUrl, poem.heading, poem.poem, poem.headingHash,
+                poem.poemHash)
+    return None
+
+
+# Sanitizes the rows of table one at a time, see _repair_row().
+def sanitize_and_repopulate(flags, db, table, parser, url_filter):
     num_fixed, num_removed = 0, 0
-    crawler = UrlCrawler('http://kavitakosh.org')
-    for url in all_urls:
-        newUrl = crawler.sanitize_url(unquote(url))
-        if should_include_url(newUrl) is False or should_include_url(
-                url) is False:
-            logging.debug("Removing url: %s", url)
-            num_removed += 1
-            if not flags['dry_run']:
-                db.remove_from_fetched(url)
+    changes = []
+    for row in _scan_table(flags, db, table, changes):
+        change = _repair_row(table, row, parser, url_filter)
+        if change is None:
             continue
-        contents = db.read_fetched_content(url)
-        heading, poem = parser.sanitize_text(
-            contents[0][1]), parser.sanitize_text(contents[0][2])
-        prevHH, prevPH = contents[0][3], contents[0][4]
-        if len(heading) == 0 or len(poem) == 0:
-            logging.critical("Empty poem or heading found in DB for %s", url)
-            if not flags['dry_run']:
-                db.remove_from_fetched(url)
+        changes.append(change)
+        if change[1]:
+            logging.debug("Removing url: %s", row[1])
             num_removed += 1
-            continue
-        # TODO: Make this a library and use in both code and here.
-        headingHash = hashlib.md5(heading.encode()).hexdigest()
-        poemHash = hashlib.md5(poem.encode()).hexdigest()
-        if prevHH != headingHash or prevPH != poemHash or url != newUrl:
-            if not flags['dry_run']:
-                db.remove_from_fetched(url)
-                db.remove_from_fetched(newUrl)
-                db.add_fetched_content(newUrl, heading, headingHash, poem,
-                                       poemHash)
+        else:
+            if change[2] != row[1]:
+                print(row[1], "    ", change[2])
             num_fixed += 1
+    _apply_changes(flags, db, table)
     print("Number of entries fixed: ", num_fixed, ", and removed: ",
           num_removed)
 
 
-def sanitize_and_repopulate_seen_urls(flags, db, parser):
+def sanitize_and_repopulate_fetched_contents(flags, db, parser, url_filter):
+    total_fetched_count = db.get_total_fetched()
+    print("Total urls in fetched content: ", total_fetched_count)
+    sanitize_and_repopulate(flags, db, "fetched_content", parser, url_filter)
+
+
+def sanitize_and_repopulate_seen_urls(flags, db, parser, url_filter):
     total_seen_count = db.get_total_seen()
     print("Total urls in seen_urls: ", total_seen_count)
-    all_urls = db.read_from_seen(max_to_fetch=total_seen_count)
-    num_fixed, num_removed = 0, 0
-    crawler = UrlCrawler('http://kavitakosh.org')
-    for url in all_urls:
-        newUrl = crawler.sanitize_url(unquote(url))
-        if should_include_url(newUrl) is False or should_include_url(
-                url) is False:
-            logging.debug("Removing url: %s", url)
-            num_removed += 1
-            if not flags['dry_run']:
-                db.remove_from_seen(url)
-        elif url != newUrl:
-            print(url, "    ", newUrl)
-            if not flags['dry_run']:
-                contents = db.read_seen_url(url)
-                db.remove_from_seen(url)
-                db.remove_from_seen(newUrl)
-                db.add_seen_url(newUrl, contents[0][1], contents[0][2])
-            num_fixed += 1
-    print("Number of entries fixed: ", num_fixed, ", and removed: ",
-          num_removed)
+    sanitize_and_repopulate(flags, db, "seen_urls", parser, url_filter)
 
 
-def sanitize_and_repopulate_crawled_urls(flags, db, parser):
+def sanitize_and_repopulate_crawled_urls(flags, db, parser, url_filter):
     total_crawled_count = db.get_total_crawled()
     print("Total urls in crawled_urls: ", total_crawled_count)
-    all_urls = db.read_from_crawled(max_to_fetch=total_crawled_count)
-    num_fixed, num_removed = 0, 0
-    crawler = UrlCrawler('http://kavitakosh.org')
-    for url in all_urls:
-        newUrl = crawler.sanitize_url(unquote(url))
-        if should_include_url(newUrl) is False or should_include_url(
-                url) is False:
-            logging.debug("Removing url: %s", url)
-            num_removed += 1
-            if not flags['dry_run']:
-                db.remove_from_crawled(url)
-        elif url != newUrl:
-            print(url, "    ", newUrl)
-            if not flags['dry_run']:
-                contents = db.read_crawled_url(url)
-                db.remove_from_crawled(url)
-                db.remove_from_crawled(newUrl)
-                db.add_crawled_url(newUrl, contents[0][1], contents[0][2])
-            num_fixed += 1
-    print("Number of entries fixed: ", num_fixed, ", and removed: ",
-          num_removed)
+    sanitize_and_repopulate(flags, db, "crawled_urls", parser, url_filter)
+
+
+# The UrlParser and UrlFilter of a pool process, see _init_worker().
+_parser = None
+_url_filter = None
+
+
+# Initializer of the processes of the pool running _repair_rows().
+def _init_worker(url_filter_config):
+    global _parser, _url_filter
+    _parser = UrlParser()
+    _url_filter = UrlFilter.from_file(url_filter_config)
+
+
+# _repair_row() for each of rows, (rowid, *row) of table. Returns the last
+# rowid, the number of rows and the changes to make.
+def _repair_rows(table, rows):
+    changes = []
+    for row in rows:
+        change = _repair_row(table, row, _parser, _url_filter)
+        if change is not None:
+            changes.append(change)
+    return rows[-1][0], len(rows), changes
+
+
+# Same result as sanitize_and_repopulate_* for table, but the rows are
+# examined in batches on a pool of processes and the changes staged in the
+# db, then applied in one transaction, see UrlDb.start_repair. A run which
+# was interrupted carries on from the last staged batch unless --resume 0.
+def bulk_sanitize_and_repopulate(flags, db, table):
+    start = time.monotonic()
+    after_rowid = 0
+    if not flags['dry_run']:
+        if not flags['resume'] and not db.discard_repair(table):
+            sys.exit("Discarding the staged repair failed. Aborting")
+        after_rowid = db.start_repair(table)
+        if after_rowid < 0:
+            sys.exit("Starting the repair failed. DB is unchanged.")
+        if after_rowid > 0:
+            print("Resuming after rowid ", after_rowid)
+    num_rows, num_removed, num_fixed = 0, 0, 0
+
+    def stage(last_rowid, num_batch_rows, changes):
+        nonlocal num_rows, num_removed, num_fixed
+        num_rows += num_batch_rows
+        num_removed += sum(change[1] for change in changes)
+        num_fixed += sum(1 - change[1] for change in changes)
+        if not flags['dry_run'] and not db.stage_repair(
+                table, changes, last_rowid):
+            sys.exit("Staging the repair failed. DB is unchanged.")
+        logging.info("Examined %s up to rowid %d", table, last_rowid)
+
+    num_workers = flags['num_workers']
+    with concurrent.futures.ProcessPoolExecutor(
+            num_workers,
+            initializer=_init_worker,
+            initargs=(flags['url_filter_config'], )) as executor:
+        # Batches are staged in order, so that the last rowid staged has all
+        # the rows before it examined.
+        pending = collections.deque()
+        while True:
+            rows = db.read_table_rows(table, after_rowid, flags['batch_size'])
+            if rows is None:
+                sys.exit("Reading the table failed. DB is unchanged.")
+            if len(rows) == 0:
+                break
+            after_rowid = rows[-1][0]
+            pending.append(executor.submit(_repair_rows, table, rows))
+            # Bounds the rows held in memory
+            if len(pending) >= 2 * num_workers:
+                stage(*pending.popleft().result())
+        while len(pending) > 0:
+            stage(*pending.popleft().result())
+    print("Rows examined: ", num_rows, ", to fix: ", num_fixed,
+          ", to remove: ", num_removed, ", secs: ",
+          round(time.monotonic() - start, 2))
+    if flags['dry_run']:
+        return
+    applied = db.apply_repair(table)
+    if applied is None:
+        sys.exit("Applying the repair failed. DB is unchanged, run again "
+                 "to retry.")
+    print("Number of entries fixed: ", applied[1], ", and removed: ",
+          applied[0], ", secs: ", round(time.monotonic() - start, 2))
 
 
 # Sets the global logging config
@@ -200,12 +255,46 @@ def ProcessArgs():
                         help='Path to database',
                         type=str,
                         default="kavita_kosh2.db")
+    parser.add_argument('--url_filter_config',
+                        help='Json file with the rules for urls to keep',
+                        type=str,
+                        default=DEFAULT_CONFIG)
+    parser.add_argument('--batch_size',
+                        help='Number of rows read from the db at a time',
+                        type=int,
+                        default=1000)
+    parser.add_argument(
+        '--bulk',
+        help='Sanitize in batches on --num_workers processes and apply the '
+        'changes in one transaction',
+        type=int,
+        default=0,
+        choices=[0, 1])  # 0 = false, 1 = true
+    parser.add_argument('--num_workers',
+                        help='Number of processes sanitizing in --bulk mode',
+                        type=int,
+                        default=os.cpu_count())
+    parser.add_argument(
+        '--resume',
+        help='Carry on with the changes staged by an interrupted --bulk run '
+        'instead of starting over',
+        type=int,
+        default=1,
+        choices=[0, 1])  # 0 = false, 1 = true
     args = parser.parse_args()
     flags = vars(args)
     if flags['dry_run'] == 0:
         flags['dry_run'] = False
     else:
         flags['dry_run'] = True
+    if flags['bulk'] == 1:
+        flags['bulk'] = True
+    else:
+        flags['bulk'] = False
+    if flags['resume'] == 1:
+        flags['resume'] = True
+    else:
+        flags['resume'] = False
     return flags
 
 
@@ -216,13 +305,17 @@ def main():
         print("Dry run mode. No mutations.")
     SetupLogger(flags)
     db = UrlDb(flags['db_path'])
-    parser = Parser()
-    if flags['sanitize_and_repopulate'] == "fetched_content":
-        sanitize_and_repopulate_fetched_contents(flags, db, parser)
-    if flags['sanitize_and_repopulate'] == "seen_urls":
-        sanitize_and_repopulate_seen_urls(flags, db, parser)
-    if flags['sanitize_and_repopulate'] == "crawled_urls":
-        sanitize_and_repopulate_crawled_urls(flags, db, parser)
+    parser = UrlParser()
+    url_filter = UrlFilter.from_file(flags['url_filter_config'])
+    if flags['bulk'] and len(flags['sanitize_and_repopulate']) > 0:
+        bulk_sanitize_and_repopulate(flags, db,
+                                     flags['sanitize_and_repopulate'])
+    elif flags['sanitize_and_repopulate'] == "fetched_content":
+        sanitize_and_repopulate_fetched_contents(flags, db, parser, url_filter)
+    elif flags['sanitize_and_repopulate'] == "seen_urls":
+        sanitize_and_repopulate_seen_urls(flags, db, parser, url_filter)
+    elif flags['sanitize_and_repopulate'] == "crawled_urls":
+        sanitize_and_repopulate_crawled_urls(flags, db, parser, url_filter)
     if flags['dedup_db'] == "fetched_content":
         dedup_db(flags, db)
 
@@ -0,0 +1,85 @@
+# Combines the dbs of the shards of a sharded crawl (see tools/shard_crawl.py)
+# into one db, which can then be crawled on or cleaned like any other. Urls
+# which more than one shard has, eg. the target of a redirect, keep the rows
+# of the first shard given. Shard dbs have to be at the current schema, see
+# tools/migrate_db.py. Merging into an existing db adds to it, eg.
+#   python merge_shards.py --db_path merged.db --shard_db_paths s0.db,s1.db
+
+# export PYTHONPATH=/Users/avidullu/workspaces/PyCharm/poem_fetcher/
+
+import argparse
+import logging
+import os
+# This is ugly because of python packaging
+import sys
+import time
+
+sys.path.append("../")
+
+from db.url_db import UrlDb
+
+
+# Sets the global logging config
+def SetupLogger(flags):
+    logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s '
+                        '[%(filename)s:%(lineno)d] %(message)s',
+                        datefmt='%Y-%m-%d:%H:%M:%S',
+                        level=flags['log'])
+
+
+# Merges the dbs at shard_paths into the db at db_path, which is created if
+# it does not exist. Returns False if any of them failed, the shards merged
+# before it stay merged.
+def merge_shards(db_path, shard_paths):
+    is_new = not os.path.exists(db_path)
+    db = UrlDb(db_path)
+    if is_new and not db.reset_tables():
+        return False
+    for shard_path in shard_paths:
+        start = time.monotonic()
+        added = db.merge_from(shard_path)
+        if added is None:
+            db.close()
+            return False
+        print("Merged ", shard_path, " in ",
+              round(time.monotonic() - start, 2), " secs, rows added: ", added)
+    print("Seen: ", db.get_total_seen(), ", crawled: ", db.get_total_crawled(),
+          ", fetched: ", db.get_total_fetched(), ", forbidden: ",
+          db.get_total_forbidden())
+    db.close()
+    return True
+
+
+def ProcessArgs():
+    parser = argparse.ArgumentParser(
+        description='Combine the dbs of a sharded crawl into one')
+    parser.add_argument('--shard_db_paths',
+                        help='Comma separated paths of the shard dbs',
+                        type=str,
+                        required=True)
+    parser.add_argument('--log',
+                        help='logging level',
+                        type=str,
+                        default="WARNING")  # NOTSET
+    parser.add_argument('--db_path',
+                        help='Path to the database to merge into',
+                        type=str,
+                        default="kavita_kosh2.db")
+    args = parser.parse_args()
+    flags = vars(args)
+    return flags
+
+
+def main():
+    flags = ProcessArgs()
+    print(flags)
+    SetupLogger(flags)
+    shard_paths = [
+        path for path in flags['shard_db_paths'].split(",") if len(path) > 0
+    ]
+    if not merge_shards(flags['db_path'], shard_paths):
+        sys.exit("Merging the shards failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# Upgrades a db created by an older version of UrlDb to the current schema in
+# place, so that it need not be recrawled. Rows which repeat a url are dropped
+# while copying, see db/url_db.py#_DEDUP_ORDER for which one is kept.
+
+# export PYTHONPATH=/Users/avidullu/workspaces/PyCharm/poem_fetcher/
+
+import argparse
+import logging
+# This is ugly because of python packaging
+import sys
+
+sys.path.append("../")
+
+from db.url_db import SCHEMA_VERSION, UrlDb
+
+
+# Sets the global logging config
+def SetupLogger(flags):
+    logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s '
+                        '[%(filename)s:%(lineno)d] %(message)s',
+                        datefmt='%Y-%m-%d:%H:%M:%S',
+                        level=flags['log'])
+
+
+def ProcessArgs():
+    parser = argparse.ArgumentParser(
+        description='Tool to upgrade the schema of a crawled db')
+    parser.add_argument('--dry_run',
+                        help='Does not mutate the DB',
+                        type=int,
+                        default=1,
+                        choices=[0,
+                                 1])  # 0 = --dry_run=false, 1 = --dry_run=true
+    parser.add_argument('--log',
+                        help='logging level',
+                        type=str,
+                        default="WARNING")  # NOTSET
+    parser.add_argument('--db_path',
+                        help='Path to database',
+                        type=str,
+                        default="kavita_kosh2.db")
+    args = parser.parse_args()
+    flags = vars(args)
+    if flags['dry_run'] == 0:
+        flags['dry_run'] = False
+    else:
+        flags['dry_run'] = True
+    return flags
+
+
+def main():
+    flags = ProcessArgs()
+    print(flags)
+    if flags['dry_run']:
+        print("Dry run mode. No mutations.")
+    SetupLogger(flags)
+    db = UrlDb(flags['db_path'])
+    version = db.get_schema_version()
+    print("Schema version: ", version, ", current: ", SCHEMA_VERSION)
+    if version == SCHEMA_VERSION:
+        return
+    for table, (num_rows, num_urls) in db.get_upgrade_plan().items():
+        print(table, ": rows ", num_rows, ", duplicate rows to drop: ",
+              num_rows - num_urls)
+    if flags['dry_run']:
+        return
+    if not db.upgrade_schema():
+        sys.exit("Upgrading the schema failed. DB is unchanged.")
+    print("Upgraded schema to version ", db.get_schema_version())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# Finds poems which are the same but for small edits, eg. in spacing,
+# punctuation or an attribution line, which the exact poemHash dedup of
+# db_cleaner.py misses. Uses the MinHash/LSH index of db/near_dup.py which the
+# crawler keeps up to date.
+#   --backfill indexes the poems of fetched_content which are not indexed yet,
+#     eg. of a db crawled before the index existed, many poems at a time.
+#   --similar_to prints the near duplicates of the poem of a url.
+#   --cluster prints the groups of near duplicate poems of the whole db.
+
+# export PYTHONPATH=/Users/avidullu/workspaces/PyCharm/poem_fetcher/
+
+import argparse
+import logging
+# This is ugly because of python packaging
+import sys
+import time
+
+sys.path.append("../")
+
+from db.near_dup import NearDupIndex
+from db.url_db import UrlDb
+
+
+# Sets the global logging config
+def SetupLogger(flags):
+    logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s '
+                        '[%(filename)s:%(lineno)d] %(message)s',
+                        datefmt='%Y-%m-%d:%H:%M:%S',
+                        level=flags['log'])
+
+
+def backfill(flags, db, index):
+    start = time.monotonic()
+    num_read, num_indexed, after_rowid = 0, 0, 0
+    while True:
+        rows = db.read_unsigned_content(after_rowid, flags['batch_size'])
+        if rows is None:
+            sys.exit("Reading fetched_content failed. Aborting")
+        if len(rows) == 0:
+            break
+        after_rowid = rows[-1][0]
+        signatures = index.get_hasher().signatures(
+            [poem or "" for _, _, poem in rows])
+        for (_, url, _), signature in zip(rows, signatures):
+            if signature is not None:
+                index.add_signature(url, signature)
+                num_indexed += 1
+        db.flush()
+        num_read += len(rows)
+        logging.info("Indexed %d of %d poems", num_indexed, num_read)
+    elapsed = time.monotonic() - start
+    print("Poems read: ", num_read, ", indexed: ", num_indexed,
+          ", poems/sec: ", round(num_read / max(elapsed, 1e-6), 2))
+
+
+def ProcessArgs():
+    parser = argparse.ArgumentParser(
+        description='Find near duplicate poems in the db')
+    parser.add_argument('--backfill',
+                        help='Index the poems which are not indexed yet',
+                        type=int,
+                        default=0,
+                        choices=[0, 1])  # 0 = false, 1 = true
+    parser.add_argument('--similar_to',
+                        help='Url to print the near duplicates of',
+                        type=str,
+                        default="")
+    parser.add_argument('--cluster',
+                        help='Print the groups of near duplicate poems',
+                        type=int,
+                        default=0,
+                        choices=[0, 1])  # 0 = false, 1 = true
+    parser.add_argument('--threshold',
+                        help='Least estimated similarity of near duplicates',
+                        type=float,
+                        default=0.8)
+    parser.add_argument('--batch_size',
+                        help='Number of poems indexed at a time by --backfill',
+                        type=int,
+                        default=1000)
+    parser.add_argument('--log',
+                        help='logging level',
+                        type=str,
+                        default="WARNING")  # NOTSET
+    parser.add_argument('--db_path',
+                        help='Path to database',
+                        type=str,
+                        default="kavita_kosh2.db")
+    args = parser.parse_args()
+    flags = vars(args)
+    if flags['backfill'] == 1:
+        flags['backfill'] = True
+    else:
+        flags['backfill'] = False
+    if flags['cluster'] == 1:
+        flags['cluster'] = True
+    else:
+        flags['cluster'] = False
+    return flags
+
+
+def main():
+    flags = ProcessArgs()
+    print(flags)
+    SetupLogger(flags)
+    db = UrlDb(flags['db_path'], batch_writes=True, max_batch_rows=100000)
+    index = NearDupIndex(db, threshold=flags['threshold'])
+    if flags['backfill']:
+        backfill(flags, db, index)
+    if len(flags['similar_to']) > 0:
+        for url, score in index.find_similar_to_url(flags['similar_to']):
+            print(round(score, 3), url)
+    if flags['cluster']:
+        clusters = index.cluster()
+        for cluster in clusters:
+            print(len(cluster), ": ", " ".join(sorted(cluster)))
+        print("Clusters: ", len(clusters), ", poems in them: ",
+              sum(len(cluster) for cluster in clusters))
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
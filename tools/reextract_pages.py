@@ -0,0 +1,106 @@
+# Extracts the heading and poem of every page in the page archive written by
+# the crawler (see db/page_archive.py) again and updates fetched_content where
+# they differ, eg. after fixing an extraction bug. Needs no refetching.
+
+# export PYTHONPATH=/Users/avidullu/workspaces/PyCharm/poem_fetcher/
+
+import argparse
+import logging
+# This is ugly because of python packaging
+import sys
+
+sys.path.append("../")
+
+from db.page_archive import PageArchive
+from db.url_db import UrlDb
+from url_parser.url_parser import BACKENDS, UrlParser, lxml
+
+
+# Sets the global logging config
+def SetupLogger(flags):
+    logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s '
+                        '[%(filename)s:%(lineno)d] %(message)s',
+                        datefmt='%Y-%m-%d:%H:%M:%S',
+                        level=flags['log'])
+
+
+def reextract(flags, db, archive, parser):
+    num_pages, num_same, num_fixed, num_removed = 0, 0, 0, 0
+    for url, _, page in archive.iterate():
+        num_pages += 1
+        content = parser.extract(page)
+        poem = None if content.no_article_text else parser.get_poem(content)
+        contents = db.read_fetched_content(url)
+        if poem is None:
+            if len(contents) > 0:
+                logging.debug("No content found any more in %s", url)
+                if not flags['dry_run']:
+                    db.remove_from_fetched(url)
+                num_removed += 1
+            continue
+        stored = contents[0] if len(contents) > 0 else None
+        if stored is not None and stored[3] == poem.headingHash and stored[
+                4] == poem.poemHash:
+            num_same += 1
+            continue
+        logging.debug("Updating content of %s", url)
+        if not flags['dry_run']:
+            db.remove_from_fetched(url)
+            db.add_fetched_content(url, *poem)
+        num_fixed += 1
+    db.flush()
+    print("Archived pages: ", num_pages, ", unchanged: ", num_same,
+          ", fixed: ", num_fixed, ", removed: ", num_removed)
+
+
+def ProcessArgs():
+    parser = argparse.ArgumentParser(
+        description='Extract the archived pages again into the db')
+    parser.add_argument('--dry_run',
+                        help='Does not mutate the DB',
+                        type=int,
+                        default=1,
+                        choices=[0,
+                                 1])  # 0 = --dry_run=false, 1 = --dry_run=true
+    parser.add_argument('--log',
+                        help='logging level',
+                        type=str,
+                        default="WARNING")  # NOTSET
+    parser.add_argument('--db_path',
+                        help='Path to database',
+                        type=str,
+                        default="kavita_kosh2.db")
+    parser.add_argument('--archive_dir',
+                        help='Directory of the page archive',
+                        type=str,
+                        default="page_archive")
+    parser.add_argument('--parser_backend',
+                        help='How pages are parsed, bs4 is the reference',
+                        type=str,
+                        default="lxml" if lxml is not None else "stream",
+                        choices=BACKENDS)
+    args = parser.parse_args()
+    flags = vars(args)
+    if flags['dry_run'] == 0:
+        flags['dry_run'] = False
+    else:
+        flags['dry_run'] = True
+    return flags
+
+
+def main():
+    flags = ProcessArgs()
+    print(flags)
+    if flags['dry_run']:
+        print("Dry run mode. No mutations.")
+    SetupLogger(flags)
+    db = UrlDb(flags['db_path'], batch_writes=True)
+    archive = PageArchive(flags['archive_dir'])
+    print("Page archive: ", archive.get_stats())
+    reextract(flags, db, archive, UrlParser(backend=flags['parser_backend']))
+    db.close()
+    archive.close()
+
+
+if __name__ == "__main__":
+    main()
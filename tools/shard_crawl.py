@@ -0,0 +1,156 @@
+# Runs a sharded crawl as --num_shards local poem_fetcher.py processes. Each
+# one crawls the urls its shard owns (see crawler/sharding.py) into its own db
+# --shard_dir/shard_<n>.db, logging to --shard_dir/shard_<n>.log, and sends
+# the urls it finds for the others through --shard_dir/spool. The crawl ends
+# once every shard is out of urls or has used up its share of
+# --max_urls_to_process, after which the shard dbs are merged into --db_path
+# unless --merge 0, see tools/merge_shards.py. Running it again with the same
+# --shard_dir and without --reset_tables continues the crawl, eg.
+#   python shard_crawl.py --num_shards 4 --max_urls_to_process 10000
+#       --crawl_args "--reset_tables 1 --crawl_mode pipeline"
+# Shards on other machines run poem_fetcher.py with the same --num_shards and
+# a --shard_spool_dir they all share.
+
+# export PYTHONPATH=/Users/avidullu/workspaces/PyCharm/poem_fetcher/
+
+import argparse
+import glob
+import logging
+import os
+import shlex
+import sqlite3
+import subprocess
+# This is ugly because of python packaging
+import sys
+import time
+
+sys.path.append("../")
+
+from tools.merge_shards import merge_shards
+
+_POEM_FETCHER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                             "poem_fetcher.py")
+
+
+# Sets the global logging config
+def SetupLogger(flags):
+    logging.basicConfig(format='%(asctime)s,%(msecs)d %(levelname)-8s '
+                        '[%(filename)s:%(lineno)d] %(message)s',
+                        datefmt='%Y-%m-%d:%H:%M:%S',
+                        level=flags['log'])
+
+
+def get_shard_db_path(flags, shard):
+    return os.path.join(flags['shard_dir'], "shard_%d.db" % shard)
+
+
+# Starts the process of every shard and waits for all of them. Returns False
+# if any of them failed.
+def run_shards(flags):
+    spool_dir = os.path.join(flags['shard_dir'], "spool")
+    os.makedirs(spool_dir, exist_ok=True)
+    # States of an earlier crawl would end this one, urls it sent are kept
+    for path in glob.glob(os.path.join(spool_dir, "state_*")):
+        os.remove(path)
+    num_shards = flags['num_shards']
+    # Every shard gets an equal share of the budget
+    budget = -(-flags['max_urls_to_process'] // num_shards)
+    processes = []
+    for shard in range(num_shards):
+        log = open(os.path.join(flags['shard_dir'], "shard_%d.log" % shard),
+                   "w")
+        processes.append(
+            subprocess.Popen([
+                sys.executable, _POEM_FETCHER, "--num_shards",
+                str(num_shards), "--shard_index",
+                str(shard), "--shard_spool_dir", spool_dir, "--db_path",
+                get_shard_db_path(flags, shard), "--max_urls_to_process",
+                str(budget)
+            ] + shlex.split(flags['crawl_args']),
+                             stdout=log,
+                             stderr=subprocess.STDOUT))
+        log.close()
+    ok = True
+    for shard, process in enumerate(processes):
+        if process.wait() != 0:
+            logging.error("Shard %d failed with %d, see its log", shard,
+                          process.returncode)
+            ok = False
+    return ok
+
+
+def count_crawled(flags):
+    num_crawled = 0
+    for shard in range(flags['num_shards']):
+        conn = sqlite3.connect(get_shard_db_path(flags, shard))
+        num_crawled += conn.execute(
+            "select count(*) from crawled_urls;").fetchone()[0]
+        conn.close()
+    return num_crawled
+
+
+def ProcessArgs():
+    parser = argparse.ArgumentParser(
+        description='Crawl with several processes, each on a shard of the urls'
+    )
+    parser.add_argument('--num_shards',
+                        help='Number of processes to crawl with',
+                        type=int,
+                        default=4)
+    parser.add_argument('--max_urls_to_process',
+                        help='Number of urls to crawl, split equally between '
+                        'the shards',
+                        type=int,
+                        default=1000)
+    parser.add_argument('--shard_dir',
+                        help='Directory of the shard dbs, logs and spool',
+                        type=str,
+                        default="shards")
+    parser.add_argument('--crawl_args',
+                        help='More flags for poem_fetcher.py, the same for '
+                        'every shard',
+                        type=str,
+                        default="")
+    parser.add_argument('--merge',
+                        help='Merge the shard dbs into --db_path at the end',
+                        type=int,
+                        default=1,
+                        choices=[0, 1])  # 0 = false, 1 = true
+    parser.add_argument('--log',
+                        help='logging level',
+                        type=str,
+                        default="WARNING")  # NOTSET
+    parser.add_argument('--db_path',
+                        help='Path to the database to merge the shards into',
+                        type=str,
+                        default="kavita_kosh2.db")
+    args = parser.parse_args()
+    flags = vars(args)
+    if flags['merge'] == 1:
+        flags['merge'] = True
+    else:
+        flags['merge'] = False
+    return flags
+
+
+def main():
+    flags = ProcessArgs()
+    print(flags)
+    SetupLogger(flags)
+    start = time.monotonic()
+    if not run_shards(flags):
+        sys.exit("Crawling the shards failed")
+    elapsed = time.monotonic() - start
+    num_crawled = count_crawled(flags)
+    print("Shards: ", flags['num_shards'], ", pages crawled: ", num_crawled,
+          ", secs: ", round(elapsed, 2), ", pages/sec: ",
+          round(num_crawled / max(elapsed, 1e-6), 2))
+    if flags['merge'] and not merge_shards(flags['db_path'], [
+            get_shard_db_path(flags, shard)
+            for shard in range(flags['num_shards'])
+    ]):
+        sys.exit("Merging the shards failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+# Serves a synthetic MediaWiki style site shaped like kavitakosh.org, for
+# running the crawler end to end without hitting the real site, eg. by
+# tools/bench_crawl.py. Pages are generated from their path and --seed, so a
+# site is the same on every run:
+#   /                      main page, links to the categories
+#   /kk/Category:Kavi_<n>  category pages, link to --fan_out poems
+#   /kk/Kavita_<n>         poem pages with a firstHeading and a poem div,
+#                          linking to --fan_out other pages, besides the edit,
+#                          random and image links of every wiki page which the
+#                          url filter drops
+#   /kk/Missing_<n>        pages with the noarticletext marker
+#   /kk/Redirect_<n>       302 redirects to a poem
+#   /kk/Photo_<n>          --photo_kb jpeg images, which no url filter rule
+#                          catches
+#   /kk/Index_<n>          --index_kb html pages of links, like the special
+#                          pages listing a whole wiki
+# Every response is delayed by --latency_ms, plus --load_latency_ms for every
+# other request being served, and like a loaded site it can push back:
+# requests beyond --max_rps per second get a 429 and those beyond
+# --max_concurrency at a time a 503, both with a Retry-After.
+# Pages are sent gzip or deflate compressed to clients which accept it, as
+# kavitakosh.org does, unless --compress is 0.
+
+# export PYTHONPATH=/Users/avidullu/workspaces/PyCharm/poem_fetcher/
+
+import argparse
+import gzip
+import http.server
+import logging
+import random
+import threading
+import time
+import zlib
+from urllib.parse import quote, unquote
+
+_WORDS = [
+    "मन", "नदी", "चाँद", "धूप", "पवन", "सपना", "आँगन", "दीप", "बादल", "सागर",
+    "पथ", "गीत", "साँझ", "भोर", "फूल", "धरती", "आकाश", "प्रेम", "पीड़ा", "नयन",
+    "घर", "गाँव", "शहर", "बारिश", "छाँव", "तारे", "राह", "मौन", "स्वर", "जीवन"
+]
+
+
+# The pages of a synthetic site of num_poems poems and num_categories
+# categories. missing_rate, redirect_rate, photo_rate and index_rate are the
+# shares of the links of a poem which point to missing pages, redirects, images
+# of photo_kb and huge pages of index_kb.
+class StandinSite:
+    _num_poems = 0
+    _num_categories = 0
+    _fan_out = 0
+    _missing_rate = 0
+    _redirect_rate = 0
+    _photo_rate = 0
+    _index_rate = 0
+    _photo_kb = 0
+    _index_kb = 0
+    _seed = 0
+
+    def __init__(self,
+                 num_poems=100000,
+                 num_categories=1000,
+                 fan_out=20,
+                 missing_rate=0.05,
+                 redirect_rate=0.02,
+                 seed=1,
+                 photo_rate=0,
+                 index_rate=0,
+                 photo_kb=512,
+                 index_kb=20480):
+        self._num_poems = num_poems
+        self._num_categories = num_categories
+        self._fan_out = fan_out
+        self._missing_rate = missing_rate
+        self._redirect_rate = redirect_rate
+        self._seed = seed
+        self._photo_rate = photo_rate
+        self._index_rate = index_rate
+        self._photo_kb = photo_kb
+        self._index_kb = index_kb
+
+    # Returns the http status, extra headers and body of path.
+    def render(self, path):
+        path = unquote(path.split('?')[0].split('#')[0])
+        if path == "/" or path == "/kk" or path == "/kk/":
+            return 200, {}, self._main_page()
+        kind, _, number = path[len("/kk/"):].rpartition('_')
+        if not path.startswith("/kk/") or not number.isdigit():
+            return 404, {}, self._page("Not found", "", [])
+        number = int(number)
+        if kind == "Category:Kavi" and number < self._num_categories:
+            return 200, {}, self._category_page(number)
+        if kind == "Kavita" and number < self._num_poems:
+            return 200, {}, self._poem_page(number)
+        if kind == "Missing":
+            return 200, {}, self._page(
+                "Missing %d" % number,
+                '<div class="noarticletext">इस पन्ने पर अभी कुछ नहीं है</div>',
+                [])
+        if kind == "Redirect":
+            return 302, {
+                'Location': "/kk/Kavita_%d" % (number % self._num_poems)
+            }, b""
+        if kind == "Photo":
+            return 200, {
+                'Content-Type': "image/jpeg"
+            }, self._rng("photo", number).randbytes(self._photo_kb * 1024)
+        if kind == "Index":
+            line = ('<li><a href="/kk/Kavita_%d">कविता</a></li>\n' %
+                    number).encode()
+            return 200, {}, self._page("Index %d" % number, "", []).replace(
+                b"</body>",
+                line * (self._index_kb * 1024 // len(line)) + b"</body>")
+        return 404, {}, self._page("Not found", "", [])
+
+    def _rng(self, kind, number):
+        return random.Random("%d/%s/%d" % (self._seed, kind, number))
+
+    def _main_page(self):
+        links = [
+            "/kk/Category:Kavi_%d" % i
+            for i in range(min(self._num_categories, 100))
+        ]
+        return self._page("कविता कोश मुखपृष्ठ", "", links)
+
+    def _category_page(self, number):
+        rng = self._rng("category", number)
+        links = [
+            "/kk/Kavita_%d" % rng.randrange(self._num_poems)
+            for _ in range(self._fan_out)
+        ]
+        links.append("/kk/Category:Kavi_%d" %
+                     ((number + 1) % self._num_categories))
+        return self._page("श्रेणी:कवि %d" % number, "", links)
+
+    def _poem_page(self, number):
+        rng = self._rng("poem", number)
+        stanzas = []
+        for _ in range(rng.randint(2, 6)):
+            lines = [
+                " ".join(rng.choice(_WORDS) for _ in range(rng.randint(4, 9)))
+                for _ in range(4)
+            ]
+            stanzas.append("<br />\n".join(lines))
+        poem = '<div class="poem">\n<p>%s</p>\n</div>' % "</p>\n<p>".join(
+            stanzas)
+        links = ["/kk/Category:Kavi_%d" % (number % self._num_categories)]
+        for _ in range(self._fan_out):
+            draw = rng.random()
+            if draw < self._missing_rate:
+                links.append("/kk/Missing_%d" % rng.randrange(self._num_poems))
+            elif draw < self._missing_rate + self._redirect_rate:
+                links.append("/kk/Redirect_%d" %
+                             rng.randrange(self._num_poems))
+            elif draw < (self._missing_rate + self._redirect_rate +
+                         self._photo_rate):
+                links.append("/kk/Photo_%d" % rng.randrange(self._num_poems))
+            elif draw < (self._missing_rate + self._redirect_rate +
+                         self._photo_rate + self._index_rate):
+                links.append("/kk/Index_%d" % rng.randrange(self._num_poems))
+            else:
+                links.append("/kk/Kavita_%d" % rng.randrange(self._num_poems))
+        heading = " ".join(rng.choice(_WORDS) for _ in range(3))
+        return self._page("%s / कवि %d" % (heading, number), poem, links)
+
+    # Every page has the navigation of a wiki page around its content.
+    def _page(self, heading, content, links):
+        nav = [
+            "/kk/Special:Random", "/kk/images/logo.png",
+            "/share?url=%s" % quote(heading),
+            "/kk/index.php?title=%s&action=edit" % quote(heading),
+            "/kk/index.php?title=%s&printable=yes" % quote(heading)
+        ]
+        anchors = "\n".join('<li><a href="%s">%s</a></li>' % (href, href)
+                            for href in links + nav)
+        return (
+            '<!DOCTYPE html>\n<html lang="hi"><head><meta charset="UTF-8" />'
+            '<title>%s</title></head><body>\n<div id="content">'
+            '<h1 id="firstHeading" class="firstHeading">%s</h1>\n'
+            '<div id="mw-content-text">%s</div>\n</div>\n'
+            '<div id="mw-navigation"><ul>\n%s\n</ul></div>\n</body></html>' %
+            (heading, heading, content, anchors)).encode()
+
+
+# Admits up to max_rps requests per second, with a token bucket holding a
+# second worth of them, and max_concurrency at a time, 0 for no limit.
+class _Throttle:
+    _max_rps = 0
+    _max_concurrency = 0
+    _tokens = 0
+    _last_refill = 0
+    in_flight = 0
+    _lock = None
+
+    def __init__(self, max_rps, max_concurrency):
+        self._max_rps = max_rps
+        self._max_concurrency = max_concurrency
+        self._tokens = max_rps
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Returns the status to reject a request with, or None after counting it
+    # in flight.
+    def admit(self):
+        with self._lock:
+            if self._max_rps > 0:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._max_rps,
+                    self._tokens + (now - self._last_refill) * self._max_rps)
+                self._last_refill = now
+                if self._tokens < 1:
+                    return 429
+                self._tokens -= 1
+            if self._max_concurrency > 0 and (self.in_flight
+                                              >= self._max_concurrency):
+                return 503
+            self.in_flight += 1
+            return None
+
+    def done(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+# Serves site on a thread of its own and returns the server, whose
+# server_address has the port when port is 0.
+def start_server(site,
+                 port=0,
+                 latency_ms=0,
+                 host="127.0.0.1",
+                 load_latency_ms=0,
+                 max_rps=0,
+                 max_concurrency=0,
+                 compress=True):
+    throttle = _Throttle(max_rps, max_concurrency)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are written separately, with Nagle the body
+        # waits for the ack of the headers.
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            rejected = throttle.admit()
+            if rejected is not None:
+                self._send(rejected, {'Retry-After': "1"}, b"")
+                return
+            try:
+                delay_ms = latency_ms + load_latency_ms * (throttle.in_flight -
+                                                           1)
+                if delay_ms > 0:
+                    time.sleep(delay_ms / 1000)
+                status, headers, body = site.render(self.path)
+            finally:
+                throttle.done()
+            self._send(status, headers, body)
+
+        def _send(self, status, headers, body):
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            accepted = self.headers.get("Accept-Encoding", "")
+            # Only html is compressed, images are already
+            html = "Content-Type" not in headers
+            if compress and html and len(body) > 0 and "gzip" in accepted:
+                body = gzip.compress(body, 6)
+                self.send_header("Content-Encoding", "gzip")
+            elif compress and html and len(body) > 0 and "deflate" in accepted:
+                body = zlib.compress(body, 6)
+                self.send_header("Content-Encoding", "deflate")
+            if html:
+                self.send_header("Content-Type", "text/html; charset=UTF-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("Standin request: " + format, *args)
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever,
+                     name="StandinServer",
+                     daemon=True).start()
+    return server
+
+
+def AddSiteArgs(parser):
+    parser.add_argument('--num_poems',
+                        help='Number of poem pages of the site',
+                        type=int,
+                        default=100000)
+    parser.add_argument('--num_categories',
+                        help='Number of category pages of the site',
+                        type=int,
+                        default=1000)
+    parser.add_argument('--fan_out',
+                        help='Number of links of a poem or category page',
+                        type=int,
+                        default=20)
+    parser.add_argument('--missing_rate',
+                        help='Share of links to pages with no article',
+                        type=float,
+                        default=0.05)
+    parser.add_argument('--redirect_rate',
+                        help='Share of links which redirect',
+                        type=float,
+                        default=0.02)
+    parser.add_argument('--photo_rate',
+                        help='Share of links to images',
+                        type=float,
+                        default=0)
+    parser.add_argument('--index_rate',
+                        help='Share of links to huge pages',
+                        type=float,
+                        default=0)
+    parser.add_argument('--photo_kb',
+                        help='Size of the images',
+                        type=int,
+                        default=512)
+    parser.add_argument('--index_kb',
+                        help='Size of the huge pages',
+                        type=int,
+                        default=20480)
+    parser.add_argument('--latency_ms',
+                        help='Delay of every response',
+                        type=float,
+                        default=20)
+    parser.add_argument('--load_latency_ms',
+                        help='Extra delay of a response for every other '
+                        'request being served',
+                        type=float,
+                        default=0)
+    parser.add_argument('--max_rps',
+                        help='Requests per second beyond which the site '
+                        'answers 429, 0 for no limit',
+                        type=float,
+                        default=0)
+    parser.add_argument('--max_concurrency',
+                        help='Concurrent requests beyond which the site '
+                        'answers 503, 0 for no limit',
+                        type=int,
+                        default=0)
+    parser.add_argument('--compress',
+                        help='Compress the pages for clients which accept it',
+                        type=int,
+                        default=1,
+                        choices=[0, 1])  # 0 = false, 1 = true
+    parser.add_argument('--seed',
+                        help='Seed the pages are generated from',
+                        type=int,
+                        default=1)
+
+
+# Serves the site of flags as per their latency and throttling flags.
+def StartServer(site, flags, port=0):
+    return start_server(site,
+                        port,
+                        flags['latency_ms'],
+                        load_latency_ms=flags['load_latency_ms'],
+                        max_rps=flags['max_rps'],
+                        max_concurrency=flags['max_concurrency'],
+                        compress=flags['compress'] == 1)
+
+
+def MakeSite(flags):
+    return StandinSite(flags['num_poems'], flags['num_categories'],
+                       flags['fan_out'], flags['missing_rate'],
+                       flags['redirect_rate'], flags['seed'],
+                       flags['photo_rate'], flags['index_rate'],
+                       flags['photo_kb'], flags['index_kb'])
+
+
+def ProcessArgs():
+    parser = argparse.ArgumentParser(
+        description='Serve a synthetic kavitakosh like site')
+    parser.add_argument('--port',
+                        help='Port to serve on',
+                        type=int,
+                        default=8765)
+    parser.add_argument('--log',
+                        help='logging level',
+                        type=str,
+                        default="WARNING")  # NOTSET
+    AddSiteArgs(parser)
+    return vars(parser.parse_args())
+
+
+def main():
+    flags = ProcessArgs()
+    logging.basicConfig(level=flags['log'])
+    server = StartServer(MakeSite(flags), flags, flags['port'])
+    print("Serving on http://127.0.0.1:%d" % server.server_address[1])
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,53 @@
+import codecs
+import collections
+import hashlib
 import logging
+import re
+from html.parser import HTMLParser
 
 from bs4 import BeautifulSoup
 
+try:
+    import lxml.etree
+    import lxml.html
+except ImportError:
+    lxml = None
+
+# What extract() finds on a page. heading and poem are the text of the first
+# matching element or None, no_article_text is True if the page has the
+# missing article marker and hrefs are those of all the anchors, in order.
+PageContent = collections.namedtuple(
+    'PageContent', ['heading', 'poem', 'no_article_text', 'hrefs'])
+
+# A poem as stored in fetched_content, with md5 hashes of the sanitized heading
+# and poem.
+Poem = collections.namedtuple('Poem',
+                              ['heading', 'headingHash', 'poem', 'poemHash'])
+
+BACKENDS = ["bs4", "stream", "lxml"]
+
+# lxml refuses a decoded page with an xml declaration naming its encoding
+_XML_DECLARATION = re.compile(r'^\ufeff?\s*<\?xml[^>]*\?>')
+
 
 # Use BeautifulSoup to parse and extract information from a fetched page
 class UrlParser:
     _soup = None
+    _backend = None
+    # (element, attribute, value) as taken by find_element. Defaults are for
+    # kavitakosh.
+    heading_selector = ('h1', 'class', 'firstHeading')
+    poem_selector = ('div', 'class', 'poem')
+    no_article_selector = ('div', 'class', 'noarticletext')
 
-    def __init__(self, data=None):
+    # backend is used by extract(): bs4 is the reference, stream is a single
+    # pass of the stdlib tokenizer without building a tree and lxml needs the
+    # lxml package.
+    def __init__(self, data=None, backend="bs4"):
+        assert backend in BACKENDS, backend
+        if backend == "lxml" and lxml is None:
+            raise ImportError("lxml backend needs the lxml package")
+        self._backend = backend
         if data is not None:
             self._soup = BeautifulSoup(data)
         else:
@@ -34,7 +74,207 @@ class UrlParser:
     def set_data(self, data, format="html.parser"):
         self._soup = BeautifulSoup(data, format)
 
+    # Finds the heading, poem, missing article marker and all the hrefs of a
+    # page with the configured backend.
+    def extract(self, data):
+        if self._backend == "stream":
+            return _extract_stream(data, self)
+        if self._backend == "lxml":
+            return _extract_lxml(data, self)
+        self.set_data(data)
+        return PageContent(
+            self.find_element(*self.heading_selector),
+            self.find_element(*self.poem_selector),
+            self.find_element(*self.no_article_selector) is not None, [
+                a_tag['href']
+                for a_tag in self.find_all("a") if a_tag.has_attr('href')
+            ])
+
+    # Returns an extractor to feed a page to in chunks, eg. as it is fetched,
+    # whose close() returns the PageContent of extract() for the whole page.
+    # The stream and lxml backends parse each chunk as it comes, bs4 keeps the
+    # chunks and parses the page on close().
+    def start_extract(self):
+        if self._backend == "stream":
+            return _StreamFeed(self)
+        if self._backend == "lxml":
+            return _LxmlFeed(self)
+        return _BufferedFeed(self)
+
+    # Returns the Poem of a PageContent from extract(), or None if the page has
+    # no heading or poem.
+    def get_poem(self, page):
+        heading, poem = page.heading, page.poem
+        if heading is None or poem is None:
+            return None
+        heading = self.sanitize_text(heading)
+        poem = self.sanitize_text(poem)
+        if len(heading) == 0 or len(poem) == 0:
+            return None
+        return Poem(heading,
+                    hashlib.md5(heading.encode()).hexdigest(), poem,
+                    hashlib.md5(poem.encode()).hexdigest())
+
     @staticmethod
     def sanitize_text(text):
         text = text.strip()
         return text
+
+
+def _decode(data):
+    if isinstance(data, bytes):
+        return data.decode('utf-8', errors='replace')
+    return data
+
+
+# Collects the text of the first element matching each selector and all the
+# hrefs as the tokenizer goes, keeping only a count of open elements.
+class _StreamExtractor(HTMLParser):
+
+    def __init__(self, selectors):
+        super().__init__(convert_charrefs=True)
+        self.selectors = selectors
+        self.texts = [None] * len(selectors)
+        self.hrefs = []
+        # Index of the selector being collected to its depth in its element
+        self._open = {}
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            for name, value in attrs:
+                if name == 'href' and value is not None:
+                    self.hrefs.append(value)
+                    break
+        for i, (elem, attr, prop) in enumerate(self.selectors):
+            if elem != tag:
+                continue
+            if i in self._open:
+                self._open[i] += 1
+            elif self.texts[i] is None:
+                for name, value in attrs:
+                    if name == attr and value is not None and prop in value.split(
+                    ):
+                        self.texts[i] = []
+                        self._open[i] = 1
+                        break
+
+    def handle_endtag(self, tag):
+        for i in list(self._open):
+            if self.selectors[i][0] == tag:
+                self._open[i] -= 1
+                if self._open[i] == 0:
+                    del self._open[i]
+
+    def handle_data(self, data):
+        for i in self._open:
+            self.texts[i].append(data)
+
+
+def _extract_stream(data, parser):
+    extractor = _StreamExtractor(_get_selectors(parser))
+    extractor.feed(_decode(data))
+    return _close_stream(extractor)
+
+
+def _get_selectors(parser):
+    return [
+        parser.heading_selector, parser.poem_selector,
+        parser.no_article_selector
+    ]
+
+
+def _close_stream(extractor):
+    extractor.close()
+    heading, poem, no_article = [
+        None if text is None else ''.join(text) for text in extractor.texts
+    ]
+    return PageContent(heading, poem, no_article is not None, extractor.hrefs)
+
+
+def _extract_lxml(data, parser):
+    if len(data) == 0:
+        return PageContent(None, None, False, [])
+    # Decoded like the other backends, lxml would take pages without a charset
+    # to be latin-1.
+    try:
+        root = lxml.html.fromstring(
+            _XML_DECLARATION.sub('', _decode(data), count=1))
+    except lxml.etree.ParserError:
+        # Only whitespace or comments
+        return PageContent(None, None, False, [])
+    return _extract_lxml_tree(root, parser)
+
+
+def _extract_lxml_tree(root, parser):
+    selectors = _get_selectors(parser)
+    texts = [None] * len(selectors)
+    hrefs = []
+    for elm in root.iter():
+        tag = elm.tag
+        if not isinstance(tag, str):
+            # Comments and processing instructions
+            continue
+        if tag == 'a':
+            href = elm.get('href')
+            if href is not None:
+                hrefs.append(href)
+        for i, (elem, attr, prop) in enumerate(selectors):
+            if texts[i] is None and tag == elem and prop in elm.get(
+                    attr, '').split():
+                texts[i] = elm.text_content()
+    return PageContent(texts[0], texts[1], texts[2] is not None, hrefs)
+
+
+# The chunks of a page may split utf-8 sequences, they are decoded as one
+# text by an incremental decoder.
+class _StreamFeed:
+
+    def __init__(self, parser):
+        self._extractor = _StreamExtractor(_get_selectors(parser))
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def feed(self, chunk):
+        self._extractor.feed(self._decoder.decode(chunk))
+
+    def close(self):
+        self._extractor.feed(self._decoder.decode(b'', final=True))
+        return _close_stream(self._extractor)
+
+
+class _LxmlFeed:
+
+    def __init__(self, parser):
+        self._parser = parser
+        self._feed_parser = lxml.html.HTMLParser()
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._empty = True
+
+    def feed(self, chunk):
+        self._feed_text(self._decoder.decode(chunk))
+
+    def close(self):
+        self._feed_text(self._decoder.decode(b'', final=True))
+        # lxml fails on a document with nothing in it and has no root for one
+        # of only whitespace or comments
+        root = None if self._empty else self._feed_parser.close()
+        if root is None:
+            return PageContent(None, None, False, [])
+        return _extract_lxml_tree(root, self._parser)
+
+    def _feed_text(self, text):
+        if len(text) > 0:
+            self._empty = False
+            self._feed_parser.feed(text)
+
+
+class _BufferedFeed:
+
+    def __init__(self, parser):
+        self._parser = parser
+        self._chunks = []
+
+    def feed(self, chunk):
+        self._chunks.append(chunk)
+
+    def close(self):
+        return self._parser.extract(b''.join(self._chunks))